@@ -8,34 +8,860 @@ import time
 from datetime import datetime, timedelta
 import imgkit
 import reportlab
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image, ImageEnhance, ImageFilter, ImageSequence
 import pytesseract
+try:
+    import tesserocr  # Opcional: Tesseract em processo (libtesseract)
+except ImportError:
+    tesserocr = None
+try:
+    from pyzbar import pyzbar  # Opcional: leitura de código de barras via zbar
+except ImportError:
+    pyzbar = None
+try:
+    import yaml  # Opcional: pacotes de regras em YAML (JSON funciona sem ele)
+except ImportError:
+    yaml = None
+try:
+    import xlrd  # Opcional: .xls binário e leitura do contêiner OLE2 dos .doc
+    from xlrd.compdoc import CompDoc
+except ImportError:
+    xlrd = None
+    CompDoc = None
 from docx import Document
+from docx.oxml.ns import qn
 import pandas as pd
+import numpy as np
 from PyPDF2 import PdfReader
 import fitz  # PyMuPDF
 from bs4 import BeautifulSoup
 import logging
+import logging.handlers
+import atexit
 from collections import Counter
-from difflib import SequenceMatcher
-
-rarfile.UNRAR_TOOL = r"C:\Program Files\WinRAR\UnRAR.exe"
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import heapq
+import tempfile
+import sqlite3
+import argparse
+from functools import partial
+from contextlib import contextmanager
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+import threading
+import pickle
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque, defaultdict
+import shlex
+import queue
+import glob
+import statistics
+import urllib.request
+import urllib.error
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    from watchdog.observers import Observer  # Opcional: eventos do sistema de arquivos
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+import hashlib
+import socket
+import io
+import csv
+import sys
+import struct
+import subprocess
+import signal
+import pathlib
 
 # --- Configurações ---
 BASE_PATH = r'E:\ambiente_teste\01 amostragem'
 JSON_OUTPUT_FOLDER_NAME = '01-JSON'
 JSON_OUTPUT_PATH = os.path.join(BASE_PATH, JSON_OUTPUT_FOLDER_NAME)
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-
-# --- Configuração do Logging ---
-logging.basicConfig(filename='processamento_log.log', level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    encoding='utf-8')
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logging.getLogger().addHandler(console_handler)
+# Ferramentas externas: aplicadas por configure_external_tools() na execução como script
+# (importar o módulo não altera o pytesseract nem o rarfile)
+TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+UNRAR_TOOL = r"C:\Program Files\WinRAR\UnRAR.exe"
+LOG_FILE_PATH = 'processamento_log.log'
+
+# Backend de OCR: 'auto' (tesserocr se instalado, senão pytesseract), 'tesserocr' ou 'pytesseract'
+OCR_BACKEND = 'auto'
+TESSDATA_PATH = None  # Pasta tessdata para o tesserocr (None = padrão da instalação)
+
+# Idioma do OCR: 'por', 'por+eng' ou 'auto' (escolhido uma vez por documento,
+# pelo texto da primeira página; só carrega o modelo 'eng' quando necessário)
+OCR_LANGUAGE = 'auto'
+# Orientação: OSD do Tesseract em cópia reduzida, antes da passada principal
+OCR_ORIENTATION_DETECTION = True
+OSD_MAX_SIDE = 1600          # Maior lado (px) da cópia usada no OSD
+OSD_MIN_CONFIDENCE = 2.0     # Confiança mínima para girar a imagem
+# Cache de OCR (texto por imagem/idioma/configuração) e de orientação por página
+OCR_CACHE_ENABLED = True
+OCR_CACHE_DB_PATH = os.path.join(JSON_OUTPUT_PATH, '_ocr_cache.sqlite3')
+
+# PDFs escaneados: OCR rápido do topo da página 1 antes do OCR completo.
+# Se tipo, competência e CNPJ forem resolvidos pelo cabeçalho, as demais páginas não passam por OCR.
+PDF_HEADER_FIRST = True
+PDF_HEADER_FRACTION = 0.35  # Fração superior da página 1 usada na primeira passada
+PDF_HEADER_ZOOM = 1.5       # ~108 dpi (o OCR completo usa 2x)
+
+# PDFs com vários documentos digitalizados juntos (boletos, extrato, DANFEs...):
+# páginas consecutivas são agrupadas em documentos lógicos, com um registro por documento
+PDF_SPLIT_DOCUMENTS = True
+# Com a página 1 resolvida pelo cabeçalho, os cabeçalhos das demais páginas só são lidos
+# (para confirmar que é um único documento) em PDFs escaneados de até este número de páginas;
+# acima disso, o OCR completo segmenta pelo texto de cada página
+PDF_SEGMENT_PROBE_MAX_PAGES = 8
+PDF_PAGE_WORKERS = 4        # Threads de OCR por PDF (páginas em paralelo)
+# Páginas escaneadas com uma única imagem: OCR da imagem embutida na resolução
+# nativa (sem renderizar a página); páginas compostas continuam renderizadas
+PDF_NATIVE_IMAGES = True
+PDF_NATIVE_IMAGE_MIN_COVERAGE = 0.85  # Fração mínima da página coberta pela imagem
+PDF_NATIVE_IMAGE_MIN_DPI = 150        # Abaixo disso, renderiza em 2x (melhor para o OCR)
+# TIFF/GIF com várias páginas e imagens coladas em DOCX (OCR em paralelo, como as páginas de PDF)
+IMAGE_MAX_FRAMES = 500       # Limite de quadros lidos por arquivo de imagem
+DOCX_IMAGE_MIN_SIDE = 300    # Imagens menores (logotipos, ícones) não passam pelo OCR
+
+# Boletos: leitura do código de barras ITF direto da imagem (sem OCR) em
+# imagens e PDFs escaneados de uma página
+BOLETO_BARCODE_ENABLED = True
+BOLETO_BARCODE_ZOOM = 3     # ~216 dpi: barras estreitas com ~3 px
+
+# Extratos bancários: grava as transações (data, descrição, valor, saldo) em
+# <json>_transacoes.csv ao lado do JSON
+STATEMENT_TRANSACTIONS_ENABLED = True
+
+# Descoberta de arquivos: threads para varredura paralela (1 = sequencial)
+SCAN_WORKERS = 8
+# Pastas de sistema que nunca contêm documentos de clientes
+IGNORED_DIR_NAMES = {
+    JSON_OUTPUT_FOLDER_NAME, '$RECYCLE.BIN', 'System Volume Information',
+    '__MACOSX', '.git', '.svn', '@eaDir', '.Trash-1000',
+}
+
+# Agendamento: pool para arquivos rápidos (texto/Office/PDF com texto) e pool dedicado ao OCR
+FAST_POOL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+OCR_POOL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Isolamento por arquivo: tempo máximo, teto de memória e reciclagem dos workers
+FILE_TIMEOUT_SECONDS = 600
+WORKER_MEMORY_LIMIT_MB = 2048  # aplicado via RLIMIT_AS (indisponível no Windows)
+WORKER_MAX_TASKS = 50
+# Pasta das extrações temporárias de .zip/.rar (uma subpasta por arquivo, com o pid do worker)
+ARCHIVE_EXTRACT_BASE = r'C:\temp_extract' if os.name == 'nt' else '/tmp/temp_extract'
+
+# Diário de checkpoints para retomar execuções interrompidas (--resume)
+CHECKPOINT_DB_PATH = os.path.join(JSON_OUTPUT_PATH, '_checkpoints.sqlite3')
+
+# Modo daemon (--watch): espera o arquivo parar de mudar antes de processá-lo
+WATCH_DEBOUNCE_SECONDS = 5
+WATCH_POLL_INTERVAL = 15  # Varredura periódica, usada apenas sem o pacote watchdog
+
+# Serviço HTTP local (--serve)
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+SERVICE_MAX_CONCURRENCY = 16   # Requisições admitidas (em processamento + na fila)
+SERVICE_MAX_UPLOAD_MB = 50
+
+# Detecção de duplicados: hash de conteúdo (exato, antes do OCR), hash perceptual
+# da página renderizada e MinHash do texto (quase-duplicados: marcados como
+# duplicados, mas só o tipo é reaproveitado)
+DEDUP_ENABLED = True
+DEDUP_DB_PATH = os.path.join(JSON_OUTPUT_PATH, '_duplicados.sqlite3')
+PHASH_MAX_DISTANCE = 8       # bits diferentes (de 256) para considerar a mesma imagem
+MINHASH_THRESHOLD = 0.9      # similaridade de Jaccard estimada entre textos
+
+# Resumo da execução: contagens por cliente/tipo/competência e competências faltantes.
+# 'csv' ou 'parquet' (parquet exige pyarrow ou fastparquet; sem eles, grava CSV)
+SUMMARY_FORMAT = 'csv'
+SUMMARY_OUTPUT_BASE = os.path.join(JSON_OUTPUT_PATH, '_resumo_execucao')
+
+# Índice SQLite com todos os resultados (consultas com --query)
+INDEX_ENABLED = True
+INDEX_DB_PATH = os.path.join(JSON_OUTPUT_PATH, '_indice.sqlite3')
+
+# Processamento distribuído: fila SQLite em pasta compartilhada (--queue / --queue-worker)
+QUEUE_LEASE_SECONDS = 120      # Validade do lease; renovado enquanto o item está em processamento
+QUEUE_MAX_ATTEMPTS = 3         # Tentativas (falhas ou leases expirados) antes de desistir do item
+QUEUE_POLL_INTERVAL = 2.0      # Espera quando a fila está vazia (workers) ou entre coletas (coordenador)
+QUEUE_PUBLISH_BATCH = 200      # Itens publicados por transação
+QUEUE_JOURNAL_MODE = 'DELETE'  # WAL exige todos os processos no mesmo host; DELETE funciona em SMB/NFS
+
+# Pacotes de regras de classificação (JSON/YAML) aplicados sobre as regras embutidas.
+# Recarregados automaticamente quando alterados; a versão validada fica em cache por hash.
+RULE_PACKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regras')
+RULE_PACKS_CACHE_DIR = os.path.join(JSON_OUTPUT_PATH, '_regras_cache')
+RULE_PACKS_CHECK_INTERVAL = 5.0  # Segundos entre verificações de alteração dos pacotes
+
+# Perfil de desempenho por arquivo (--profile): cProfile + tracemalloc. Só os arquivos
+# acima de um dos limites têm o perfil gravado; ao final, um relatório mesclado.
+PROFILE_OUTPUT_DIR = os.path.join(JSON_OUTPUT_PATH, '_perfil')
+PROFILE_SLOW_SECONDS = 10.0    # Tempo de processamento a partir do qual o perfil é mantido
+PROFILE_MEMORY_MB = 300        # Pico de memória alocada pelo Python a partir do qual o perfil é mantido
+PROFILE_TRACEBACK_FRAMES = 8   # Quadros guardados por alocação (mais quadros, mais sobrecarga)
+PROFILE_TOP_ALLOCATIONS = 30   # Locais de alocação listados por arquivo e no relatório
+PROFILE_SNAPSHOT_INTERVAL = 0.5  # Segundos entre amostras de memória (snapshot guardado perto do pico)
+
+# Formatos legados do Office (.doc/.xls binários, OLE2): leitura direta (Word 97-2003 pela
+# tabela de peças, .xls pelo xlrd); o que não for lido assim é convertido em lotes por um
+# LibreOffice headless (perfis reaproveitados) e o resultado fica em cache pelo hash do conteúdo
+LEGACY_SOFFICE_CMD = None          # None: procura 'soffice'/'libreoffice' no PATH
+LEGACY_ANTIWORD_CMD = None         # None: procura 'antiword' no PATH (.doc antigos, sem LibreOffice)
+LEGACY_CONVERTER_WORKERS = 2       # Conversões simultâneas, cada uma com seu perfil do LibreOffice
+LEGACY_CONVERT_BATCH_SIZE = 25     # Arquivos por chamada ao LibreOffice
+LEGACY_CONVERT_BATCH_WAIT = 5.0    # Segundos máximos que um arquivo espera o lote completar
+LEGACY_CONVERT_TIMEOUT = 120       # Segundos por chamada (mais 10 s por arquivo do lote)
+LEGACY_FAILED_RETRY_DAYS = 7       # Arquivo que falhou na conversão é tentado de novo após este prazo
+LEGACY_CONVERT_CACHE_DIR = os.path.join(JSON_OUTPUT_PATH, '_convertidos')
+LEGACY_PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'ocr_inteligente_libreoffice')
+
+# --- Configuração do Logging e Ferramentas Externas ---
+
+_runtime_settings = {'tesseract_cmd': None, 'unrar_tool': None, 'log_file': None, 'rule_packs_dir': None,
+                     'profile': None, 'base_path': None, 'output_path': None}
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_BATCH_MAX_RECORDS = 200  # Linhas acumuladas por arquivo antes de um envio parcial
+# Linhas do relatório/resumo: as únicas exibidas no console no modo silencioso (--quiet)
+LOG_SUMMARY = {'resumo': True}
+
+class BatchingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Envia os registros para o escritor único (fila local no processo
+    principal, pipe de log nos workers) sem bloquear em disco ou console.
+    Entre begin_batch() e end_batch() (um arquivo em processamento), todos
+    os registros, inclusive avisos e erros, são acumulados e enviados de uma
+    vez, mantendo as linhas de cada arquivo contíguas no log mesmo com vários
+    processos. Só um lote com LOG_BATCH_MAX_RECORDS linhas é enviado antes.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self._batch = None
+        self._batch_depth = 0
+
+    def begin_batch(self):
+        self.acquire()
+        try:
+            self._batch_depth += 1
+            if self._batch is None:
+                self._batch = []
+        finally:
+            self.release()
+
+    def end_batch(self):
+        self.acquire()
+        try:
+            self._batch_depth = max(0, self._batch_depth - 1)
+            if self._batch_depth == 0:
+                self._flush_batch()
+                self._batch = None
+        finally:
+            self.release()
+
+    def _flush_batch(self):
+        if self._batch:
+            self.enqueue(self._batch)
+            self._batch = []
+
+    def emit(self, record):
+        try:
+            prepared = self.prepare(record)
+            self.acquire()
+            try:
+                if self._batch is None:
+                    self.enqueue(prepared)
+                    return
+                self._batch.append(prepared)
+                if len(self._batch) >= LOG_BATCH_MAX_RECORDS:
+                    self._flush_batch()
+            finally:
+                self.release()
+        except Exception:
+            self.handleError(record)
+
+
+class _PipeLogSink:
+    """Destino do handler num worker: registros e lotes seguem pelo pipe de log exclusivo do worker"""
+
+    __slots__ = ('conn',)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put_nowait(self, item):
+        self.conn.send(item)
+
+
+class _BatchQueueListener(logging.handlers.QueueListener):
+    """Escritor único: grava registros avulsos e lotes de registros, na ordem de chegada"""
+
+    def handle(self, record):
+        if isinstance(record, list):
+            for batched_record in record:
+                super().handle(batched_record)
+        else:
+            super().handle(record)
+
+
+class _SummaryConsoleFilter(logging.Filter):
+    """Modo silencioso: no console, apenas avisos/erros e linhas de resumo"""
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or getattr(record, 'resumo', False)
+
+
+_log_listener = None
+_log_listener_pid = None
+_log_queue = None
+
+def _batching_handler():
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, BatchingQueueHandler):
+            return handler
+    return None
+
+def attach_log_queue(log_queue, level=logging.INFO):
+    """Processo principal: todo o log vai para a fila local do escritor"""
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(BatchingQueueHandler(log_queue))
+
+def attach_log_pipe(conn, level=logging.INFO):
+    """
+    Processos worker do pool: o log segue pelo pipe do próprio worker, lido
+    pelo pool no processo principal. Um worker encerrado à força no meio de
+    um envio só corrompe o próprio pipe, que o pool descarta; nenhuma fila é
+    compartilhada entre processos.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)  # Herdados do processo principal (fork)
+    root.setLevel(level)
+    root.addHandler(BatchingQueueHandler(_PipeLogSink(conn)))
+
+def log_writer_active():
+    """Verdadeiro quando este processo tem o escritor de log (setup_logging)"""
+    return _log_listener is not None and _log_listener_pid == os.getpid()
+
+def forward_worker_log(item):
+    """Entrega ao escritor um registro (ou lote) recebido do pipe de log de um worker"""
+    if _log_queue is not None:
+        _log_queue.put_nowait(item)
+
+@contextmanager
+def file_log_batch():
+    """Agrupa as linhas de log de um arquivo em um único envio ao escritor"""
+    handler = _batching_handler()
+    if handler is None:
+        yield
+        return
+    handler.begin_batch()
+    try:
+        yield
+    finally:
+        handler.end_batch()
+
+def setup_logging(log_file=LOG_FILE_PATH, quiet=False):
+    """
+    Configura o log em arquivo e no console (chamado pela execução como
+    script). Um único thread escritor grava arquivo e console a partir de uma
+    fila local; os workers do pool enviam pelos seus pipes de log e o pool
+    repassa à mesma fila. Quem registra não espera por disco nem console.
+    Com quiet, o console mostra apenas o resumo.
+    """
+    global _log_listener, _log_listener_pid, _log_queue
+    stop_logging()
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if quiet:
+        console_handler.addFilter(_SummaryConsoleFilter())
+
+    log_queue = queue.Queue()
+    _log_listener = _BatchQueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _log_listener.start()
+    _log_listener_pid = os.getpid()
+    _log_queue = log_queue
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, BatchingQueueHandler):
+            root.removeHandler(handler)
+    attach_log_queue(log_queue)
+    _runtime_settings['log_file'] = log_file
+
+def stop_logging():
+    """Esvazia a fila de log e encerra o escritor (registrado no atexit)"""
+    global _log_listener, _log_queue
+    handler = _batching_handler()
+    if handler is not None:
+        handler.end_batch()
+    # Processos filhos (fork) herdam o objeto, mas o escritor pertence ao principal
+    if _log_listener is None or _log_listener_pid != os.getpid():
+        return
+    _log_listener.stop()
+    for listener_handler in _log_listener.handlers:
+        listener_handler.close()
+    _log_listener = None
+    _log_queue = None
+
+atexit.register(stop_logging)
+
+def configure_external_tools(tesseract_cmd=TESSERACT_CMD, unrar_tool=UNRAR_TOOL):
+    """Aponta o pytesseract e o rarfile para os executáveis informados (None mantém o padrão do PATH)"""
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        _runtime_settings['tesseract_cmd'] = tesseract_cmd
+    if unrar_tool:
+        rarfile.UNRAR_TOOL = unrar_tool
+        _runtime_settings['unrar_tool'] = unrar_tool
+
+# Caminhos que, por padrão, ficam dentro da pasta de saída (acompanham --base-path)
+_OUTPUT_PATH_SETTINGS = ('OCR_CACHE_DB_PATH', 'CHECKPOINT_DB_PATH', 'DEDUP_DB_PATH', 'SUMMARY_OUTPUT_BASE',
+                         'INDEX_DB_PATH', 'RULE_PACKS_CACHE_DIR', 'PROFILE_OUTPUT_DIR', 'LEGACY_CONVERT_CACHE_DIR')
+
+def configure_base_path(base_path):
+    """
+    Define a pasta raiz (--base-path), repassada aos processos worker. A pasta
+    de saída passa a ser <raiz>/JSON_OUTPUT_FOLDER_NAME e os caminhos que
+    estavam dentro dela a acompanham; os apontados para fora (ex.: caches no
+    disco local de cada máquina) são mantidos.
+    """
+    global BASE_PATH, JSON_OUTPUT_PATH
+    old_output_path = JSON_OUTPUT_PATH
+    BASE_PATH = base_path
+    JSON_OUTPUT_PATH = os.path.join(base_path, JSON_OUTPUT_FOLDER_NAME)
+    module_globals = globals()
+    for name in _OUTPUT_PATH_SETTINGS:
+        if os.path.dirname(module_globals[name]) == old_output_path:
+            module_globals[name] = os.path.join(JSON_OUTPUT_PATH, os.path.basename(module_globals[name]))
+    _runtime_settings['base_path'] = base_path
+
+def configure_output_path(output_path):
+    """
+    Define só a pasta dos JSONs, sem mudar a raiz nem os bancos (repassada
+    aos processos worker e aplicada depois de configure_base_path)
+    """
+    global JSON_OUTPUT_PATH
+    JSON_OUTPUT_PATH = output_path
+    _runtime_settings['output_path'] = output_path
+
+def init_worker_runtime(settings):
+    """
+    Inicializador dos processos worker: reaplica ferramentas e logging
+    configurados no processo principal (necessário com 'spawn', ex.: Windows).
+    """
+    if settings.get('base_path'):
+        configure_base_path(settings['base_path'])
+    if settings.get('output_path'):
+        configure_output_path(settings['output_path'])
+    configure_external_tools(settings.get('tesseract_cmd'), settings.get('unrar_tool'))
+    if settings.get('rule_packs_dir'):
+        configure_rule_packs(settings['rule_packs_dir'])
+    if settings.get('profile'):
+        configure_profiling(**settings['profile'])
+    if not logging.getLogger().handlers and settings.get('log_file'):
+        # Processo sem pipe de log do pool: escritor próprio no mesmo arquivo
+        setup_logging(settings['log_file'])
+
+def current_runtime_settings():
+    return dict(_runtime_settings)
+
+# --- Pacotes de Regras de Classificação ---
+
+class RulePackError(Exception):
+    """Pacote de regras inválido (o conjunto de regras em uso é mantido)"""
+    pass
+
+RULE_PACK_EXTENSIONS = ('.json', '.yaml', '.yml')
+INDICATOR_GROUPS = ('primary_indicators', 'secondary_indicators', 'context_patterns', 'negative_indicators')
+RULE_TYPE_KEYS = frozenset(INDICATOR_GROUPS + ('filename_patterns', 'filename_boost', 'ativo'))
+FILENAME_BOOST = 5
+
+# Regras embutidas; os pacotes em RULE_PACKS_DIR substituem tipos de mesmo nome,
+# acrescentam tipos novos ou desativam tipos ("ativo": false)
+DEFAULT_CLASSIFICATION_RULES = {
+    "Nota Fiscal Eletrônica": {
+        'primary_indicators': [
+            {'pattern': r'nota fiscal eletr[ôo]nica', 'weight': 25},
+            {'pattern': r'nf-e', 'weight': 20},
+            {'pattern': r'danfe', 'weight': 20},
+            {'pattern': r'chave de acesso\s*:?\s*\d{44}', 'weight': 30}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'protocolo de autoriza[çc][ãa]o', 'weight': 10},
+            {'pattern': r'valor total dos produtos', 'weight': 8},
+            {'pattern': r'destinat[áa]rio', 'weight': 5},
+            {'pattern': r'emitente', 'weight': 5},
+            {'pattern': r'icms', 'weight': 6},
+            {'pattern': r'ipi', 'weight': 4}
+        ],
+        'negative_indicators': [
+            {'pattern': r'extrato', 'weight': -15},
+            {'pattern': r'boleto', 'weight': -10}
+        ],
+        'filename_patterns': [r'nfe?', r'danfe', r'notafiscal']
+    },
+    "Extrato Bancário": {
+        'primary_indicators': [
+            {'pattern': r'extrato (?:de )?conta corrente', 'weight': 25},
+            {'pattern': r'extrato banc[áa]rio', 'weight': 25},
+            {'pattern': r'movimenta[çc][ãa]o banc[áa]ria', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'saldo anterior', 'weight': 12},
+            {'pattern': r'saldo (?:final|atual|disponível)', 'weight': 12},
+            {'pattern': r'lan[çc]amentos futuros', 'weight': 8},
+            {'pattern': r'ag[êe]ncia\s*:?\s*\d+', 'weight': 10},
+            {'pattern': r'conta\s*:?\s*[\d\-x]+', 'weight': 10},
+            {'pattern': r'pix', 'weight': 5},
+            {'pattern': r'ted|doc|transfer[êe]ncia', 'weight': 6}
+        ],
+        'context_patterns': [
+            {'pattern': r'\b\d{2}/\d{2}\s+[A-Z\s]+\s+[\d\.,\-]+', 'weight': 8}  # Padrão de lançamento
+        ],
+        'filename_patterns': [r'extrato', r'moviment', r'bancario']
+    },
+    "Boleto de Pagamento": {
+        'primary_indicators': [
+            {'pattern': r'\d{5}\.\d{5}\s+\d{5}\.\d{6}\s+\d{5}\.\d{6}\s+\d\s+\d{14}', 'weight': 40},  # Linha digitável
+            {'pattern': r'linha digit[áa]vel', 'weight': 20},
+            {'pattern': r'boleto de pagamento', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'nosso n[úu]mero', 'weight': 12},
+            {'pattern': r'data de vencimento', 'weight': 10},
+            {'pattern': r'cedente', 'weight': 8},
+            {'pattern': r'sacado', 'weight': 8},
+            {'pattern': r'valor do documento', 'weight': 8},
+            {'pattern': r'c[óo]digo de barras', 'weight': 15}
+        ],
+        'filename_patterns': [r'boleto', r'cobranca']
+    },
+    "DACTE": {
+        'primary_indicators': [
+            {'pattern': r'dacte', 'weight': 30},
+            {'pattern': r'documento auxiliar do conhecimento de transporte eletr[ôo]nico', 'weight': 25},
+            {'pattern': r'ct-e', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'remetente', 'weight': 8},
+            {'pattern': r'expedidor', 'weight': 8},
+            {'pattern': r'destinat[áa]rio', 'weight': 6},
+            {'pattern': r'tomador do servi[çc]o', 'weight': 10}
+        ],
+        'filename_patterns': [r'dacte', r'cte']
+    },
+    "SPED Fiscal": {
+        'primary_indicators': [
+            {'pattern': r'sped', 'weight': 25},
+            {'pattern': r'efd', 'weight': 20},
+            {'pattern': r'escritura[çc][ãa]o fiscal digital', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'bloco [a-z]', 'weight': 10},
+            {'pattern': r'registro \d{4}', 'weight': 8},
+            {'pattern': r'arquivo magn[ée]tico', 'weight': 6}
+        ],
+        'filename_patterns': [r'sped', r'efd']
+    },
+    "Relatório de Faturamento": {
+        'primary_indicators': [
+            {'pattern': r'relat[óo]rio de faturamento', 'weight': 25},
+            {'pattern': r'faturamento (?:mensal|do m[êe]s)', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'total faturado', 'weight': 12},
+            {'pattern': r'receita l[íi]quida', 'weight': 10},
+            {'pattern': r'resumo de vendas', 'weight': 8}
+        ],
+        'negative_indicators': [
+            {'pattern': r'fatura de', 'weight': -10}
+        ],
+        'filename_patterns': [r'faturamento', r'relatorio']
+    },
+    "Fatura de Serviços": {
+        'primary_indicators': [
+            {'pattern': r'fatura de servi[çc]os', 'weight': 25},
+            {'pattern': r'fatura (?:do )?cart[ãa]o', 'weight': 20}
+        ],
+        'secondary_indicators': [
+            {'pattern': r'valor da fatura', 'weight': 10},
+            {'pattern': r'data de vencimento', 'weight': 8},
+            {'pattern': r'discrimina[çc][ãa]o dos servi[çc]os', 'weight': 12}
+        ],
+        'negative_indicators': [
+            {'pattern': r'faturamento', 'weight': -15}
+        ],
+        'filename_patterns': [r'fatura']
+    }
+}
+
+def configure_rule_packs(directory):
+    """Define a pasta de pacotes de regras (repassada aos processos worker)"""
+    global RULE_PACKS_DIR
+    RULE_PACKS_DIR = directory
+    _runtime_settings['rule_packs_dir'] = directory
+
+def _check_pattern(pattern, where):
+    if not isinstance(pattern, str) or not pattern:
+        raise RulePackError(f"{where}: padrão deve ser um texto não vazio")
+    try:
+        re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise RulePackError(f"{where}: regex inválida {pattern!r} ({e})")
+
+def validate_rule_pack(pack, pack_name):
+    """Valida um pacote de regras e retorna {'nome', 'versao', 'tipos'} normalizado"""
+    if not isinstance(pack, dict):
+        raise RulePackError(f"{pack_name}: o pacote deve ser um objeto")
+    unknown = set(pack) - {'nome', 'versao', 'tipos'}
+    if unknown:
+        raise RulePackError(f"{pack_name}: chaves desconhecidas {sorted(unknown)}")
+    if 'versao' not in pack:
+        raise RulePackError(f"{pack_name}: campo 'versao' obrigatório")
+    doc_types = pack.get('tipos')
+    if not isinstance(doc_types, dict) or not doc_types:
+        raise RulePackError(f"{pack_name}: 'tipos' deve ser um objeto com ao menos um tipo")
+
+    normalized = {}
+    for doc_type, rules in doc_types.items():
+        where = f"{pack_name} / {doc_type}"
+        if not isinstance(rules, dict):
+            raise RulePackError(f"{where}: as regras do tipo devem ser um objeto")
+        unknown = set(rules) - RULE_TYPE_KEYS
+        if unknown:
+            raise RulePackError(f"{where}: chaves desconhecidas {sorted(unknown)}")
+        if rules.get('ativo', True) is False:
+            normalized[doc_type] = {'ativo': False}
+            continue
+
+        entry = {}
+        for group in INDICATOR_GROUPS:
+            indicators = rules.get(group, [])
+            if not isinstance(indicators, list):
+                raise RulePackError(f"{where}: '{group}' deve ser uma lista")
+            entry[group] = []
+            for indicator in indicators:
+                if not isinstance(indicator, dict) or set(indicator) != {'pattern', 'weight'}:
+                    raise RulePackError(f"{where}: cada item de '{group}' precisa de 'pattern' e 'weight'")
+                _check_pattern(indicator['pattern'], where)
+                weight = indicator['weight']
+                if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+                    raise RulePackError(f"{where}: peso inválido {weight!r}")
+                if (group == 'negative_indicators') != (weight < 0):
+                    raise RulePackError(f"{where}: pesos de '{group}' devem ser "
+                                        f"{'negativos' if group == 'negative_indicators' else 'positivos'}")
+                entry[group].append({'pattern': indicator['pattern'], 'weight': weight})
+        if not entry['primary_indicators'] and not entry['secondary_indicators']:
+            raise RulePackError(f"{where}: informe ao menos um indicador primário ou secundário")
+
+        filename_patterns = rules.get('filename_patterns', [])
+        if not isinstance(filename_patterns, list):
+            raise RulePackError(f"{where}: 'filename_patterns' deve ser uma lista")
+        for pattern in filename_patterns:
+            _check_pattern(pattern, where)
+        entry['filename_patterns'] = list(filename_patterns)
+        boost = rules.get('filename_boost', FILENAME_BOOST)
+        if isinstance(boost, bool) or not isinstance(boost, (int, float)):
+            raise RulePackError(f"{where}: 'filename_boost' inválido {boost!r}")
+        entry['filename_boost'] = boost
+        normalized[doc_type] = entry
+
+    return {'nome': str(pack.get('nome') or os.path.splitext(pack_name)[0]),
+            'versao': str(pack['versao']), 'tipos': normalized}
+
+def _parse_rule_pack(pack_name, data):
+    try:
+        if pack_name.lower().endswith('.json'):
+            return json.loads(data.decode('utf-8-sig'))
+        if yaml is None:
+            raise RulePackError(f"{pack_name}: PyYAML não instalado (use JSON ou 'pip install pyyaml')")
+        return yaml.safe_load(data)
+    except (ValueError, getattr(yaml, 'YAMLError', ValueError)) as e:
+        raise RulePackError(f"{pack_name}: arquivo ilegível ({e})")
+
+def _rule_pack_files(directory):
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(entry.path for entry in os.scandir(directory)
+                  if entry.is_file() and entry.name.lower().endswith(RULE_PACK_EXTENSIONS))
+
+def build_rule_set(pack_contents):
+    """
+    Aplica os pacotes, em ordem de nome de arquivo, sobre as regras embutidas.
+    pack_contents: lista de (nome_do_arquivo, bytes). Retorna (regras, pacotes).
+    """
+    rules = {doc_type: dict(entry, filename_boost=FILENAME_BOOST)
+             for doc_type, entry in DEFAULT_CLASSIFICATION_RULES.items()}
+    packs = []
+    for pack_name, data in pack_contents:
+        pack = validate_rule_pack(_parse_rule_pack(pack_name, data), pack_name)
+        for doc_type, entry in pack['tipos'].items():
+            if entry.get('ativo', True) is False:
+                rules.pop(doc_type, None)
+            else:
+                rules[doc_type] = entry
+        packs.append(f"{pack['nome']}@{pack['versao']}")
+    return rules, packs
+
+
+class CompiledRuleSet:
+    """Regras de classificação com as regex já compiladas, prontas para o analisador"""
+
+    __slots__ = ('pack_hash', 'packs', 'types', 'filename_patterns')
+
+    def __init__(self, rules, pack_hash, packs):
+        self.pack_hash = pack_hash
+        self.packs = packs
+        self.types = {
+            doc_type: {group: tuple((re.compile(indicator['pattern'], re.IGNORECASE), indicator['weight'])
+                                    for indicator in entry.get(group, []))
+                       for group in INDICATOR_GROUPS}
+            for doc_type, entry in rules.items()
+        }
+        self.filename_patterns = tuple(
+            (doc_type, re.compile(pattern), entry.get('filename_boost', FILENAME_BOOST))
+            for doc_type, entry in rules.items()
+            for pattern in entry.get('filename_patterns', [])
+        )
+
+
+_compiled_rule_sets = {}
+
+def load_rule_set(directory=None, cache_dir=None):
+    """
+    Carrega e compila o conjunto de regras atual. O hash cobre as regras
+    embutidas e o conteúdo de cada pacote: o resultado validado fica em
+    cache_dir/<hash>.json (os workers pulam leitura de YAML e validação) e o
+    conjunto compilado é reaproveitado no processo enquanto o hash não mudar.
+    """
+    directory = RULE_PACKS_DIR if directory is None else directory
+    cache_dir = RULE_PACKS_CACHE_DIR if cache_dir is None else cache_dir
+    pack_contents = []
+    for pack_path in _rule_pack_files(directory):
+        with open(pack_path, 'rb') as f:
+            pack_contents.append((os.path.basename(pack_path), f.read()))
+
+    digest = hashlib.sha256(json.dumps(DEFAULT_CLASSIFICATION_RULES, sort_keys=True).encode('utf-8'))
+    for pack_name, data in pack_contents:
+        digest.update(pack_name.encode('utf-8') + b'\0' + hashlib.sha256(data).digest())
+    pack_hash = digest.hexdigest()[:16]
+
+    compiled = _compiled_rule_sets.get(pack_hash)
+    if compiled is not None:
+        return compiled
+
+    artifact_path = os.path.join(cache_dir, f"{pack_hash}.json") if cache_dir and pack_contents else None
+    artifact = None
+    if artifact_path and os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, 'r', encoding='utf-8') as f:
+                artifact = json.load(f)
+        except (OSError, ValueError):
+            artifact = None
+    if artifact is None:
+        rules, packs = build_rule_set(pack_contents)
+        artifact = {'regras': rules, 'pacotes': packs}
+        if artifact_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(artifact, f, ensure_ascii=False)
+                os.replace(temp_path, artifact_path)
+            except OSError as e:
+                logging.debug(f"Cache de regras não gravado em {cache_dir}: {e}")
+
+    compiled = CompiledRuleSet(artifact['regras'], pack_hash, artifact['pacotes'])
+    _compiled_rule_sets.clear()  # Mantém só a versão atual na memória
+    _compiled_rule_sets[pack_hash] = compiled
+    return compiled
+
+
+class RuleRegistry:
+    """
+    Conjunto de regras em uso no processo, recarregado quando os pacotes mudam.
+    A verificação (stat dos arquivos) ocorre no máximo a cada check_interval
+    segundos; a troca é uma atribuição única, então arquivos já em análise
+    terminam com as regras com que começaram. Um pacote inválido é registrado
+    no log e as regras anteriores continuam valendo.
+    """
+
+    def __init__(self, directory, check_interval=None):
+        self.directory = directory
+        self.check_interval = RULE_PACKS_CHECK_INTERVAL if check_interval is None else check_interval
+        self._lock = threading.Lock()
+        self._signature = self._current_signature()
+        try:
+            self._rules = load_rule_set(directory)
+        except RulePackError as e:
+            logging.error(f"Pacote de regras inválido ({e}). Usando apenas as regras embutidas.")
+            self._rules = CompiledRuleSet(build_rule_set([])[0], 'embutidas', [])
+        self._checked_at = time.monotonic()
+        if self._rules.packs:
+            logging.info(f"Pacotes de regras carregados: {', '.join(self._rules.packs)}")
+
+    def _current_signature(self):
+        signature = []
+        for pack_path in _rule_pack_files(self.directory):
+            try:
+                stat = os.stat(pack_path)
+            except OSError:
+                continue
+            signature.append((pack_path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def current(self):
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return self._rules
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return self._rules
+            self._checked_at = time.monotonic()
+            signature = self._current_signature()
+            if signature == self._signature:
+                return self._rules
+            self._signature = signature
+            try:
+                rules = load_rule_set(self.directory)
+            except (RulePackError, OSError) as e:
+                logging.error(f"Pacote de regras inválido ({e}). Mantendo as regras em uso.")
+                return self._rules
+            if rules.pack_hash != self._rules.pack_hash:
+                logging.info(f"Regras de classificação recarregadas: {', '.join(rules.packs) or 'apenas embutidas'}")
+                self._rules = rules
+            return self._rules
+
+
+_rule_registries = {}
+_rule_registries_lock = threading.Lock()
+_document_analyzer = None
+
+def get_rule_registry():
+    with _rule_registries_lock:
+        registry = _rule_registries.get(RULE_PACKS_DIR)
+        if registry is None:
+            registry = RuleRegistry(RULE_PACKS_DIR)
+            _rule_registries[RULE_PACKS_DIR] = registry
+        return registry
+
+def get_document_analyzer():
+    """Analisador compartilhado do processo, refeito apenas quando as regras mudam"""
+    global _document_analyzer
+    rule_set = get_rule_registry().current()
+    analyzer = _document_analyzer
+    if analyzer is None or analyzer.rule_set is not rule_set:
+        analyzer = IntelligentDocumentAnalyzer(rule_set)
+        _document_analyzer = analyzer
+    return analyzer
 
 # --- Sistema de IA Aprimorado ---
 
@@ -44,9 +870,10 @@ class IntelligentDocumentAnalyzer:
     Sistema de IA para análise inteligente de documentos
     """
 
-    def __init__(self):
+    def __init__(self, rule_set=None):
+        self.rule_set = rule_set or get_rule_registry().current()
         self.month_patterns = self._build_month_patterns()
-        self.classification_engine = self._build_classification_engine()
+        self.classification_engine = self.rule_set.types
         self.cnpj_validator = CNPJValidator()
 
     def _build_month_patterns(self):
@@ -108,119 +935,10 @@ class IntelligentDocumentAnalyzer:
             }
         ]
 
-        return {'month_map': month_map, 'patterns': patterns}
+        for pattern_info in patterns:
+            pattern_info['compiled'] = re.compile(pattern_info['regex'], re.IGNORECASE)
 
-    def _build_classification_engine(self):
-        """Constrói motor de classificação avançado"""
-        return {
-            "Nota Fiscal Eletrônica": {
-                'primary_indicators': [
-                    {'pattern': r'nota fiscal eletr[ôo]nica', 'weight': 25},
-                    {'pattern': r'nf-e', 'weight': 20},
-                    {'pattern': r'danfe', 'weight': 20},
-                    {'pattern': r'chave de acesso\s*:?\s*\d{44}', 'weight': 30}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'protocolo de autoriza[çc][ãa]o', 'weight': 10},
-                    {'pattern': r'valor total dos produtos', 'weight': 8},
-                    {'pattern': r'destinat[áa]rio', 'weight': 5},
-                    {'pattern': r'emitente', 'weight': 5},
-                    {'pattern': r'icms', 'weight': 6},
-                    {'pattern': r'ipi', 'weight': 4}
-                ],
-                'negative_indicators': [
-                    {'pattern': r'extrato', 'weight': -15},
-                    {'pattern': r'boleto', 'weight': -10}
-                ]
-            },
-            "Extrato Bancário": {
-                'primary_indicators': [
-                    {'pattern': r'extrato (?:de )?conta corrente', 'weight': 25},
-                    {'pattern': r'extrato banc[áa]rio', 'weight': 25},
-                    {'pattern': r'movimenta[çc][ãa]o banc[áa]ria', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'saldo anterior', 'weight': 12},
-                    {'pattern': r'saldo (?:final|atual|disponível)', 'weight': 12},
-                    {'pattern': r'lan[çc]amentos futuros', 'weight': 8},
-                    {'pattern': r'ag[êe]ncia\s*:?\s*\d+', 'weight': 10},
-                    {'pattern': r'conta\s*:?\s*[\d\-x]+', 'weight': 10},
-                    {'pattern': r'pix', 'weight': 5},
-                    {'pattern': r'ted|doc|transfer[êe]ncia', 'weight': 6}
-                ],
-                'context_patterns': [
-                    {'pattern': r'\b\d{2}/\d{2}\s+[A-Z\s]+\s+[\d\.,\-]+', 'weight': 8}  # Padrão de lançamento
-                ]
-            },
-            "Boleto de Pagamento": {
-                'primary_indicators': [
-                    {'pattern': r'\d{5}\.\d{5}\s+\d{5}\.\d{6}\s+\d{5}\.\d{6}\s+\d\s+\d{14}', 'weight': 40},  # Linha digitável
-                    {'pattern': r'linha digit[áa]vel', 'weight': 20},
-                    {'pattern': r'boleto de pagamento', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'nosso n[úu]mero', 'weight': 12},
-                    {'pattern': r'data de vencimento', 'weight': 10},
-                    {'pattern': r'cedente', 'weight': 8},
-                    {'pattern': r'sacado', 'weight': 8},
-                    {'pattern': r'valor do documento', 'weight': 8},
-                    {'pattern': r'c[óo]digo de barras', 'weight': 15}
-                ]
-            },
-            "DACTE": {
-                'primary_indicators': [
-                    {'pattern': r'dacte', 'weight': 30},
-                    {'pattern': r'documento auxiliar do conhecimento de transporte eletr[ôo]nico', 'weight': 25},
-                    {'pattern': r'ct-e', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'remetente', 'weight': 8},
-                    {'pattern': r'expedidor', 'weight': 8},
-                    {'pattern': r'destinat[áa]rio', 'weight': 6},
-                    {'pattern': r'tomador do servi[çc]o', 'weight': 10}
-                ]
-            },
-            "SPED Fiscal": {
-                'primary_indicators': [
-                    {'pattern': r'sped', 'weight': 25},
-                    {'pattern': r'efd', 'weight': 20},
-                    {'pattern': r'escritura[çc][ãa]o fiscal digital', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'bloco [a-z]', 'weight': 10},
-                    {'pattern': r'registro \d{4}', 'weight': 8},
-                    {'pattern': r'arquivo magn[ée]tico', 'weight': 6}
-                ]
-            },
-            "Relatório de Faturamento": {
-                'primary_indicators': [
-                    {'pattern': r'relat[óo]rio de faturamento', 'weight': 25},
-                    {'pattern': r'faturamento (?:mensal|do m[êe]s)', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'total faturado', 'weight': 12},
-                    {'pattern': r'receita l[íi]quida', 'weight': 10},
-                    {'pattern': r'resumo de vendas', 'weight': 8}
-                ],
-                'negative_indicators': [
-                    {'pattern': r'fatura de', 'weight': -10}
-                ]
-            },
-            "Fatura de Serviços": {
-                'primary_indicators': [
-                    {'pattern': r'fatura de servi[çc]os', 'weight': 25},
-                    {'pattern': r'fatura (?:do )?cart[ãa]o', 'weight': 20}
-                ],
-                'secondary_indicators': [
-                    {'pattern': r'valor da fatura', 'weight': 10},
-                    {'pattern': r'data de vencimento', 'weight': 8},
-                    {'pattern': r'discrimina[çc][ãa]o dos servi[çc]os', 'weight': 12}
-                ],
-                'negative_indicators': [
-                    {'pattern': r'faturamento', 'weight': -15}
-                ]
-            }
-        }
+        return {'month_map': month_map, 'patterns': patterns}
 
     def extract_competence_with_ai(self, text, filename=""):
         """Extração inteligente de competência com múltiplas estratégias"""
@@ -229,7 +947,7 @@ class IntelligentDocumentAnalyzer:
 
         # Estratégia 1: Padrões estruturados
         for pattern_info in self.month_patterns['patterns']:
-            matches = re.finditer(pattern_info['regex'], text_lower, re.IGNORECASE)
+            matches = pattern_info['compiled'].finditer(text_lower)
             for match in matches:
                 competence = self._process_match(match, pattern_info)
                 if competence:
@@ -262,13 +980,7 @@ class IntelligentDocumentAnalyzer:
         elif pattern_info['type'] in ['vencimento', 'data_emissao'] and pattern_info.get('extract_competencia'):
             # Para vencimentos, assume competência como mês anterior
             try:
-                day, month, year = int(groups[0]), int(groups[1]), int(groups[2])
-                if day <= 15:  # Vencimento até dia 15, competência é mês anterior
-                    comp_month = month - 1 if month > 1 else 12
-                    comp_year = year if month > 1 else year - 1
-                else:  # Vencimento após dia 15, competência é mesmo mês
-                    comp_month, comp_year = month, year
-                return f"{comp_month:02d}/{comp_year}"
+                return competence_from_due_date(int(groups[0]), int(groups[1]), int(groups[2]))
             except:
                 return None
 
@@ -443,24 +1155,20 @@ class IntelligentDocumentAnalyzer:
         for doc_type, rules in self.classification_engine.items():
 
             # Indicadores primários (peso alto)
-            for indicator in rules.get('primary_indicators', []):
-                matches = len(re.findall(indicator['pattern'], text_lower, re.IGNORECASE))
-                scores[doc_type] += matches * indicator['weight']
+            for regex, weight in rules['primary_indicators']:
+                scores[doc_type] += len(regex.findall(text_lower)) * weight
 
             # Indicadores secundários (peso médio)
-            for indicator in rules.get('secondary_indicators', []):
-                matches = len(re.findall(indicator['pattern'], text_lower, re.IGNORECASE))
-                scores[doc_type] += matches * indicator['weight']
+            for regex, weight in rules['secondary_indicators']:
+                scores[doc_type] += len(regex.findall(text_lower)) * weight
 
             # Padrões contextuais (peso médio)
-            for indicator in rules.get('context_patterns', []):
-                matches = len(re.findall(indicator['pattern'], text_lower, re.IGNORECASE))
-                scores[doc_type] += matches * indicator['weight']
+            for regex, weight in rules['context_patterns']:
+                scores[doc_type] += len(regex.findall(text_lower)) * weight
 
             # Indicadores negativos (reduz score)
-            for indicator in rules.get('negative_indicators', []):
-                matches = len(re.findall(indicator['pattern'], text_lower, re.IGNORECASE))
-                scores[doc_type] += matches * indicator['weight']  # weight já é negativo
+            for regex, weight in rules['negative_indicators']:
+                scores[doc_type] += len(regex.findall(text_lower)) * weight  # weight já é negativo
 
         # Aplica boost baseado no nome do arquivo
         filename_boost = self._get_filename_boost(filename)
@@ -495,20 +1203,9 @@ class IntelligentDocumentAnalyzer:
         filename_lower = filename.lower()
         boosts = {}
 
-        filename_patterns = {
-            "Nota Fiscal Eletrônica": [r'nfe?', r'danfe', r'notafiscal'],
-            "Extrato Bancário": [r'extrato', r'moviment', r'bancario'],
-            "Boleto de Pagamento": [r'boleto', r'cobranca'],
-            "DACTE": [r'dacte', r'cte'],
-            "SPED Fiscal": [r'sped', r'efd'],
-            "Relatório de Faturamento": [r'faturamento', r'relatorio'],
-            "Fatura de Serviços": [r'fatura']
-        }
-
-        for doc_type, patterns in filename_patterns.items():
-            for pattern in patterns:
-                if re.search(pattern, filename_lower):
-                    boosts[doc_type] = boosts.get(doc_type, 0) + 5
+        for doc_type, regex, boost in self.rule_set.filename_patterns:
+            if regex.search(filename_lower):
+                boosts[doc_type] = boosts.get(doc_type, 0) + boost
 
         return boosts
 
@@ -591,11 +1288,411 @@ class CNPJValidator:
         return cnpj
 
 
+# --- Backends de OCR ---
+
+def _parse_tesseract_config(config):
+    """Converte a string de configuração do pytesseract em (psm, variáveis)"""
+    psm = 3  # Padrão do Tesseract
+    variables = {}
+    tokens = shlex.split(config or '')
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == '--psm' and i + 1 < len(tokens):
+            psm = int(tokens[i + 1])
+            i += 2
+            continue
+        if token == '-c' and i + 1 < len(tokens) and '=' in tokens[i + 1]:
+            name, value = tokens[i + 1].split('=', 1)
+            variables[name] = value
+            i += 2
+            continue
+        i += 1
+    return psm, variables
+
+
+class PytesseractBackend:
+    """Backend padrão: um processo tesseract por chamada"""
+
+    name = 'pytesseract'
+
+    def image_to_string(self, image, lang, config=''):
+        return pytesseract.image_to_string(image, lang=lang, config=config)
+
+    def detect_orientation(self, image):
+        """(graus para girar no sentido horário, confiança, escrita)"""
+        osd = pytesseract.image_to_osd(image, config='--psm 0', output_type=pytesseract.Output.DICT)
+        return int(osd.get('rotate', 0)), float(osd.get('orientation_conf', 0.0)), osd.get('script')
+
+    def image_to_words(self, image, lang, config=''):
+        data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+        words = []
+        for i, text in enumerate(data['text']):
+            if text and text.strip():
+                left, top = data['left'][i], data['top'][i]
+                words.append((left, top, left + data['width'][i], top + data['height'][i], text.strip()))
+        return words
+
+    def image_to_text_and_words(self, image, lang, config=''):
+        """Texto e palavras posicionadas de uma única execução do tesseract (image_to_data)"""
+        data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+        words = []
+        lines = []
+        line_key = paragraph_key = None
+        for i, text in enumerate(data['text']):
+            if not text or not text.strip():
+                continue
+            left, top = data['left'][i], data['top'][i]
+            words.append((left, top, left + data['width'][i], top + data['height'][i], text.strip()))
+            key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            if key != line_key:
+                if line_key is not None and key[:2] != paragraph_key:
+                    lines.append("")  # Linha em branco entre parágrafos, como no image_to_string
+                line_key, paragraph_key = key, key[:2]
+                lines.append(text.strip())
+            else:
+                lines[-1] = f"{lines[-1]} {text.strip()}"
+        text = "\n".join(lines) + "\n" if lines else ""
+        return text, words
+
+
+class TesserocrBackend:
+    """
+    Backend persistente via tesserocr (libtesseract em processo).
+    Mantém uma instância da API por (idioma, psm, variáveis) e por thread,
+    de modo que os modelos traineddata são carregados uma única vez por
+    worker e as imagens são passadas em memória, sem arquivos temporários.
+    """
+
+    name = 'tesserocr'
+
+    def __init__(self, tessdata_path=TESSDATA_PATH):
+        self.tessdata_path = tessdata_path
+        self._local = threading.local()
+
+    def _get_api(self, lang, psm, variables):
+        apis = getattr(self._local, 'apis', None)
+        if apis is None:
+            apis = self._local.apis = {}
+        key = (lang, psm, tuple(sorted(variables.items())))
+        api = apis.get(key)
+        if api is None:
+            kwargs = {'lang': lang, 'psm': psm}
+            if self.tessdata_path:
+                kwargs['path'] = self.tessdata_path
+            api = tesserocr.PyTessBaseAPI(**kwargs)
+            for name, value in variables.items():
+                api.SetVariable(name, value)
+            apis[key] = api
+        return api
+
+    def image_to_string(self, image, lang, config=''):
+        psm, variables = _parse_tesseract_config(config)
+        api = self._get_api(lang, psm, variables)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+    def detect_orientation(self, image):
+        api = self._get_api('osd', 0, {})  # PSM.OSD_ONLY
+        api.SetImage(image)
+        result = api.DetectOrientationScript()
+        if not result:
+            return 0, 0.0, None
+        # orient_deg é a orientação detectada; o giro de correção é o complemento
+        return (360 - result['orient_deg']) % 360, float(result['orient_conf']), result.get('script_name')
+
+    def image_to_words(self, image, lang, config=''):
+        psm, variables = _parse_tesseract_config(config)
+        api = self._get_api(lang, psm, variables)
+        api.SetImage(image)
+        api.Recognize()
+        words = []
+        level = tesserocr.RIL.WORD
+        for item in tesserocr.iterate_level(api.GetIterator(), level):
+            text = item.GetUTF8Text(level)
+            box = item.BoundingBox(level)
+            if text and text.strip() and box:
+                words.append((box[0], box[1], box[2], box[3], text.strip()))
+        return words
+
+    def image_to_text_and_words(self, image, lang, config=''):
+        """Texto e palavras posicionadas do mesmo reconhecimento"""
+        words = self.image_to_words(image, lang, config)
+        return self._get_api(lang, *_parse_tesseract_config(config)).GetUTF8Text(), words
+
+
+_ocr_backend = None
+
+def get_ocr_backend():
+    """Backend de OCR do processo atual (criado sob demanda)"""
+    global _ocr_backend
+    if _ocr_backend is None:
+        if OCR_BACKEND in ('auto', 'tesserocr') and tesserocr is not None:
+            _ocr_backend = TesserocrBackend()
+        else:
+            if OCR_BACKEND == 'tesserocr':
+                logging.warning("tesserocr não instalado. Usando pytesseract como backend de OCR.")
+            _ocr_backend = PytesseractBackend()
+    return _ocr_backend
+
+def _call_ocr_backend(method_name, image, *args):
+    global _ocr_backend
+    backend = get_ocr_backend()
+    try:
+        return getattr(backend, method_name)(image, *args)
+    except RuntimeError as e:
+        if backend.name == 'pytesseract':
+            raise
+        # Falha ao inicializar o libtesseract (ex.: tessdata ausente)
+        logging.warning(f"Backend {backend.name} falhou ({e}). Usando pytesseract a partir de agora.")
+        _ocr_backend = PytesseractBackend()
+        return getattr(_ocr_backend, method_name)(image, *args)
+
+def ocr_image_to_string(image, lang='por+eng', config=''):
+    """OCR de uma imagem PIL pelo backend ativo, com fallback para o pytesseract"""
+    return _call_ocr_backend('image_to_string', image, lang, config)
+
+def ocr_image_to_words(image, lang='por+eng', config=''):
+    """OCR com posição: lista de (x0, y0, x1, y1, palavra) em pixels da imagem"""
+    return _call_ocr_backend('image_to_words', image, lang, config)
+
+def ocr_image_to_text_and_words(image, lang='por+eng', config=''):
+    """OCR com texto e posição numa única passada: (texto, palavras)"""
+    return _call_ocr_backend('image_to_text_and_words', image, lang, config)
+
+
+# --- Cache de OCR e Orientação ---
+
+class OCRCache:
+    """
+    Cache persistente (SQLite em modo WAL) do texto reconhecido por imagem,
+    idioma e configuração, e da orientação detectada por página. A chave da
+    imagem é o hash dos pixels, então reprocessar um arquivo, uma cópia ou
+    uma execução retomada não repete o OCR.
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Compartilhada entre os threads de OCR do processo (acesso sob self._lock)
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS ocr_text ('
+            ' image_hash TEXT NOT NULL, lang TEXT NOT NULL, config TEXT NOT NULL, text TEXT NOT NULL,'
+            ' PRIMARY KEY (image_hash, lang, config));'
+            'CREATE TABLE IF NOT EXISTS orientation ('
+            ' image_hash TEXT PRIMARY KEY, rotate INTEGER NOT NULL, confidence REAL, script TEXT);'
+        )
+
+    def get_text(self, image_hash, lang, config):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT text FROM ocr_text WHERE image_hash = ? AND lang = ? AND config = ?',
+                (image_hash, lang, config)).fetchone()
+        return row[0] if row else None
+
+    def put_text(self, image_hash, lang, config, text):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO ocr_text VALUES (?, ?, ?, ?)',
+                               (image_hash, lang, config, text))
+
+    def get_orientation(self, image_hash):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT rotate, confidence, script FROM orientation WHERE image_hash = ?',
+                (image_hash,)).fetchone()
+        return tuple(row) if row else None
+
+    def put_orientation(self, image_hash, rotate, confidence, script):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO orientation VALUES (?, ?, ?, ?)',
+                               (image_hash, rotate, confidence, script))
+
+
+_ocr_caches = {}
+_ocr_caches_lock = threading.Lock()
+
+def get_ocr_cache():
+    """Cache de OCR do processo atual (None quando desativado ou indisponível)"""
+    if not OCR_CACHE_ENABLED:
+        return None
+    with _ocr_caches_lock:
+        cache = _ocr_caches.get(OCR_CACHE_DB_PATH)
+        if cache is None:
+            try:
+                cache = OCRCache(OCR_CACHE_DB_PATH)
+            except sqlite3.Error as e:
+                logging.warning(f"Cache de OCR indisponível ({e}). OCR sem cache.")
+                return None
+            _ocr_caches[OCR_CACHE_DB_PATH] = cache
+        return cache
+
+def image_fingerprint(image):
+    """Hash dos pixels da imagem (independe do arquivo de origem)"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}|{image.size[0]}x{image.size[1]}|".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def _decode_cached_ocr(method_name, cached):
+    if method_name == 'image_to_string':
+        return cached
+    value = json.loads(cached)
+    if method_name == 'image_to_text_and_words':
+        return value[0], [tuple(w) for w in value[1]]
+    return [tuple(w) for w in value]
+
+def cached_ocr(method_name, image, lang, config):
+    """OCR pelo backend ativo, consultando antes o cache (texto, ou palavras/texto e palavras em JSON)"""
+    cache = get_ocr_cache()
+    if cache is None:
+        return _call_ocr_backend(method_name, image, lang, config)
+    image_hash = image_fingerprint(image)
+    cache_config = config if method_name == 'image_to_string' else f"{method_name}|{config}"
+    cached = cache.get_text(image_hash, lang, cache_config)
+    if cached is not None:
+        return _decode_cached_ocr(method_name, cached)
+    result = _call_ocr_backend(method_name, image, lang, config)
+    cache.put_text(image_hash, lang, cache_config,
+                   result if method_name == 'image_to_string' else json.dumps(result, ensure_ascii=False))
+    return result
+
+_osd_unavailable = False
+
+def detect_image_rotation(image):
+    """
+    Giro (0/90/180/270, sentido horário) que deixa a página na posição de
+    leitura, pelo OSD do Tesseract numa cópia reduzida. Resultado em cache.
+    """
+    global _osd_unavailable
+    if _osd_unavailable:
+        return 0
+    cache = get_ocr_cache()
+    image_hash = image_fingerprint(image) if cache else None
+    if cache:
+        cached = cache.get_orientation(image_hash)
+        if cached is not None:
+            return cached[0]
+
+    small = image.convert('L')
+    small.thumbnail((OSD_MAX_SIDE, OSD_MAX_SIDE))
+    try:
+        rotate, confidence, script = _call_ocr_backend('detect_orientation', small)
+    except Exception as e:
+        message = str(e).lower()
+        if 'osd' in message or 'traineddata' in message or 'tesseract is not installed' in message:
+            # Sem osd.traineddata (ou sem Tesseract): desativa o OSD neste processo
+            logging.warning(f"Detecção de orientação indisponível ({e}).")
+            _osd_unavailable = True
+            return 0
+        # Pouco texto para o OSD decidir: mantém a imagem como está
+        rotate, confidence, script = 0, 0.0, None
+    if confidence < OSD_MIN_CONFIDENCE:
+        rotate = 0
+    if cache:
+        cache.put_orientation(image_hash, rotate, confidence, script)
+    return rotate
+
+PORTUGUESE_STOPWORDS = frozenset('de da do das dos que para com não uma por mais valor data total nota conta'.split())
+ENGLISH_STOPWORDS = frozenset('the and of to for with from this that is are invoice amount date total account'.split())
+
+def choose_ocr_language(text):
+    """'por' ou 'por+eng' pelo vocabulário do texto; None se houver pouco texto para decidir"""
+    words = re.findall(r'[a-zà-ú]+', (text or '').lower())
+    if len(words) < 20:
+        return None
+    portuguese = sum(1 for word in words if word in PORTUGUESE_STOPWORDS)
+    english = sum(1 for word in words if word in ENGLISH_STOPWORDS)
+    return 'por+eng' if english >= 5 and english > portuguese else 'por'
+
+
+class DocumentOCR:
+    """
+    Contexto de OCR de um documento: um único idioma para todas as páginas
+    (com OCR_LANGUAGE = 'auto', decidido pelo texto da primeira página lida em
+    'por'; com pouco texto nela, fica 'por', sem nova detecção), correção de orientação por página e cache. Seguro para uso pelos
+    threads de OCR de páginas.
+    """
+
+    def __init__(self, lang=None, detect_orientation=None):
+        self.lang = lang or (None if OCR_LANGUAGE == 'auto' else OCR_LANGUAGE)
+        self.detect_orientation = (OCR_ORIENTATION_DETECTION if detect_orientation is None
+                                   else detect_orientation)
+        self._lock = threading.Lock()
+
+    def upright(self, image):
+        """Imagem girada para a posição de leitura (quando o OSD indica rotação)"""
+        if not self.detect_orientation:
+            return image
+        rotate = detect_image_rotation(image)
+        if rotate:
+            logging.info(f"  -> Página girada {rotate}° antes do OCR.")
+            return image.rotate(-rotate, expand=True)
+        return image
+
+    def _recognize(self, method_name, image, config):
+        if self.lang is None:
+            with self._lock:
+                if self.lang is None:
+                    result = cached_ocr(method_name, image, 'por', config)
+                    # Página indecisa (pouco texto): 'por' para o documento todo, para que as
+                    # demais páginas não repitam a detecção nem esperem neste lock
+                    self.lang = choose_ocr_language(result if isinstance(result, str) else result[0]) or 'por'
+                    if self.lang == 'por':
+                        return result
+                    logging.info("  -> Documento com texto em inglês; OCR em 'por+eng'.")
+        return cached_ocr(method_name, image, self.lang, config)
+
+    def image_to_string(self, image, config='--psm 6'):
+        return self._recognize('image_to_string', image, config)
+
+    def image_to_text_and_words(self, image, config='--psm 6'):
+        """(texto, palavras posicionadas) da mesma passada de OCR"""
+        return self._recognize('image_to_text_and_words', image, config)
+
+    def image_to_words(self, image, config='--psm 6'):
+        return cached_ocr('image_to_words', image, self.lang or 'por', config)
+
+
+
 # --- Funções de Extração de Texto Aprimoradas ---
 
+# As funções de extração aceitam um caminho ou um fluxo em memória
+# (io.BytesIO com atributo 'name'), usado pela API de biblioteca.
+
+def _source_name(source):
+    """Nome do arquivo para logs, seja caminho ou fluxo em memória"""
+    return os.path.basename(getattr(source, 'name', None) or str(source))
+
+def _rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+def _read_source_bytes(source):
+    if hasattr(source, 'read'):
+        return _rewind(source).read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+def _open_pdf(source):
+    """Abre um PDF no PyMuPDF a partir de caminho ou fluxo em memória"""
+    if hasattr(source, 'read'):
+        return fitz.open(stream=_rewind(source).read(), filetype='pdf')
+    return fitz.open(source)
+
 def preprocess_image_for_ocr(pil_image):
     """Pré-processamento avançado de imagem para OCR"""
     try:
+        if pil_image.mode == '1':
+            # Digitalização bitonal (CCITT/JBIG2): já binarizada, vai direto ao Tesseract
+            return pil_image
+
         # Converte para escala de cinza
         img = pil_image.convert('L')
 
@@ -615,90 +1712,314 @@ def preprocess_image_for_ocr(pil_image):
         logging.error(f"Erro no pré-processamento da imagem: {e}")
         return None
 
-def extract_text_from_image_file(image_path):
-    """Extração de texto aprimorada com múltiplas tentativas"""
-    try:
-        img = Image.open(image_path)
-
-        # Primeira tentativa: processamento padrão
-        processed_img = preprocess_image_for_ocr(img)
-        if processed_img:
-            text = pytesseract.image_to_string(processed_img, lang='por+eng', config='--psm 6')
-            if text.strip():
-                return text
+def iter_image_frames(img, max_frames=IMAGE_MAX_FRAMES):
+    """
+    Quadros de uma imagem (páginas de TIFF de fax, quadros de GIF), na ordem.
+    Cada quadro é copiado no thread chamador, já que o seek altera a imagem
+    aberta; imagens de um quadro só produzem a própria imagem.
+    """
+    if getattr(img, 'n_frames', 1) <= 1:
+        yield 0, img
+        return
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index >= max_frames:
+            logging.warning(f"  -> Imagem com mais de {max_frames} quadros; os demais foram ignorados.")
+            break
+        yield index, frame.convert('RGB') if frame.mode in ('P', 'PA') else frame.copy()
 
-        # Segunda tentativa: configuração alternativa
-        text = pytesseract.image_to_string(img, lang='por+eng', config='--psm 1 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,/-: ')
+def _ocr_image_frame(img, document_ocr, with_words=False):
+    """
+    OCR de uma imagem (ou quadro) com múltiplas tentativas.
+    Com with_words, retorna (texto, palavras): as palavras vêm da primeira
+    tentativa, na mesma configuração da exportação de extratos, em pontos
+    quando a resolução da imagem é conhecida, ou são None.
+    """
+    page_size = page_size_points(img)
+    img = document_ocr.upright(img)
+
+    # Primeira tentativa: processamento padrão
+    processed_img = preprocess_image_for_ocr(img)
+    if processed_img:
+        if with_words:
+            text, words = document_ocr.image_to_text_and_words(processed_img, config='--psm 6')
+            words = words_to_page_points(words, processed_img.size, page_size)
+        else:
+            text, words = document_ocr.image_to_string(processed_img, config='--psm 6'), None
         if text.strip():
-            return text
+            return (text, words) if with_words else text
+
+    text = _ocr_image_fallbacks(img, document_ocr)
+    return (text, None) if with_words else text
 
-        # Terceira tentativa: OCR agressivo
-        text = pytesseract.image_to_string(img, lang='por', config='--psm 13')
+def _ocr_image_fallbacks(img, document_ocr):
+    # Segunda tentativa: configuração alternativa
+    text = document_ocr.image_to_string(img, config='--psm 1 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,/-: ')
+    if text.strip():
         return text
 
+    # Terceira tentativa: OCR agressivo
+    return document_ocr.image_to_string(img, config='--psm 13')
+
+def ocr_images_in_order(images, document_ocr=None, page_words=None):
+    """
+    OCR em paralelo de (índice, imagem), com os textos unidos na ordem de entrada.
+    Com page_words (dicionário), guarda as palavras posicionadas de cada índice.
+    """
+    with_words = page_words is not None
+    ocr_function = partial(_ocr_image_frame, document_ocr=document_ocr or DocumentOCR(), with_words=with_words)
+    texts = []
+    for index, text in iter_page_ocr(images, ocr_function):
+        if with_words:
+            text, words = text
+            if words is not None:
+                page_words[index] = words
+        if text and text.strip():
+            texts.append(text)
+    return "\n".join(texts)
+
+def extract_text_from_image_file(image_path, page_words=None):
+    """
+    Extração de texto aprimorada com múltiplas tentativas (todos os quadros de TIFF/GIF).
+    Com page_words, guarda também as palavras posicionadas de cada quadro.
+    """
+    try:
+        with Image.open(_rewind(image_path)) as img:
+            frame_count = getattr(img, 'n_frames', 1)
+            if frame_count > 1:
+                logging.info(f"  -> {_source_name(image_path)}: {frame_count} páginas/quadros para OCR.")
+            return ocr_images_in_order(iter_image_frames(img), page_words=page_words)
     except pytesseract.TesseractNotFoundError:
         logging.critical("Tesseract não encontrado. Verifique o caminho em 'pytesseract.pytesseract.tesseract_cmd'.")
         return ""
     except Exception as e:
-        logging.error(f"Erro ao extrair texto da imagem {os.path.basename(image_path)}: {e}")
+        logging.error(f"Erro ao extrair texto da imagem {_source_name(image_path)}: {e}")
         return ""
 
-def extract_text_from_pdf(pdf_path):
-    """Extração de texto PDF com IA aprimorada"""
-    text = ""
+def _ocr_pdf_page_image(img, document_ocr):
+    processed_img = preprocess_image_for_ocr(document_ocr.upright(img))
+    if processed_img:
+        return document_ocr.image_to_string(processed_img, config='--psm 6')
+    return ""
+
+def _ocr_pdf_page_image_with_words(img, document_ocr):
+    processed_img = preprocess_image_for_ocr(document_ocr.upright(img))
+    if processed_img:
+        text, words = document_ocr.image_to_text_and_words(processed_img, config='--psm 6')
+        return text, words_to_page_points(words, processed_img.size, page_size_points(img))
+    return "", None
+
+def _ocr_pdf_header_image(img, document_ocr):
+    # Recorte do topo: sem OSD (a orientação só é confiável na página inteira)
+    processed_img = preprocess_image_for_ocr(img)
+    return document_ocr.image_to_string(processed_img or img, config='--psm 6')
+
+def iter_page_ocr(page_images, ocr_function, max_workers=PDF_PAGE_WORKERS):
+    """
+    OCR de páginas em paralelo, produzindo (índice, resultado) na ordem de
+    entrada. page_images produz (índice, imagem) e é consumido no thread
+    chamador (o PyMuPDF não é thread-safe); apenas o OCR roda nos threads,
+    com no máximo 2 * max_workers imagens em memória.
+    """
+    if max_workers <= 1:
+        for index, img in page_images:
+            yield index, ocr_function(img)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for index, img in page_images:
+            pending.append((index, executor.submit(ocr_function, img)))
+            if len(pending) >= max_workers * 2:
+                done_index, future = pending.popleft()
+                yield done_index, future.result()
+        while pending:
+            done_index, future = pending.popleft()
+            yield done_index, future.result()
+
+def _run_page_ocr(page_images, ocr_function, max_workers=PDF_PAGE_WORKERS):
+    """OCR de páginas em paralelo; retorna {índice: texto}"""
+    return dict(iter_page_ocr(page_images, ocr_function, max_workers))
+
+def extract_native_page_image(doc, page):
+    """
+    Imagem embutida de uma página escaneada, na resolução nativa e sem
+    renderizar a página. Só vale para páginas com uma única imagem cobrindo
+    quase toda a página, sem máscara e sem giro/espelhamento no posicionamento.
+    Digitalizações de 1 bit (CCITT, JBIG2) continuam em 1 bit. Retorna None
+    quando a página precisa ser renderizada.
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1:
+        return None
+    xref, smask, width, height, bpc = images[0][:5]
+    if smask:
+        return None
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    if abs(matrix.b) > 1e-3 or abs(matrix.c) > 1e-3 or matrix.a <= 0 or matrix.d <= 0:
+        return None
+
+    # Coordenadas sem o /Rotate da página, como as do posicionamento da imagem
+    page_area = fitz.Rect(0, 0, page.cropbox.width, page.cropbox.height)
+    if abs(rect & page_area) < abs(page_area) * PDF_NATIVE_IMAGE_MIN_COVERAGE:
+        return None
+    if min(width / (rect.width / 72), height / (rect.height / 72)) < PDF_NATIVE_IMAGE_MIN_DPI:
+        return None
+
+    info = doc.extract_image(xref)
+    if not info or info.get('colorspace') not in (1, 3):
+        return None  # CMYK, máscaras de estêncil etc.: deixa o PyMuPDF renderizar
+    # JPEG sai como o fluxo original (decodificado só no OCR); os demais, já decodificados
+    img = Image.open(io.BytesIO(info['image']))
+    if bpc == 1 and img.mode != '1':
+        img = img.convert('1', dither=Image.NONE)
+    if page.rotation:
+        img = img.rotate(-page.rotation, expand=True)
+    return img
+
+def render_page_for_ocr(doc, page, zoom=2):
+    """
+    Imagem da página para OCR: a imagem embutida nativa, ou a página renderizada.
+    O tamanho da página em pontos fica em img.info['tamanho_pagina'], para
+    converter as caixas do OCR (ver page_size_points).
+    """
+    img = None
+    if PDF_NATIVE_IMAGES:
+        try:
+            img = extract_native_page_image(doc, page)
+        except Exception as e:
+            logging.debug(f"  -> Imagem nativa indisponível na página {page.number + 1}: {e}")
+    if img is None:
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    img.info['tamanho_pagina'] = (page.rect.width, page.rect.height)
+    return img
+
+def page_size_points(img):
+    """
+    Tamanho da página em pontos (1/72 pol.): o da página do PDF renderizada,
+    ou o da imagem pela resolução (dpi) gravada no arquivo. None se desconhecido.
+    """
+    if 'tamanho_pagina' in img.info:
+        return img.info['tamanho_pagina']
+    dpi = img.info.get('dpi')
+    if dpi and dpi[0] and dpi[1]:
+        return img.width * 72.0 / dpi[0], img.height * 72.0 / dpi[1]
+    return None
+
+def words_to_page_points(words, image_size, page_size):
+    """
+    Caixas do OCR (pixels da imagem reconhecida) -> pontos da página, a mesma
+    unidade da camada de texto do PDF. Imagem nativa, página renderizada a 2x
+    e foto em outra resolução passam a ter as mesmas coordenadas. Uma imagem
+    girada pelo OSD tem largura e altura trocadas em relação à página.
+    """
+    if not page_size or not words:
+        return words
+    width, height = image_size
+    page_width, page_height = page_size
+    if (width > height) != (page_width > page_height):
+        page_width, page_height = page_height, page_width
+    scale_x, scale_y = page_width / width, page_height / height
+    return [(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y, text) for x0, y0, x1, y1, text in words]
+
+def extract_pdf_pages_text(pdf_path, page_words=None):
+    """
+    Texto de cada página do PDF (lista na ordem das páginas; vazia em caso de falha).
+    Com page_words (dicionário), as páginas com OCR guardam também as palavras
+    posicionadas da mesma passada, por índice de página (base 0).
+    """
     try:
         # Primeira tentativa: extração direta
-        reader = PdfReader(pdf_path)
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+        reader = PdfReader(_rewind(pdf_path))
+        pages = [page.extract_text() or "" for page in reader.pages]
+        text = "".join(page_text + "\n" for page_text in pages if page_text)
 
         if text.strip() and len(text.strip()) > 50:  # Texto substancial
-            logging.info(f"  -> Texto extraído diretamente do PDF {os.path.basename(pdf_path)}.")
-            return text
+            logging.info(f"  -> Texto extraído diretamente do PDF {_source_name(pdf_path)}.")
+            return pages
     except Exception:
-        logging.warning(f"  -> Falha na extração direta de texto do PDF {os.path.basename(pdf_path)}.")
+        logging.warning(f"  -> Falha na extração direta de texto do PDF {_source_name(pdf_path)}.")
 
     try:
         # Segunda tentativa: OCR com PyMuPDF
-        doc = fitz.open(pdf_path)
-        ocr_text = ""
-
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-
-            # Tenta extrair texto diretamente da página primeiro
-            direct_text = page.get_text()
-            if direct_text.strip() and len(direct_text.strip()) > 20:
-                ocr_text += direct_text + "\n"
-                continue
+        pages = []
+
+        def pages_to_ocr(doc):
+            for page_num in range(len(doc)):
+                page = doc.load_page(page_num)
+
+                # Tenta extrair texto diretamente da página primeiro
+                direct_text = page.get_text()
+                if direct_text.strip() and len(direct_text.strip()) > 20:
+                    pages.append(direct_text)
+                    continue
+
+                # Se não há texto, usa OCR (imagem nativa ou página renderizada em 2x)
+                pages.append("")
+                yield page_num, render_page_for_ocr(doc, page)
+
+        ocr_function = _ocr_pdf_page_image if page_words is None else _ocr_pdf_page_image_with_words
+        with _open_pdf(pdf_path) as doc:
+            ocr_results = _run_page_ocr(pages_to_ocr(doc), partial(ocr_function, document_ocr=DocumentOCR()))
+        for page_num, page_text in ocr_results.items():
+            if page_words is not None:
+                page_text, words = page_text
+                if words is not None:
+                    page_words[page_num] = words
+            pages[page_num] = page_text
+
+        if any(page_text.strip() for page_text in pages):
+            logging.info(f"  -> Texto extraído via OCR do PDF {_source_name(pdf_path)}.")
+            return pages
+        return []
+    except Exception as e:
+        logging.error(f"  -> Erro fatal ao extrair texto do PDF {_source_name(pdf_path)} via OCR: {e}")
+        return []
 
-            # Se não há texto, usa OCR
-            # Aumenta resolução para melhor OCR
-            mat = fitz.Matrix(2, 2)  # Escala 2x
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+def extract_text_from_pdf(pdf_path, page_words=None):
+    """Extração de texto PDF com IA aprimorada"""
+    return "".join(page_text + "\n" for page_text in extract_pdf_pages_text(pdf_path, page_words) if page_text)
 
-            processed_img = preprocess_image_for_ocr(img)
-            if processed_img:
-                page_ocr = pytesseract.image_to_string(processed_img, lang='por+eng', config='--psm 6')
-                ocr_text += page_ocr + "\n"
+def _render_header_clip(page, zoom, fraction):
+    rect = page.rect
+    clip = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * fraction)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
-        doc.close()
+def extract_header_text_from_pdf(pdf_path, zoom=PDF_HEADER_ZOOM, fraction=PDF_HEADER_FRACTION):
+    """OCR rápido, em baixa resolução, apenas do topo da primeira página"""
+    try:
+        with _open_pdf(pdf_path) as doc:
+            if doc.page_count == 0:
+                return ""
+            img = _render_header_clip(doc.load_page(0), zoom, fraction)
 
-        if ocr_text.strip():
-            logging.info(f"  -> Texto extraído via OCR do PDF {os.path.basename(pdf_path)}.")
-            return ocr_text
-        return ""
+        return _ocr_pdf_header_image(img, DocumentOCR(detect_orientation=False))
     except Exception as e:
-        logging.error(f"  -> Erro fatal ao extrair texto do PDF {os.path.basename(pdf_path)} via OCR: {e}")
+        logging.warning(f"  -> Falha no OCR do cabeçalho do PDF {_source_name(pdf_path)}: {e}")
         return ""
 
+def extract_header_texts_from_pdf(pdf_path, pages=None, zoom=PDF_HEADER_ZOOM, fraction=PDF_HEADER_FRACTION):
+    """OCR rápido do topo das páginas (todas ou as de pages, base 0), em paralelo"""
+    try:
+        with _open_pdf(pdf_path) as doc:
+            page_numbers = list(pages if pages is not None else range(doc.page_count))
+            headers = _run_page_ocr(
+                ((page_num, _render_header_clip(doc.load_page(page_num), zoom, fraction))
+                 for page_num in page_numbers),
+                partial(_ocr_pdf_header_image, document_ocr=DocumentOCR(detect_orientation=False)))
+        return [headers.get(page_num, "") for page_num in page_numbers]
+    except Exception as e:
+        logging.warning(f"  -> Falha no OCR dos cabeçalhos do PDF {_source_name(pdf_path)}: {e}")
+        return []
+
 def extract_text_from_docx(docx_path):
     """Extração aprimorada de DOCX incluindo tabelas"""
     try:
-        doc = Document(docx_path)
+        doc = Document(_rewind(docx_path))
         text_parts = []
 
         # Extrai texto dos parágrafos
@@ -716,11 +2037,41 @@ def extract_text_from_docx(docx_path):
                 if row_text:
                     text_parts.append(" | ".join(row_text))
 
+        # Imagens coladas no documento (recibos e comprovantes digitalizados)
+        images_text = ocr_images_in_order(_iter_docx_images(doc))
+        if images_text:
+            text_parts.append(images_text)
+
         return "\n".join(text_parts)
     except Exception as e:
-        logging.error(f"  -> Erro ao extrair texto do DOCX {os.path.basename(docx_path)}: {e}")
+        logging.error(f"  -> Erro ao extrair texto do DOCX {_source_name(docx_path)}: {e}")
         return ""
 
+def _iter_docx_images(doc, min_side=DOCX_IMAGE_MIN_SIDE):
+    """
+    Imagens embutidas no corpo do DOCX, na ordem em que aparecem, como
+    (índice, imagem); quadros de TIFF colados são expandidos. A mesma mídia
+    referenciada mais de uma vez é lida uma única vez.
+    """
+    seen_parts = set()
+    index = 0
+    for blip in doc.element.body.iter(qn('a:blip')):
+        rel_id = blip.get(qn('r:embed'))
+        part = doc.part.related_parts.get(rel_id) if rel_id else None
+        if part is None or part.partname in seen_parts:
+            continue
+        seen_parts.add(part.partname)
+        try:
+            img = Image.open(io.BytesIO(part.blob))
+            if min(img.size) < min_side:
+                continue
+            for _, frame in iter_image_frames(img):
+                yield index, frame
+                index += 1
+        except Exception as e:
+            # EMF/WMF e formatos que o Pillow não abre
+            logging.debug(f"  -> Imagem {part.partname} do DOCX ignorada: {e}")
+
 def extract_text_from_excel(excel_path):
     """Extração aprimorada de Excel com múltiplas engines"""
     try:
@@ -729,7 +2080,7 @@ def extract_text_from_excel(excel_path):
 
         for engine in engines:
             try:
-                xls = pd.ExcelFile(excel_path, engine=engine)
+                xls = pd.ExcelFile(_rewind(excel_path), engine=engine)
                 text_parts = []
 
                 for sheet_name in xls.sheet_names:
@@ -758,26 +2109,27 @@ def extract_text_from_excel(excel_path):
                 continue
 
         # Se falhou com todas as engines, tenta como texto
-        logging.warning(f"  -> Falha ao ler {os.path.basename(excel_path)} como Excel. Tentando como texto.")
+        logging.warning(f"  -> Falha ao ler {_source_name(excel_path)} como Excel. Tentando como texto.")
         return extract_text_from_text_based_file(excel_path)
     except Exception as e:
-        logging.error(f"  -> Erro ao extrair texto do Excel {os.path.basename(excel_path)}: {e}")
+        logging.error(f"  -> Erro ao extrair texto do Excel {_source_name(excel_path)}: {e}")
         return ""
 
 def extract_text_from_text_based_file(file_path):
     """Extração aprimorada de arquivos baseados em texto"""
     try:
+        raw_content = _read_source_bytes(file_path)
+
         # Tenta diferentes encodings
         encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
 
         for encoding in encodings:
             try:
-                with open(file_path, 'r', encoding=encoding, errors='ignore') as file:
-                    content = file.read()
+                content = raw_content.decode(encoding, errors='ignore')
 
                 if content.strip():  # Se conseguiu ler conteúdo
                     # Processa baseado na extensão
-                    file_ext = os.path.splitext(file_path)[1].lower()
+                    file_ext = os.path.splitext(_source_name(file_path))[1].lower()
 
                     if file_ext in ['.xml', '.html', '.ofx', '.ofc']:
                         try:
@@ -790,12 +2142,488 @@ def extract_text_from_text_based_file(file_path):
             except Exception:
                 continue
 
-        logging.warning(f"  -> Não foi possível ler {os.path.basename(file_path)} com nenhum encoding.")
+        logging.warning(f"  -> Não foi possível ler {_source_name(file_path)} com nenhum encoding.")
+        return ""
+    except Exception as e:
+        logging.error(f"  -> Erro ao extrair texto de {_source_name(file_path)}: {e}")
+        return ""
+
+
+# --- Formatos Legados do Office (.doc/.xls) ---
+
+OLE2_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+LEGACY_TARGETS = {
+    '.doc': ('.docx', 'docx:MS Word 2007 XML'),
+    '.xls': ('.xlsx', 'xlsx:Calc MS Excel 2007 XML'),
+}
+
+
+class LegacyFormatError(Exception):
+    """Arquivo legado que a leitura direta não suporta (vai para o conversor)"""
+    pass
+
+
+def sniff_office_format(data):
+    """
+    Formato real de um .doc/.xls pelo conteúdo: 'ole2' (binário do Office),
+    'zip' (DOCX/XLSX renomeado), 'rtf', 'html' (o "salvar como .doc/.xls"
+    de muitos sistemas), 'utf16' ou 'text' (CSV/TSV exportado com extensão
+    .xls). Binários não reconhecidos (Word 2.0, WordPerfect, arquivos
+    truncados) são 'binary' e não vão para o extrator de texto.
+    """
+    if data.startswith(OLE2_SIGNATURE):
+        return 'ole2'
+    if data.startswith(b'PK\x03\x04'):
+        return 'zip'
+    if data.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'utf16'
+    sample = data[:4096]
+    control_bytes = sum(1 for byte in sample if byte < 32 and byte not in (9, 10, 12, 13))
+    if b'\x00' in sample or control_bytes > len(sample) // 20:
+        return 'binary'
+    head = data[:2048].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if head.startswith(b'{\\rtf'):
+        return 'rtf'
+    if head.startswith((b'<html', b'<!doctype html', b'<?xml', b'<table', b'<meta')) or b'<html' in head:
+        return 'html'
+    return 'text'
+
+def _word_fib_table_stream(word_stream):
+    """Valida o FIB do Word 97-2003 e devolve (nome do fluxo de tabela, fcClx, lcbClx)"""
+    if len(word_stream) < 0x200:
+        raise LegacyFormatError("fluxo WordDocument truncado")
+    ident, nfib = struct.unpack_from('<HH', word_stream, 0)
+    flags = struct.unpack_from('<H', word_stream, 0x0A)[0]
+    if ident != 0xA5EC or nfib < 0x00C0:
+        raise LegacyFormatError(f"versão do Word anterior ao 97 (nFib {nfib})")
+    if flags & 0x0100:
+        raise LegacyFormatError("documento protegido por senha")
+    # FIB: base (32 bytes), fibRgW, fibRgLw e fibRgFcLcb de tamanhos variáveis
+    pos = 32
+    pos += 2 + 2 * struct.unpack_from('<H', word_stream, pos)[0]
+    pos += 2 + 4 * struct.unpack_from('<H', word_stream, pos)[0]
+    fc_lcb_count = struct.unpack_from('<H', word_stream, pos)[0]
+    if fc_lcb_count <= 33:
+        raise LegacyFormatError("FIB sem a tabela de peças")
+    fc_clx, lcb_clx = struct.unpack_from('<II', word_stream, pos + 2 + 33 * 8)
+    return ('1Table' if flags & 0x0200 else '0Table'), fc_clx, lcb_clx
+
+_WORD_FIELD_INSTRUCTION = re.compile(r'\x13[^\x13\x14\x15]*\x14')
+_WORD_FIELD_WITHOUT_RESULT = re.compile(r'\x13[^\x13\x14\x15]*\x15')
+_WORD_CONTROL_CHARS = str.maketrans({'\r': '\n', '\x0b': '\n', '\x0c': '\n', '\x07': '\t', '\x1e': '-',
+                                     '\x1f': None, '\x01': None, '\x02': None, '\x05': None,
+                                     '\x08': None, '\x13': None, '\x14': None, '\x15': None})
+
+def _clean_word_text(text):
+    """Remove códigos de campo (mantendo o resultado exibido) e caracteres de controle do Word"""
+    previous = None
+    while previous != text:  # campos aninhados: de dentro para fora
+        previous = text
+        text = _WORD_FIELD_INSTRUCTION.sub('', text)
+        text = _WORD_FIELD_WITHOUT_RESULT.sub('', text)
+    lines = (line.strip() for line in text.translate(_WORD_CONTROL_CHARS).split('\n'))
+    return "\n".join(line for line in lines if line)
+
+def extract_text_from_word97(data):
+    """
+    Texto de um .doc binário (Word 97-2003) lido pela tabela de peças do
+    documento, sem conversor externo. Levanta LegacyFormatError para
+    versões anteriores, documentos com senha ou estrutura inesperada.
+    """
+    if CompDoc is None:
+        raise LegacyFormatError("xlrd não instalado (leitura de OLE2)")
+    try:
+        ole = CompDoc(data, logfile=io.StringIO())
+        word_stream = ole.get_named_stream('WordDocument')
+    except Exception as e:
+        raise LegacyFormatError(f"contêiner OLE2 inválido: {e}")
+    if not word_stream:
+        raise LegacyFormatError("sem fluxo WordDocument")
+    table_name, fc_clx, lcb_clx = _word_fib_table_stream(word_stream)
+    table_stream = ole.get_named_stream(table_name) or b''
+    clx = table_stream[fc_clx:fc_clx + lcb_clx]
+
+    # Clx: blocos Prc (0x01, propriedades) seguidos do Pcdt (0x02, tabela de peças)
+    pos = 0
+    while pos < len(clx) and clx[pos] == 0x01:
+        pos += 3 + struct.unpack_from('<H', clx, pos + 1)[0]
+    if pos + 5 > len(clx) or clx[pos] != 0x02:
+        raise LegacyFormatError("tabela de peças não encontrada")
+    plc_size = struct.unpack_from('<I', clx, pos + 1)[0]
+    plc = clx[pos + 5:pos + 5 + plc_size]
+    piece_count = (len(plc) - 4) // 12
+    if piece_count <= 0:
+        raise LegacyFormatError("tabela de peças vazia")
+    cps = struct.unpack_from(f'<{piece_count + 1}I', plc, 0)
+
+    parts = []
+    for index in range(piece_count):
+        _, fc, _ = struct.unpack_from('<HIH', plc, (piece_count + 1) * 4 + index * 8)
+        char_count = cps[index + 1] - cps[index]
+        if fc & 0x40000000:
+            # Peça "comprimida": um byte por caractere em cp1252
+            start = (fc & 0x3FFFFFFF) // 2
+            parts.append(word_stream[start:start + char_count].decode('cp1252', errors='replace'))
+        else:
+            parts.append(word_stream[fc:fc + 2 * char_count].decode('utf-16-le', errors='replace'))
+    return _clean_word_text(''.join(parts))
+
+def _xls_cell_text(book, cell):
+    if cell.ctype == xlrd.XL_CELL_DATE:
+        try:
+            return xlrd.xldate_as_datetime(cell.value, book.datemode).strftime('%d/%m/%Y')
+        except Exception:
+            return str(cell.value)
+    if cell.ctype == xlrd.XL_CELL_NUMBER:
+        return str(int(cell.value)) if float(cell.value).is_integer() else str(cell.value)
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return ''
+    return str(cell.value).strip()
+
+def extract_text_from_xls(data):
+    """Texto de um .xls binário (BIFF) pelo xlrd, no mesmo formato do extract_text_from_excel"""
+    if xlrd is None:
+        raise LegacyFormatError("xlrd não instalado")
+    try:
+        book = xlrd.open_workbook(file_contents=data, on_demand=True, logfile=io.StringIO())
+    except Exception as e:
+        raise LegacyFormatError(f"xls ilegível pelo xlrd: {e}")
+    text_parts = []
+    try:
+        for sheet_index in range(book.nsheets):
+            sheet = book.sheet_by_index(sheet_index)
+            text_parts.append(f"=== PLANILHA: {sheet.name} ===")
+            for row_index in range(sheet.nrows):
+                cells = (_xls_cell_text(book, cell) for cell in sheet.row(row_index))
+                row_text = " | ".join(cell for cell in cells if cell)
+                if row_text:
+                    text_parts.append(row_text)
+            text_parts.append("")  # Linha em branco entre planilhas
+            book.unload_sheet(sheet_index)
+    finally:
+        book.release_resources()
+    return "\n".join(text_parts)
+
+_RTF_DESTINATION = re.compile(r'\{\\\*[^{}]*\}|\{\\(?:fonttbl|colortbl|stylesheet|info|pict)[^{}]*(?:\{[^{}]*\}[^{}]*)*\}')
+_RTF_CONTROL = re.compile(r"\\'([0-9a-fA-F]{2})|\\u(-?\d+)\??|\\(par|line|tab|cell|row)\b ?|\\[a-z]+-?\d* ?|\\([{}\\])|[{}]")
+
+def _rtf_to_text(content):
+    """Texto de um RTF (.doc salvo como RTF): sem tabelas de fonte/estilo e com escapes decodificados"""
+    content = _RTF_DESTINATION.sub('', content)
+
+    def replace(match):
+        hex_code, unicode_code, break_word, literal = match.groups()
+        if hex_code:
+            return bytes([int(hex_code, 16)]).decode('cp1252', errors='replace')
+        if unicode_code:
+            return chr(int(unicode_code) % 65536)
+        if break_word:
+            return '\t' if break_word in ('tab', 'cell') else '\n'
+        return literal or ''
+
+    lines = (line.strip() for line in _RTF_CONTROL.sub(replace, content).split('\n'))
+    return "\n".join(line for line in lines if line)
+
+def _legacy_tool(configured, *names):
+    return configured or next((path for path in map(shutil.which, names) if path), None)
+
+def legacy_converted_path(content_hash, file_ext):
+    """Caminho, no cache de conversões, do DOCX/XLSX gerado a partir do conteúdo"""
+    return os.path.join(LEGACY_CONVERT_CACHE_DIR, content_hash + LEGACY_TARGETS[file_ext][0])
+
+def _legacy_failed_marker(content_hash):
+    return os.path.join(LEGACY_CONVERT_CACHE_DIR, content_hash + '.falhou')
+
+def _legacy_failed_recently(content_hash):
+    """Falha de conversão registrada há menos de LEGACY_FAILED_RETRY_DAYS (não tenta de novo)"""
+    try:
+        age = time.time() - os.path.getmtime(_legacy_failed_marker(content_hash))
+    except OSError:
+        return False
+    return age < LEGACY_FAILED_RETRY_DAYS * 86400
+
+def _run_converter_command(command, timeout):
+    """
+    Executa o conversor em um grupo de processos próprio. No tempo esgotado
+    encerra o grupo inteiro: matar só o lançador 'soffice' deixaria o
+    soffice.bin rodando e o perfil do slot bloqueado. Retorna False no
+    tempo esgotado.
+    """
+    if os.name == 'nt':
+        group_options = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group_options = {'start_new_session': True}
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **group_options)
+    try:
+        process.wait(timeout=timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        kill_process_tree(process.pid)
+        process.kill()
+        process.wait()
+        return False
+
+def _file_uri(path):
+    """URI file:// de um caminho local (exigido pelo -env:UserInstallation)"""
+    return pathlib.Path(os.path.abspath(path)).as_uri()
+
+
+class LegacyConverter:
+    """
+    LibreOffice headless com perfil de usuário próprio, reaproveitado entre
+    as chamadas (o perfil fica "quente": a primeira inicialização, que cria
+    o perfil, é a mais lenta). Cada chamada converte um lote de arquivos; os
+    resultados vão para o cache de conversões pelo hash do conteúdo.
+    """
+    __slots__ = ('soffice', 'profile_dir')
+
+    def __init__(self, slot, soffice=None):
+        self.soffice = soffice or _legacy_tool(LEGACY_SOFFICE_CMD, 'soffice', 'libreoffice')
+        self.profile_dir = os.path.join(LEGACY_PROFILE_DIR, str(slot))
+
+    @property
+    def available(self):
+        return self.soffice is not None
+
+    def convert(self, file_ext, jobs):
+        """
+        Converte [(hash do conteúdo, caminho de origem)] de uma mesma extensão.
+        Devolve {hash: caminho convertido}. Um arquivo problemático pode
+        derrubar o lote inteiro, então os que faltarem são tentados um a um;
+        só os que falharem sozinhos são marcados no cache (e tentados de novo
+        após LEGACY_FAILED_RETRY_DAYS).
+        """
+        os.makedirs(LEGACY_CONVERT_CACHE_DIR, exist_ok=True)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        converted = self._convert_batch(file_ext, jobs)
+        missing = [job for job in jobs if job[0] not in converted]
+        if len(jobs) > 1:
+            for job in missing:
+                converted.update(self._convert_batch(file_ext, [job]))
+            missing = [job for job in missing if job[0] not in converted]
+        for content_hash, _ in missing:
+            with open(_legacy_failed_marker(content_hash), 'w', encoding='utf-8'):
+                pass
+        return converted
+
+    def _convert_batch(self, file_ext, jobs):
+        target_ext, target_filter = LEGACY_TARGETS[file_ext]
+        converted = {}
+        with tempfile.TemporaryDirectory(prefix='_legado_') as work_dir:
+            # Cópias nomeadas pelo hash: nomes repetidos em pastas diferentes não colidem
+            inputs = []
+            for content_hash, source_path in jobs:
+                input_path = os.path.join(work_dir, content_hash + file_ext)
+                shutil.copyfile(source_path, input_path)
+                inputs.append(input_path)
+            command = [self.soffice, '--headless', '--norestore', '--nolockcheck', '--nodefault',
+                       f"-env:UserInstallation={_file_uri(self.profile_dir)}",
+                       '--convert-to', target_filter, '--outdir', work_dir] + inputs
+            if not _run_converter_command(command, LEGACY_CONVERT_TIMEOUT + 10 * len(inputs)):
+                logging.warning(f"  -> LibreOffice excedeu o tempo ao converter {len(inputs)} arquivo(s).")
+            for content_hash, _ in jobs:
+                output_path = os.path.join(work_dir, content_hash + target_ext)
+                if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                    final_path = legacy_converted_path(content_hash, file_ext)
+                    shutil.move(output_path, final_path)
+                    converted[content_hash] = final_path
+        return converted
+
+_legacy_converter = None
+
+def _process_legacy_converter():
+    """Conversor do processo atual (perfil por processo: workers não disputam o mesmo perfil)"""
+    global _legacy_converter
+    if _legacy_converter is None:
+        _legacy_converter = LegacyConverter(f"worker_{os.getpid()}")
+    return _legacy_converter
+
+def _antiword_text(data):
+    antiword = _legacy_tool(LEGACY_ANTIWORD_CMD, 'antiword')
+    if antiword is None:
         return ""
+    with tempfile.NamedTemporaryFile(suffix='.doc', delete=False) as tmp:
+        tmp.write(data)
+    try:
+        completed = subprocess.run([antiword, '-m', 'cp1252.txt', tmp.name], capture_output=True,
+                                   timeout=LEGACY_CONVERT_TIMEOUT, check=False)
+        return completed.stdout.decode('cp1252', errors='replace') if completed.returncode == 0 else ""
+    except subprocess.TimeoutExpired:
+        return ""
+    finally:
+        os.remove(tmp.name)
+
+def convert_legacy_office(data, file_ext, content_hash):
+    """
+    DOCX/XLSX convertido do arquivo legado: do cache (inclusive os lotes
+    convertidos pelo processo principal) ou convertido agora. None se não
+    houver conversor ou a conversão falhar.
+    """
+    cached_path = legacy_converted_path(content_hash, file_ext)
+    if os.path.exists(cached_path):
+        return cached_path
+    if _legacy_failed_recently(content_hash):
+        return None
+    converter = _process_legacy_converter()
+    if not converter.available:
+        return None
+    with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as tmp:
+        tmp.write(data)
+    try:
+        return converter.convert(file_ext, [(content_hash, tmp.name)]).get(content_hash)
+    finally:
+        os.remove(tmp.name)
+
+def _modern_office_source(data, source, file_ext):
+    """Fluxo em memória com o nome na extensão moderna (DOCX/XLSX renomeados para .doc/.xls)"""
+    stream = io.BytesIO(data)
+    stream.name = os.path.splitext(_source_name(source))[0] + LEGACY_TARGETS[file_ext][0]
+    return stream
+
+def extract_text_from_legacy_office(file_path):
+    """
+    .doc/.xls: identifica o formato real pelo conteúdo. Binários OLE2 são
+    lidos diretamente (Word 97-2003 e xlrd); versões que a leitura direta não
+    cobre são convertidas para DOCX/XLSX pelo LibreOffice (ou antiword, para
+    .doc), com o resultado em cache pelo hash do conteúdo.
+    """
+    file_ext = os.path.splitext(_source_name(file_path))[1].lower()
+    modern_extractor = extract_text_from_docx if file_ext == '.doc' else extract_text_from_excel
+    try:
+        data = _read_source_bytes(file_path)
     except Exception as e:
-        logging.error(f"  -> Erro ao extrair texto de {os.path.basename(file_path)}: {e}")
+        logging.error(f"  -> Erro ao ler {_source_name(file_path)}: {e}")
+        return ""
+
+    file_format = sniff_office_format(data)
+    if file_format == 'zip':
+        return modern_extractor(_modern_office_source(data, file_path, file_ext))
+    if file_format == 'rtf':
+        return _rtf_to_text(data.decode('latin-1'))
+    if file_format == 'html':
+        try:
+            return BeautifulSoup(data, 'lxml').get_text(separator='\n')
+        except Exception:
+            return extract_text_from_text_based_file(file_path)
+    if file_format == 'utf16':
+        return data.decode('utf-16', errors='replace')
+    if file_format == 'text':
+        return extract_text_from_text_based_file(file_path)
+    if file_format == 'binary':
+        logging.warning(f"  -> {_source_name(file_path)}: formato binário não reconhecido "
+                        f"(Word 2.0, WordPerfect ou arquivo truncado). Nenhum texto extraído.")
         return ""
 
+    try:
+        text = extract_text_from_word97(data) if file_ext == '.doc' else extract_text_from_xls(data)
+        if text.strip():
+            return text
+    except LegacyFormatError as e:
+        logging.info(f"  -> Leitura direta de {_source_name(file_path)} indisponível ({e}). Usando conversor.")
+
+    content_hash = hashlib.sha256(data).hexdigest()
+    converted_path = convert_legacy_office(data, file_ext, content_hash)
+    if converted_path:
+        return modern_extractor(converted_path)
+    if file_ext == '.doc':
+        text = _antiword_text(data)
+        if text.strip():
+            return text
+    logging.warning(f"  -> Nenhum conversor disponível para {_source_name(file_path)} "
+                    f"(instale o LibreOffice ou ajuste LEGACY_SOFFICE_CMD).")
+    return ""
+
+def _legacy_needs_conversion(item):
+    """O item é um .doc/.xls binário que a leitura direta não cobre e ainda não foi convertido?"""
+    file_ext = item['ext']
+    if file_ext not in LEGACY_TARGETS:
+        return None
+    try:
+        with open(item['path'], 'rb') as f:
+            if f.read(len(OLE2_SIGNATURE)) != OLE2_SIGNATURE:
+                return None
+            if file_ext == '.xls' and xlrd is not None:
+                return None
+            data = OLE2_SIGNATURE + f.read()
+    except OSError:
+        return None
+    if file_ext == '.doc' and CompDoc is not None:
+        try:
+            word_stream = CompDoc(data, logfile=io.StringIO()).get_named_stream('WordDocument')
+            _word_fib_table_stream(word_stream or b'')
+            return None
+        except Exception:
+            pass
+    content_hash = hashlib.sha256(data).hexdigest()
+    if os.path.exists(legacy_converted_path(content_hash, file_ext)) or \
+            _legacy_failed_recently(content_hash):
+        return None
+    return content_hash
+
+def legacy_preconversion(work_items, batch_size=None, batch_wait=None):
+    """
+    Envolve o fluxo de itens da descoberta: .doc/.xls que precisam do
+    conversor são retidos e convertidos em lotes (um LibreOffice por lote,
+    LEGACY_CONVERTER_WORKERS lotes em paralelo, cada um com seu perfil) e só
+    então liberados ao agendador, que os encontra no cache de conversões.
+    Os demais itens passam sem espera. Sem LibreOffice, nada é retido.
+    """
+    batch_size = batch_size or LEGACY_CONVERT_BATCH_SIZE
+    batch_wait = LEGACY_CONVERT_BATCH_WAIT if batch_wait is None else batch_wait
+    soffice = _legacy_tool(LEGACY_SOFFICE_CMD, 'soffice', 'libreoffice')
+    if soffice is None:
+        yield from work_items
+        return
+    converters = queue.Queue()
+    for slot in range(LEGACY_CONVERTER_WORKERS):
+        converters.put(LegacyConverter(f"lote_{slot}", soffice))
+
+    def convert_batch(file_ext, batch):
+        converter = converters.get()
+        try:
+            converted = converter.convert(file_ext, [(content_hash, item['path']) for item, content_hash in batch])
+            logging.info(f"Conversor de formatos legados: {len(converted)}/{len(batch)} arquivo(s) {file_ext} convertidos.")
+        except Exception as e:
+            logging.warning(f"Falha no lote de conversão {file_ext}: {e}")
+        finally:
+            converters.put(converter)
+        return [item for item, _ in batch]
+
+    pending = {file_ext: [] for file_ext in LEGACY_TARGETS}
+    pending_since = {}
+    futures = set()
+    with ThreadPoolExecutor(max_workers=LEGACY_CONVERTER_WORKERS) as executor:
+        def flush(file_ext):
+            futures.add(executor.submit(convert_batch, file_ext, pending[file_ext]))
+            pending[file_ext] = []
+            pending_since.pop(file_ext, None)
+
+        def release_done():
+            for future in [f for f in futures if f.done()]:
+                futures.discard(future)
+                yield from future.result()
+
+        for item in work_items:
+            content_hash = _legacy_needs_conversion(item) if item is not None else None
+            if content_hash is None:
+                yield item
+            else:
+                pending[item['ext']].append((item, content_hash))
+                pending_since.setdefault(item['ext'], time.monotonic())
+            for file_ext, batch in pending.items():
+                if len(batch) >= batch_size or (batch and time.monotonic() - pending_since[file_ext] >= batch_wait):
+                    flush(file_ext)
+            yield from release_done()
+
+        for file_ext, batch in pending.items():
+            if batch:
+                flush(file_ext)
+        while futures:
+            wait(list(futures), timeout=1.0, return_when=FIRST_COMPLETED)
+            released = list(release_done())
+            # Pulso ao agendador enquanto os lotes terminam: recolhe resultados e ocupa os pools
+            yield from released or [None]
+
 
 # --- FUNÇÃO CORRIGIDA PARA EXTRAÇÃO DE CNPJ DA PASTA ---
 
@@ -940,75 +2768,2096 @@ def extract_compressed_files(file_path, extract_dir):
     return False
 
 
-# --- FUNÇÃO PRINCIPAL CORRIGIDA ---
-
-def process_and_save_file_data(file_path, filename, client_folder_name):
+# --- Chave de Acesso de NF-e / CT-e ---
+
+# Códigos IBGE das UFs usados no início da chave de acesso
+UF_CODES = {
+    '11': 'RO', '12': 'AC', '13': 'AM', '14': 'RR', '15': 'PA', '16': 'AP', '17': 'TO',
+    '21': 'MA', '22': 'PI', '23': 'CE', '24': 'RN', '25': 'PB', '26': 'PE', '27': 'AL',
+    '28': 'SE', '29': 'BA', '31': 'MG', '32': 'ES', '33': 'RJ', '35': 'SP', '41': 'PR',
+    '42': 'SC', '43': 'RS', '50': 'MS', '51': 'MT', '52': 'GO', '53': 'DF',
+}
+# Modelo do documento fiscal -> tipo de arquivo do motor de classificação
+ACCESS_KEY_MODELS = {
+    '55': "Nota Fiscal Eletrônica",   # NF-e
+    '65': "Nota Fiscal Eletrônica",   # NFC-e
+    '57': "DACTE",                    # CT-e
+    '67': "DACTE",                    # CT-e OS
+}
+# Chave impressa no DANFE/DACTE (grupos de 4 dígitos) ou contínua
+ACCESS_KEY_TEXT_PATTERN = re.compile(r'(?<!\d)(\d{4}(?:[ .]?\d{4}){10})(?!\d)')
+ACCESS_KEY_XML_PATTERN = re.compile(rb'<ch(?:NFe|CTe)>\s*(\d{44})\s*<|Id="(?:NFe|CTe)(\d{44})"')
+
+def access_key_check_digit(key43):
+    """Dígito verificador (módulo 11, pesos 2 a 9 da direita para a esquerda)"""
+    total = sum(int(digit) * (2 + i % 8) for i, digit in enumerate(reversed(key43)))
+    remainder = total % 11
+    return 0 if remainder < 2 else 11 - remainder
+
+def decode_access_key(key):
     """
-    Processamento principal com IA aprimorada e EXTRAÇÃO DE CNPJ CORRIGIDA
+    Valida e decompõe uma chave de acesso de 44 dígitos.
+    Retorna dicionário com UF, ano/mês de emissão, CNPJ do emitente, modelo,
+    série, número e tipo de emissão, ou None se a chave for inválida.
     """
-    logging.info(f"Processando arquivo: {filename} (Cliente: {client_folder_name})")
-
-    # Mapeamento de funções de extração
-    extraction_map = {
-        '.pdf': extract_text_from_pdf, 
-        '.docx': extract_text_from_docx,
-        '.doc': extract_text_from_docx,  # Adiciona suporte a DOC
-        '.xlsx': extract_text_from_excel, 
-        '.xls': extract_text_from_excel,
-        '.jpeg': extract_text_from_image_file, 
-        '.jpg': extract_text_from_image_file,
-        '.png': extract_text_from_image_file, 
-        '.tiff': extract_text_from_image_file,
-        '.bmp': extract_text_from_image_file,
-        '.gif': extract_text_from_image_file,
-        '.txt': extract_text_from_text_based_file, 
-        '.csv': extract_text_from_text_based_file,
-        '.xml': extract_text_from_text_based_file, 
-        '.html': extract_text_from_text_based_file,
-        '.htm': extract_text_from_text_based_file,
-        '.ofx': extract_text_from_text_based_file, 
-        '.oft': extract_text_from_text_based_file,
-        '.ofc': extract_text_from_text_based_file,
-        '.json': extract_text_from_text_based_file,
-        '.log': extract_text_from_text_based_file,
+    key = re.sub(r'\D', '', key or '')
+    if len(key) != 44 or access_key_check_digit(key[:43]) != int(key[43]):
+        return None
+    uf, year, month = key[0:2], key[2:4], key[4:6]
+    model = key[20:22]
+    if uf not in UF_CODES or not 1 <= int(month) <= 12 or model not in ACCESS_KEY_MODELS:
+        return None
+    return {
+        'chave': key,
+        'uf': UF_CODES[uf],
+        'ano': 2000 + int(year),
+        'mes': int(month),
+        'cnpj_emitente': key[6:20],
+        'modelo': model,
+        'serie': int(key[22:25]),
+        'numero': int(key[25:34]),
+        'tipo_emissao': key[34],
+        'codigo_numerico': key[35:43],
+        'tipo_arquivo': ACCESS_KEY_MODELS[model],
     }
 
-    file_ext = os.path.splitext(filename)[1].lower()
+def find_access_key(text):
+    """Primeira chave de acesso válida no texto (DANFE/DACTE, XML convertido em texto)"""
+    for match in ACCESS_KEY_TEXT_PATTERN.finditer(text or ''):
+        key_info = decode_access_key(match.group(1))
+        if key_info:
+            return key_info
+    return None
 
-    if file_ext not in extraction_map:
-        logging.warning(f"  -> Tipo de arquivo '{file_ext}' não suportado. Arquivo ignorado: {filename}")
+def find_access_key_in_xml(data):
+    """Chave de acesso das tags chNFe/chCTe (ou do atributo Id) de um XML, sem parsear o documento"""
+    for match in ACCESS_KEY_XML_PATTERN.finditer(data or b''):
+        key_info = decode_access_key((match.group(1) or match.group(2)).decode('ascii'))
+        if key_info:
+            return key_info
+    return None
+
+def analysis_from_access_key(key_info, client_folder_name):
+    """Análise completa a partir da chave: tipo pelo modelo, competência pela emissão, CNPJ do emitente"""
+    cnpj_validator = CNPJValidator()
+    cnpj = key_info['cnpj_emitente']
+    if cnpj_validator._validate_cnpj(cnpj):
+        cnpj = cnpj_validator._format_cnpj(cnpj)
+    else:
+        # Emitente pessoa física (CPF na chave): mantém o CNPJ da pasta do cliente
+        cnpj = extract_cnpj_from_folder_name(client_folder_name)
+    return {
+        "CNPJ": cnpj,
+        "Mes_Competencia": f"{key_info['mes']:02d}/{key_info['ano']}",
+        "Tipo_Arquivo": key_info['tipo_arquivo'],
+        "Agencia": None,
+        "Conta": None,
+        "Chave_Acesso": key_info['chave'],
+    }
+
+
+# --- Boletos: Linha Digitável e Código de Barras ---
+
+# Linha digitável pelos grupos de campos, para não absorver o código do banco
+# impresso ao lado ("341-7 34191.79001 ..."), comum quando o OCR perde o '|'
+BOLETO_LINE_PATTERN = re.compile(
+    r'(?<![\d.])(?:'
+    r'\d{5}[.\s]?\d{5}\s*\d{5}[.\s]?\d{6}\s*\d{5}[.\s]?\d{6}\s*\d\s*\d{14}'  # bancária: 3 campos, DV, fator/valor
+    r'|\d{11}[\s\-]?\d(?:\s*\d{11}[\s\-]?\d){3}'  # arrecadação: 4 blocos de 11 dígitos + DV
+    r')(?![\d.])')
+BOLETO_FACTOR_BASE = datetime(1997, 10, 7)
+BOLETO_FACTOR_RESET = datetime(2025, 2, 22)  # Fator 1000 após o fator 9999 (fev/2025)
+BOLETO_MAX_DAYS_AHEAD = 365  # Vencimento mais distante aceito após a data de referência
+
+def _mod10(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        product = int(digit) * (2 if i % 2 == 0 else 1)
+        total += product // 10 + product % 10
+    return (10 - total % 10) % 10
+
+def _mod11(digits, bank=True):
+    total = sum(int(digit) * (2 + i % 8) for i, digit in enumerate(reversed(digits)))
+    remainder = total % 11
+    if bank:
+        dv = 11 - remainder
+        return 1 if dv in (0, 10, 11) else dv
+    return 0 if remainder in (0, 1) else 11 - remainder
+
+def competence_from_due_date(day, month, year):
+    """Competência de um vencimento: até o dia 15, mês anterior; depois, o próprio mês"""
+    if day <= 15:
+        comp_month = month - 1 if month > 1 else 12
+        comp_year = year if month > 1 else year - 1
+    else:
+        comp_month, comp_year = month, year
+    return f"{comp_month:02d}/{comp_year}"
+
+def _due_date_from_factor(factor, reference=None):
+    """
+    Fator de vencimento -> data. Entre os ciclos (base 1997 ou 2025), fica
+    o mais recente que não passe de BOLETO_MAX_DAYS_AHEAD dias após a
+    referência: um boleto de 2011 (fator ~5000) não vira um vencimento em 2036.
+    """
+    if factor == 0:
+        return None
+    reference = reference or datetime.now()
+    candidates = [BOLETO_FACTOR_BASE + timedelta(days=factor)]
+    if factor >= 1000:
+        candidates.append(BOLETO_FACTOR_RESET + timedelta(days=factor - 1000))
+    plausible = [date for date in candidates if (date - reference).days <= BOLETO_MAX_DAYS_AHEAD]
+    return max(plausible) if plausible else min(candidates)
+
+def decode_boleto_barcode(barcode, reference=None):
+    """
+    Valida e decompõe o código de barras de 44 dígitos de um boleto bancário
+    ou de arrecadação/convênio. Retorna dicionário ou None se inválido.
+    """
+    if len(barcode) != 44 or not barcode.isdigit():
+        return None
+    if barcode[0] == '8':
+        # Arrecadação/convênio: identificador de valor define o módulo do DV geral
+        value_id = barcode[2]
+        if value_id in '67':
+            valid = _mod10(barcode[:3] + barcode[4:]) == int(barcode[3])
+        elif value_id in '89':
+            valid = _mod11(barcode[:3] + barcode[4:], bank=False) == int(barcode[3])
+        else:
+            valid = False
+        if not valid:
+            return None
+        return {
+            'codigo_barras': barcode,
+            'especie': 'arrecadacao',
+            'segmento': barcode[1],
+            'valor': int(barcode[4:15]) / 100 if value_id in '68' else None,
+            'vencimento': None,
+        }
+
+    if _mod11(barcode[:4] + barcode[5:]) != int(barcode[4]):
+        return None
+    due_date = _due_date_from_factor(int(barcode[5:9]), reference)
+    return {
+        'codigo_barras': barcode,
+        'especie': 'bancario',
+        'banco': barcode[:3],
+        'valor': int(barcode[9:19]) / 100,
+        'vencimento': due_date.strftime('%d/%m/%Y') if due_date else None,
+    }
+
+def decode_boleto_line(line, reference=None):
+    """
+    Valida a linha digitável (47 dígitos bancária, 48 arrecadação), incluindo os
+    dígitos de cada campo, e decompõe pelo código de barras equivalente.
+    """
+    digits = re.sub(r'\D', '', line or '')
+    if len(digits) == 47:
+        fields = ((digits[0:9], digits[9]), (digits[10:20], digits[20]), (digits[21:31], digits[31]))
+        if any(_mod10(body) != int(dv) for body, dv in fields):
+            return None
+        barcode = digits[0:4] + digits[32] + digits[33:47] + digits[4:9] + digits[10:20] + digits[21:31]
+    elif len(digits) == 48 and digits[0] == '8':
+        blocks = [digits[i:i + 12] for i in range(0, 48, 12)]
+        checker = _mod10 if digits[2] in '67' else (lambda body: _mod11(body, bank=False))
+        if any(checker(block[:11]) != int(block[11]) for block in blocks):
+            return None
+        barcode = ''.join(block[:11] for block in blocks)
+    else:
+        return None
+    info = decode_boleto_barcode(barcode, reference)
+    if info:
+        info['linha_digitavel'] = digits
+    return info
+
+def find_boleto_line(text, reference=None):
+    """Primeira linha digitável válida no texto"""
+    for match in BOLETO_LINE_PATTERN.finditer(text or ''):
+        info = decode_boleto_line(match.group(0), reference)
+        if info:
+            return info
+    return None
+
+# Interleaved 2 of 5: larguras (N = estreita, W = larga) de cada dígito
+ITF_PATTERNS = {
+    'NNWWN': '0', 'WNNNW': '1', 'NWNNW': '2', 'WWNNN': '3', 'NNWNW': '4',
+    'WNWNN': '5', 'NWWNN': '6', 'NNNWW': '7', 'WNNWN': '8', 'NWNWN': '9',
+}
+ITF_BOLETO_RUNS = 4 + 22 * 10 + 3  # início + 22 pares de dígitos + fim
+
+def _decode_itf_runs(widths):
+    """Decodifica 227 larguras (barra, espaço, ...) de um ITF de 44 dígitos"""
+    narrow = sum(widths[:4]) / 4.0
+    threshold = narrow * 1.6
+    if max(widths[:4]) > threshold or widths[-3] <= threshold:
+        return None
+    digits = []
+    for pair in range(22):
+        elements = widths[4 + pair * 10: 14 + pair * 10]
+        bars = ''.join('W' if w > threshold else 'N' for w in elements[0::2])
+        spaces = ''.join('W' if w > threshold else 'N' for w in elements[1::2])
+        if bars not in ITF_PATTERNS or spaces not in ITF_PATTERNS:
+            return None
+        digits.append(ITF_PATTERNS[bars] + ITF_PATTERNS[spaces])
+    return ''.join(digits)
+
+def _scan_itf_rows(gray, rows=60):
+    """Procura um ITF de boleto em linhas horizontais da imagem (tons de cinza, numpy)"""
+    height = gray.shape[0]
+    for y in np.linspace(0, height - 1, num=min(rows, height)).astype(int):
+        row = gray[y]
+        dark = row < (int(row.min()) + int(row.max())) / 2
+        changes = np.flatnonzero(np.diff(dark.astype(np.int8))) + 1
+        if len(changes) < ITF_BOLETO_RUNS:
+            continue
+        bounds = np.concatenate(([0], changes, [len(row)]))
+        widths = np.diff(bounds)
+        # Nos dois sentidos: a imagem pode estar espelhada ou girada 180°
+        for ordered, first_is_dark in ((widths, dark[0]), (widths[::-1], dark[-1])):
+            # Candidatos: cada barra escura seguida de pelo menos 226 elementos
+            for start in range(0 if first_is_dark else 1, len(ordered) - ITF_BOLETO_RUNS + 1, 2):
+                candidate = ordered[start:start + ITF_BOLETO_RUNS]
+                if max(candidate[:4]) > 2 * min(candidate[:4]):
+                    continue
+                barcode = _decode_itf_runs(candidate.tolist())
+                if barcode and decode_boleto_barcode(barcode):
+                    return barcode
+    return None
+
+def read_boleto_barcode(image):
+    """
+    Lê o código de barras ITF de um boleto a partir da imagem (PIL), sem OCR.
+    Usa o zbar (pyzbar) quando instalado; senão, um decodificador próprio
+    que varre linhas horizontais (e verticais, para páginas giradas).
+    Retorna o dicionário do boleto ou None.
+    """
+    gray_image = image.convert('L')
+    if pyzbar is not None:
+        try:
+            for symbol in pyzbar.decode(gray_image, symbols=[pyzbar.ZBarSymbol.I25]):
+                info = decode_boleto_barcode(symbol.data.decode('ascii', 'ignore'))
+                if info:
+                    return info
+        except Exception as e:
+            logging.debug(f"  -> Falha na leitura via zbar: {e}")
+
+    gray = np.asarray(gray_image)
+    for candidate in (gray, gray.T):
+        barcode = _scan_itf_rows(candidate)
+        if barcode:
+            return decode_boleto_barcode(barcode)
+    return None
+
+def read_boleto_barcode_from_file(source, file_ext):
+    """Código de barras de boleto em imagem ou PDF de uma página (renderizado em alta resolução)"""
+    try:
+        if file_ext == '.pdf':
+            with _open_pdf(source) as doc:
+                if doc.page_count != 1:
+                    return None
+                pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(BOLETO_BARCODE_ZOOM, BOLETO_BARCODE_ZOOM),
+                                                  colorspace=fitz.csGRAY, alpha=False)
+                image = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+        else:
+            image = Image.open(_rewind(source))
+            if getattr(image, 'n_frames', 1) != 1:
+                return None
+        return read_boleto_barcode(image)
+    except Exception as e:
+        logging.debug(f"  -> Código de barras não lido em {_source_name(source)}: {e}")
+        return None
+
+def analysis_from_boleto(boleto_info, client_folder_name, extracted_text=None):
+    """Análise de um boleto decodificado: competência pelo vencimento"""
+    competencia = None
+    if boleto_info['vencimento']:
+        day, month, year = (int(part) for part in boleto_info['vencimento'].split('/'))
+        competencia = competence_from_due_date(day, month, year)
+    cnpj = CNPJValidator().extract_and_validate_cnpj(extracted_text) if extracted_text else None
+    return {
+        "CNPJ": cnpj or extract_cnpj_from_folder_name(client_folder_name),
+        "Mes_Competencia": competencia,
+        "Tipo_Arquivo": "Boleto de Pagamento",
+        "Agencia": None,
+        "Conta": None,
+        "Boleto": {
+            "Banco": boleto_info.get('banco'),
+            "Vencimento": boleto_info['vencimento'],
+            "Valor": boleto_info['valor'],
+            "Linha_Digitavel": boleto_info.get('linha_digitavel'),
+            "Codigo_Barras": boleto_info['codigo_barras'],
+        },
+    }
+
+
+# --- Detecção de Duplicados ---
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16  # 16 bandas x 4 linhas
+_MINHASH_PRIME = np.uint64(4294967311)  # primo > 2^32
+_minhash_rng = np.random.RandomState(20240101)
+_MINHASH_A = _minhash_rng.randint(1, 2**31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_MINHASH_B = _minhash_rng.randint(0, 2**31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+PHASH_BANDS = 16  # 256 bits em 16 bandas de 16 bits
+
+
+def compute_content_hash(file_path, chunk_size=1024 * 1024):
+    """SHA-256 do conteúdo do arquivo (leitura em blocos)"""
+    digest = hashlib.sha256()
+    if hasattr(file_path, 'read'):
+        digest.update(_read_source_bytes(file_path))
+        return digest.hexdigest()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _difference_hash(pil_image):
+    """dHash de 256 bits: compara pixels vizinhos numa miniatura 17x16 em cinza"""
+    small = pil_image.convert('L').resize((17, 16), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(16):
+        offset = row * 17
+        for col in range(16):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def compute_perceptual_hash(file_path, file_ext):
+    """Hash perceptual da imagem ou da primeira página do PDF (renderização barata)"""
+    try:
+        if file_ext == '.pdf':
+            with _open_pdf(file_path) as doc:
+                if doc.page_count == 0:
+                    return None
+                pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(0.3, 0.3), alpha=False)
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        else:
+            img = Image.open(_rewind(file_path))
+            img.draft('L', (256, 256))  # JPEG: decodifica já reduzido
+        return _difference_hash(img)
+    except Exception as e:
+        logging.debug(f"  -> Hash perceptual indisponível para {_source_name(file_path)}: {e}")
+        return None
+
+def compute_text_minhash(text, shingle_size=5):
+    """Assinatura MinHash do texto (shingles de palavras normalizadas)"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < shingle_size:
+        return None
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=4).digest(), 'little') for sh in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    signature = (np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME
+    return signature.min(axis=1).astype(np.uint32)
+
+
+class DuplicateRegistry:
+    """
+    Registro (SQLite) dos documentos já processados na execução, indexado
+    por hash de conteúdo, bandas do hash perceptual e bandas LSH do MinHash,
+    sempre por pasta de cliente. Cópias idênticas reaproveitam o resultado da
+    primeira; imagens ou textos semelhantes reaproveitam apenas a classificação
+    (competência e CNPJ mudam de um mês para outro no mesmo modelo e saem
+    sempre do texto da própria cópia).
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        columns = {row[1]: row[3] for row in self._conn.execute('PRAGMA table_info(documents)')}
+        if columns and not columns.get('client_folder'):
+            # Registro de versão anterior (hash único entre clientes): recomeça vazio
+            self._conn.executescript('DROP TABLE documents; DROP TABLE phash_bands; '
+                                     'DROP TABLE IF EXISTS minhash_bands;')
+        elif columns and 'minhash' not in columns:
+            self._conn.execute('ALTER TABLE documents ADD COLUMN minhash BLOB')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            ' doc_id INTEGER PRIMARY KEY,'
+            ' content_hash TEXT NOT NULL,'
+            ' source_path TEXT NOT NULL,'
+            ' client_folder TEXT NOT NULL,'
+            ' output_path TEXT,'
+            ' analysis TEXT NOT NULL,'
+            ' phash TEXT,'
+            ' minhash BLOB,'
+            ' UNIQUE (content_hash, client_folder));'
+            'CREATE TABLE IF NOT EXISTS phash_bands (band INTEGER, value INTEGER, doc_id INTEGER);'
+            'CREATE INDEX IF NOT EXISTS idx_phash_bands ON phash_bands (band, value);'
+            'CREATE TABLE IF NOT EXISTS minhash_bands (band INTEGER, bucket TEXT, doc_id INTEGER);'
+            'CREATE INDEX IF NOT EXISTS idx_minhash_bands ON minhash_bands (band, bucket);'
+        )
+
+    @staticmethod
+    def _phash_bands(phash):
+        return [(band, (phash >> (band * 16)) & 0xFFFF) for band in range(PHASH_BANDS)]
+
+    @staticmethod
+    def _minhash_bands(minhash):
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        return [(band, minhash[band * rows:(band + 1) * rows].tobytes().hex()) for band in range(MINHASH_BANDS)]
+
+    def _load(self, row, match):
+        doc_id, source_path, analysis = row
+        return {'doc_id': doc_id, 'source_path': source_path, 'analysis': json.loads(analysis), 'match': match}
+
+    def find_exact(self, content_hash, client_folder_name, file_path):
+        """Cópia idêntica na mesma pasta de cliente (em outro cliente o CNPJ da pasta seria outro)"""
+        row = self._conn.execute(
+            'SELECT doc_id, source_path, analysis FROM documents '
+            'WHERE content_hash = ? AND client_folder = ? AND source_path != ?',
+            (content_hash, client_folder_name, file_path)
+        ).fetchone()
+        return self._load(row, 'conteúdo idêntico') if row else None
+
+    def find_similar_image(self, phash, client_folder_name, file_path):
+        """Quase-duplicado visual, restrito à mesma pasta de cliente (modelos iguais de outros clientes diferem só no texto miúdo)"""
+        candidates = set()
+        for band, value in self._phash_bands(phash):
+            for (doc_id,) in self._conn.execute(
+                    'SELECT doc_id FROM phash_bands WHERE band = ? AND value = ? LIMIT 200', (band, value)):
+                candidates.add(doc_id)
+        for doc_id in candidates:
+            row = self._conn.execute(
+                'SELECT doc_id, source_path, analysis, phash FROM documents '
+                'WHERE doc_id = ? AND client_folder = ? AND source_path != ?',
+                (doc_id, client_folder_name, file_path)
+            ).fetchone()
+            if row and bin(int(row[3], 16) ^ phash).count('1') <= PHASH_MAX_DISTANCE:
+                return self._load(row[:3], 'imagem semelhante')
+        return None
+
+    def find_similar_text(self, minhash, client_folder_name, file_path):
+        """Quase-duplicado pelo texto (Jaccard estimada >= MINHASH_THRESHOLD), na mesma pasta de cliente"""
+        candidates = set()
+        for band, bucket in self._minhash_bands(minhash):
+            for (doc_id,) in self._conn.execute(
+                    'SELECT doc_id FROM minhash_bands WHERE band = ? AND bucket = ? LIMIT 200', (band, bucket)):
+                candidates.add(doc_id)
+        for doc_id in candidates:
+            row = self._conn.execute(
+                'SELECT doc_id, source_path, analysis, minhash FROM documents '
+                'WHERE doc_id = ? AND client_folder = ? AND source_path != ?',
+                (doc_id, client_folder_name, file_path)
+            ).fetchone()
+            if row and row[3]:
+                other = np.frombuffer(row[3], dtype=np.uint32)
+                if float(np.mean(other == minhash)) >= MINHASH_THRESHOLD:
+                    return self._load(row[:3], 'texto semelhante')
+        return None
+
+    def register(self, content_hash, file_path, client_folder_name, output_path, analysis, phash=None, minhash=None):
+        cursor = self._conn.execute(
+            'INSERT OR IGNORE INTO documents (content_hash, source_path, client_folder, output_path, analysis, phash, minhash) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (content_hash, file_path, client_folder_name, output_path, json.dumps(analysis, ensure_ascii=False),
+             format(phash, 'x') if phash is not None else None,
+             minhash.tobytes() if minhash is not None else None)
+        )
+        if cursor.rowcount == 0:
+            return
+        doc_id = cursor.lastrowid
+        if phash is not None:
+            self._conn.executemany('INSERT INTO phash_bands (band, value, doc_id) VALUES (?, ?, ?)',
+                                   [(band, value, doc_id) for band, value in self._phash_bands(phash)])
+        if minhash is not None:
+            self._conn.executemany('INSERT INTO minhash_bands (band, bucket, doc_id) VALUES (?, ?, ?)',
+                                   [(band, bucket, doc_id) for band, bucket in self._minhash_bands(minhash)])
+
+    def reset(self):
+        self._conn.executescript('DELETE FROM documents; DELETE FROM phash_bands; DELETE FROM minhash_bands;')
+
+    def close(self):
+        self._conn.close()
+
+
+_duplicate_registries = {}
+
+def get_duplicate_registry(db_path):
+    """Conexão ao registro de duplicados reaproveitada por processo do pool"""
+    registry = _duplicate_registries.get(db_path)
+    if registry is None:
+        registry = DuplicateRegistry(db_path)
+        _duplicate_registries[db_path] = registry
+    return registry
+
+
+# --- Mapeamento de funções de extração ---
+EXTRACTION_MAP = {
+    '.pdf': extract_text_from_pdf,
+    '.docx': extract_text_from_docx,
+    '.doc': extract_text_from_legacy_office,
+    '.xlsx': extract_text_from_excel,
+    '.xls': extract_text_from_legacy_office,
+    '.jpeg': extract_text_from_image_file,
+    '.jpg': extract_text_from_image_file,
+    '.png': extract_text_from_image_file,
+    '.tiff': extract_text_from_image_file,
+    '.tif': extract_text_from_image_file,
+    '.bmp': extract_text_from_image_file,
+    '.gif': extract_text_from_image_file,
+    '.txt': extract_text_from_text_based_file,
+    '.csv': extract_text_from_text_based_file,
+    '.xml': extract_text_from_text_based_file,
+    '.html': extract_text_from_text_based_file,
+    '.htm': extract_text_from_text_based_file,
+    '.ofx': extract_text_from_text_based_file,
+    '.oft': extract_text_from_text_based_file,
+    '.ofc': extract_text_from_text_based_file,
+    '.json': extract_text_from_text_based_file,
+    '.log': extract_text_from_text_based_file,
+}
+
+SUPPORTED_EXTENSIONS = frozenset(EXTRACTION_MAP)
+COMPRESSED_EXTENSIONS = frozenset({'.zip', '.rar'})
+
+
+# --- Descoberta de Arquivos (os.scandir) ---
+
+def _scan_directory(dir_path, excluded_paths):
+    """
+    Lista um único diretório com os.scandir.
+    Retorna (subdiretórios, itens de trabalho, completo) com os itens já
+    filtrados por extensão, reaproveitando os dados de stat em cache do
+    DirEntry; completo é falso quando a listagem ou alguma entrada falhou.
+    """
+    subdirs = []
+    items = []
+    complete = True
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in IGNORED_DIR_NAMES:
+                            continue
+                        if os.path.normcase(entry.path) in excluded_paths:
+                            continue
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        file_ext = os.path.splitext(entry.name)[1].lower()
+                        if file_ext not in SUPPORTED_EXTENSIONS and file_ext not in COMPRESSED_EXTENSIONS:
+                            continue
+                        stat_result = entry.stat(follow_symlinks=False)
+                        items.append({
+                            'path': entry.path,
+                            'filename': entry.name,
+                            'ext': file_ext,
+                            'size': stat_result.st_size,
+                            'mtime': stat_result.st_mtime,
+                        })
+                except OSError as e:
+                    logging.warning(f"  -> Não foi possível ler a entrada {entry.path}: {e}")
+                    complete = False
+    except OSError as e:
+        logging.warning(f"  -> Não foi possível listar o diretório {dir_path}: {e}")
+        complete = False
+    return subdirs, items, complete
+
+
+class DiscoveryRecord:
+    """
+    O que a descoberta confirmou numa execução: diretórios listados por
+    completo e arquivos encontrados neles. Um arquivo só é dado como
+    removido quando a pasta dele foi listada sem erro e ele não estava lá.
+    """
+
+    __slots__ = ('listed_dirs', 'seen_paths')
+
+    def __init__(self):
+        self.listed_dirs = set()
+        self.seen_paths = set()
+
+    def add(self, dir_path, items, complete):
+        if complete:
+            self.listed_dirs.add(os.path.normcase(os.path.abspath(dir_path)))
+        self.seen_paths.update(os.path.normcase(os.path.abspath(item['path'])) for item in items)
+
+    def confirmed_gone(self, path):
+        path = os.path.normcase(os.path.abspath(path))
+        return os.path.dirname(path) in self.listed_dirs and path not in self.seen_paths
+
+
+def iter_work_items(directory_to_scan, max_workers=SCAN_WORKERS, excluded_paths=None, discovery=None):
+    """
+    Percorre a árvore de diretórios e produz itens de trabalho à medida
+    que são encontrados (sem esperar a varredura completa).
+    Com max_workers > 1 cada diretório é listado em uma thread do pool,
+    o que reduz bastante a latência em compartilhamentos de rede.
+    Com discovery (DiscoveryRecord), registra as pastas listadas e os arquivos vistos.
+    """
+    if excluded_paths is None:
+        excluded_paths = [JSON_OUTPUT_PATH]
+    excluded = {os.path.normcase(os.path.abspath(p)) for p in excluded_paths}
+
+    if max_workers <= 1:
+        pending_dirs = [directory_to_scan]
+        while pending_dirs:
+            dir_path = pending_dirs.pop()
+            subdirs, items, complete = _scan_directory(dir_path, excluded)
+            if discovery is not None:
+                discovery.add(dir_path, items, complete)
+            yield from items
+            pending_dirs.extend(reversed(subdirs))
         return
 
-    # Extração de texto
-    extracted_text = extraction_map[file_ext](file_path)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_scan_directory, directory_to_scan, excluded): directory_to_scan}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path = pending.pop(future)
+                subdirs, items, complete = future.result()
+                if discovery is not None:
+                    discovery.add(dir_path, items, complete)
+                for subdir in subdirs:
+                    pending[executor.submit(_scan_directory, subdir, excluded)] = subdir
+                yield from items
+
+
+# --- Isolamento de Workers (timeout e memória por arquivo) ---
 
-    if not extracted_text or not extracted_text.strip():
-        logging.warning(f"  -> Nenhum texto extraído de {filename}. JSON não será gerado.")
+class FileProcessingTimeout(Exception):
+    """Arquivo excedeu o tempo máximo de processamento"""
+
+
+class WorkerCrashedError(Exception):
+    """Worker terminou de forma inesperada (ex.: teto de memória excedido)"""
+
+
+def _apply_worker_memory_limit(memory_limit_mb):
+    """Aplica o teto de memória ao processo worker (e aos filhos, como o tesseract)"""
+    if not memory_limit_mb:
         return
+    try:
+        import resource
+    except ImportError:
+        return  # Windows: sem RLIMIT_AS, vale apenas o timeout
+    limit = memory_limit_mb * 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ValueError, OSError) as e:
+        logging.warning(f"Não foi possível aplicar o teto de memória de {memory_limit_mb} MB: {e}")
+
+
+def kill_process_tree(pid):
+    """
+    Encerra um processo e os filhos dele (tesseract do pytesseract,
+    soffice.bin do LibreOffice): o grupo de processos no POSIX, a árvore
+    (taskkill /T) no Windows.
+    """
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        return
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _archive_extract_prefix(pid):
+    return f"_temp_{pid}_"
+
+def _remove_worker_temp_dirs(pid):
+    """Pastas de extração deixadas por um worker encerrado à força"""
+    for path in glob.glob(os.path.join(ARCHIVE_EXTRACT_BASE, _archive_extract_prefix(pid) + '*')):
+        shutil.rmtree(path, ignore_errors=True)
+        logging.info(f"  -> Pasta temporária do worker encerrado removida: {path}")
+
+
+def _isolated_worker_main(conn, max_tasks, memory_limit_mb, initializer=None, initargs=(), log_conn=None):
+    """Laço do processo worker: executa tarefas recebidas pelo pipe até ser reciclado"""
+    if hasattr(os, 'setpgrp'):
+        # Grupo próprio: o pool encerra o worker junto com os processos que ele criou
+        os.setpgrp()
+    if log_conn is not None:
+        attach_log_pipe(log_conn)
+    _apply_worker_memory_limit(memory_limit_mb)
+    if initializer is not None:
+        initializer(*initargs)
+    completed = 0
+    while not max_tasks or completed < max_tasks:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        task_id, fn, args, kwargs = task
+        try:
+            conn.send((task_id, True, fn(*args, **kwargs)))
+        except BaseException as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(repr(e))
+            conn.send((task_id, False, e))
+        completed += 1
+    conn.close()
+    if log_conn is not None:
+        log_conn.close()
+
+
+class IsolatedProcessPool:
+    """
+    Pool de processos com isolamento por arquivo, compatível com submit()/Future.
+    Cada tarefa tem um tempo máximo: se excedido, o worker é encerrado, a
+    tarefa falha com FileProcessingTimeout e um novo worker é criado.
+    Workers são reciclados após max_tasks_per_worker arquivos.
+    Com o escritor de log ativo, cada worker recebe um pipe de log próprio,
+    lido pelo thread monitor e repassado ao escritor.
+    """
+
+    def __init__(self, max_workers, timeout=FILE_TIMEOUT_SECONDS,
+                 memory_limit_mb=WORKER_MEMORY_LIMIT_MB, max_tasks_per_worker=WORKER_MAX_TASKS,
+                 initializer=init_worker_runtime, initargs=None):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        # Por padrão os workers herdam ferramentas e logging do processo principal
+        self.initargs = initargs if initargs is not None else (current_runtime_settings(),)
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._context = multiprocessing.get_context()
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._workers = []
+        self._next_task_id = 0
+        self._shutdown = False
+
+        with self._lock:
+            for _ in range(max_workers):
+                self._spawn_worker()
+
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    def _spawn_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        log_conn = child_log_conn = None
+        if log_writer_active():
+            log_conn, child_log_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_isolated_worker_main,
+            args=(child_conn, self.max_tasks_per_worker, self.memory_limit_mb, self.initializer, self.initargs,
+                  child_log_conn),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        if child_log_conn is not None:
+            child_log_conn.close()
+        self._workers.append({
+            'process': process,
+            'conn': parent_conn,
+            'log_conn': log_conn,
+            'task': None,  # (task_id, future, prazo)
+            'tasks_done': 0,
+        })
+
+    @staticmethod
+    def _receive_log(worker):
+        """Repassa ao escritor os registros já recebidos no pipe de log do worker"""
+        log_conn = worker['log_conn']
+        if log_conn is None:
+            return
+        try:
+            while log_conn.poll():
+                forward_worker_log(log_conn.recv())
+        except (EOFError, OSError, pickle.UnpicklingError):
+            # Worker saiu (ou foi encerrado no meio de um envio): o pipe é descartado
+            log_conn.close()
+            worker['log_conn'] = None
+
+    def _retire_worker(self, worker, kill=False):
+        """
+        Remove o worker do pool e cria outro no lugar. Com kill (tempo
+        esgotado ou queda), encerra também os filhos ainda em execução (um
+        tesseract travado continuaria consumindo CPU e memória) e remove as
+        pastas temporárias de compactados que o worker deixou.
+        """
+        self._workers.remove(worker)
+        process = worker['process']
+        if kill:
+            kill_process_tree(process.pid)
+            if process.is_alive():
+                process.kill()
+        process.join(timeout=5)
+        worker['conn'].close()
+        self._receive_log(worker)
+        if worker['log_conn'] is not None:
+            worker['log_conn'].close()
+        if kill:
+            _remove_worker_temp_dirs(process.pid)
+        if not self._shutdown:
+            self._spawn_worker()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Pool já encerrado")
+            self._pending.append((future, fn, args, kwargs))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """Entrega tarefas pendentes aos workers ociosos (chamado com o lock)"""
+        for worker in self._workers:
+            if not self._pending:
+                return
+            if worker['task'] is not None:
+                continue
+            if self.max_tasks_per_worker and worker['tasks_done'] >= self.max_tasks_per_worker:
+                continue  # worker encerrando para reciclagem
+            future, fn, args, kwargs = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            try:
+                worker['conn'].send((task_id, fn, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            worker['task'] = (task_id, future, deadline)
+
+    def _handle_ready(self, worker):
+        try:
+            task_id, ok, payload = worker['conn'].recv()
+        except (EOFError, OSError):
+            # Worker saiu: reciclagem normal ou queda inesperada
+            if worker['task'] is not None:
+                _, future, _ = worker['task']
+                worker['process'].join(timeout=5)
+                exitcode = worker['process'].exitcode
+                future.set_exception(WorkerCrashedError(f"Worker terminou inesperadamente (código {exitcode})"))
+                self._retire_worker(worker, kill=True)
+                return
+            self._retire_worker(worker)
+            return
+
+        current = worker['task']
+        worker['task'] = None
+        worker['tasks_done'] += 1
+        if current is None or current[0] != task_id:
+            return
+        future = current[1]
+        if ok:
+            future.set_result(payload)
+        else:
+            future.set_exception(payload)
+
+    def _check_deadlines(self):
+        now = time.monotonic()
+        for worker in list(self._workers):
+            if worker['task'] is None:
+                continue
+            _, future, deadline = worker['task']
+            if deadline is not None and now > deadline:
+                worker['task'] = None
+                future.set_exception(FileProcessingTimeout(
+                    f"Tempo máximo de {self.timeout}s excedido"))
+                self._retire_worker(worker, kill=True)
+
+    def _monitor_loop(self):
+        while True:
+            with self._lock:
+                connections = [w['conn'] for w in self._workers]
+                connections += [w['log_conn'] for w in self._workers if w['log_conn'] is not None]
+            ready = wait_connections(connections, timeout=0.5) if connections else []
+
+            with self._lock:
+                for worker in list(self._workers):
+                    if worker['log_conn'] is not None and worker['log_conn'] in ready:
+                        self._receive_log(worker)
+                    if worker['conn'] in ready:
+                        self._handle_ready(worker)
+                self._check_deadlines()
+                self._dispatch()
+
+                idle = all(w['task'] is None for w in self._workers)
+                if self._shutdown and not self._pending and idle:
+                    for worker in self._workers:
+                        try:
+                            worker['conn'].send(None)
+                        except Exception:
+                            pass
+                    for worker in self._workers:
+                        worker['process'].join(timeout=5)
+                        if worker['process'].is_alive():
+                            kill_process_tree(worker['process'].pid)
+                            worker['process'].kill()
+                        worker['conn'].close()
+                        self._receive_log(worker)
+                        if worker['log_conn'] is not None:
+                            worker['log_conn'].close()
+                    self._workers = []
+                    return
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while self._pending:
+                    future, _, _, _ = self._pending.popleft()
+                    future.cancel()
+        if wait:
+            self._monitor.join()
+
+
+# --- Agendamento por Custo Estimado ---
+
+TEXT_EXTENSIONS = frozenset({'.txt', '.csv', '.xml', '.html', '.htm', '.ofx', '.oft', '.ofc', '.json', '.log'})
+OFFICE_EXTENSIONS = frozenset({'.docx', '.doc', '.xlsx', '.xls'})
+IMAGE_EXTENSIONS = frozenset({'.jpeg', '.jpg', '.png', '.tiff', '.tif', '.bmp', '.gif'})
+
+def _probe_image_frames(image_path):
+    """Número de quadros (páginas de TIFF/GIF) lido do cabeçalho, sem decodificar"""
+    if os.path.splitext(image_path)[1].lower() not in ('.tif', '.tiff', '.gif'):
+        return 1
+    try:
+        with Image.open(image_path) as img:
+            return min(getattr(img, 'n_frames', 1), IMAGE_MAX_FRAMES)
+    except Exception:
+        return 1
+
+def _probe_docx_media(docx_path, min_bytes=20 * 1024):
+    """Quantidade de imagens relevantes (não logotipos) embutidas no DOCX"""
+    try:
+        with zipfile.ZipFile(docx_path) as archive:
+            return sum(1 for info in archive.infolist()
+                       if info.filename.startswith('word/media/') and info.file_size >= min_bytes)
+    except Exception:
+        return 0
+
+def _probe_pdf(pdf_path):
+    """
+    Leitura barata do cabeçalho do PDF: número de páginas e se a primeira
+    página possui camada de texto. Não renderiza nada.
+    """
+    try:
+        with _open_pdf(pdf_path) as doc:
+            page_count = doc.page_count
+            has_text = page_count > 0 and len(doc.load_page(0).get_text().strip()) > 20
+        return page_count, has_text
+    except Exception:
+        return None, False
 
-    # Inicializa analisador de IA
-    ai_analyzer = IntelligentDocumentAnalyzer()
+def estimate_processing_cost(item):
+    """
+    Estima o custo de processamento de um item.
+    Retorna (classe, custo): classe 'fast' ou 'ocr'; custo em segundos aproximados.
+    """
+    file_ext = item['ext']
+    size_mb = item.get('size', 0) / (1024 * 1024)
+
+    if file_ext in TEXT_EXTENSIONS:
+        return 'fast', 0.01 + size_mb * 0.05
+    if file_ext == '.docx':
+        media_count = _probe_docx_media(item['path'])
+        if media_count:
+            return 'ocr', 3.0 * media_count + size_mb
+    if file_ext in OFFICE_EXTENSIONS:
+        return 'fast', 0.2 + size_mb * 0.5
+    if file_ext in IMAGE_EXTENSIONS:
+        return 'ocr', 3.0 * _probe_image_frames(item['path']) + size_mb
+    if file_ext == '.pdf':
+        page_count, has_text = _probe_pdf(item['path'])
+        if page_count is None:
+            return 'ocr', 5.0 + size_mb
+        if has_text:
+            return 'fast', 0.1 + page_count * 0.05
+        return 'ocr', 4.0 * max(1, page_count)
+    # Compactados: conteúdo desconhecido, vão para o pool pesado
+    return 'ocr', 2.0 + size_mb * 2
+
+
+class WorkScheduler:
+    """
+    Agendador com dois pools: arquivos baratos vão para o pool rápido e
+    o OCR pesado para um pool dedicado. Dentro de cada pool os itens de
+    menor custo estimado são executados primeiro.
+    """
+
+    def __init__(self, fast_workers=FAST_POOL_WORKERS, ocr_workers=OCR_POOL_WORKERS):
+        self.fast_workers = fast_workers
+        self.ocr_workers = ocr_workers
+
+    def _create_pool(self, max_workers):
+        return IsolatedProcessPool(max_workers=max_workers)
+
+    def run(self, work_items, handler=None):
+        """
+        Consome os itens (à medida que a descoberta os produz) e devolve
+        (item, resultado, erro) conforme cada tarefa termina.
+        Itens None são pulsos de fontes contínuas e apenas recolhem resultados.
+        """
+        handler = handler or process_work_item
+        pools = {
+            'fast': self._create_pool(self.fast_workers),
+            'ocr': self._create_pool(self.ocr_workers),
+        }
+        # Mantém poucas tarefas em voo por pool para que a prioridade tenha efeito
+        limits = {'fast': self.fast_workers * 2, 'ocr': self.ocr_workers * 2}
+        queues = {'fast': [], 'ocr': []}
+        running = {'fast': 0, 'ocr': 0}
+        in_flight = {}
+        sequence = 0
+
+        def fill_pools():
+            for klass, queue in queues.items():
+                while queue and running[klass] < limits[klass]:
+                    _, _, queued_item = heapq.heappop(queue)
+                    future = pools[klass].submit(handler, queued_item)
+                    in_flight[future] = (klass, queued_item)
+                    running[klass] += 1
+
+        def collect(futures):
+            for future in futures:
+                klass, done_item = in_flight.pop(future)
+                running[klass] -= 1
+                try:
+                    yield done_item, future.result(), None
+                except Exception as e:
+                    yield done_item, None, e
+
+        try:
+            for item in work_items:
+                if item is None:
+                    # Pulso de fontes contínuas (modo daemon): recolhe resultados e repõe os pools
+                    yield from collect([f for f in list(in_flight) if f.done()])
+                    fill_pools()
+                    continue
+                klass, cost = estimate_processing_cost(item)
+                heapq.heappush(queues[klass], (cost, sequence, item))
+                sequence += 1
+                fill_pools()
+                yield from collect([f for f in list(in_flight) if f.done()])
+
+            while in_flight or queues['fast'] or queues['ocr']:
+                fill_pools()
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True, cancel_futures=True)
+
+
+# --- Checkpoints para Retomada de Execuções ---
+
+class CheckpointJournal:
+    """
+    Diário durável (SQLite em modo WAL) dos itens concluídos.
+    Permite que uma execução com --resume pule o que já foi processado
+    e refaça apenas itens incompletos, inclusive membros de compactados.
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        # isolation_level=None: cada escrita é confirmada imediatamente
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            ' item_key TEXT PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' output_path TEXT,'
+            ' updated_at REAL NOT NULL)'
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(checkpoints)')]
+        if 'record' not in columns:
+            # Diários criados por versões anteriores
+            self._conn.execute('ALTER TABLE checkpoints ADD COLUMN record TEXT')
+
+    @staticmethod
+    def item_key(item):
+        """Chave estável de um arquivo: caminho + tamanho + data de modificação"""
+        path = os.path.normcase(os.path.abspath(item['path']))
+        return f"{path}|{item.get('size', 0)}|{int(item.get('mtime', 0))}"
+
+    @staticmethod
+    def member_key(archive_key, extract_dir, member_item):
+        """Chave de um arquivo extraído de um compactado"""
+        relative = os.path.relpath(member_item['path'], extract_dir).replace(os.sep, '/')
+        return f"{archive_key}::{relative}|{member_item.get('size', 0)}"
+
+    # Estados finais: não são refeitos no --resume (um arquivo que estourou
+    # o tempo máximo travaria de novo a execução retomada)
+    FINAL_STATUSES = ('done', 'timeout')
+
+    def is_done(self, item_key):
+        row = self._conn.execute(
+            'SELECT status FROM checkpoints WHERE item_key = ?', (item_key,)
+        ).fetchone()
+        return row is not None and row[0] in self.FINAL_STATUSES
+
+    def mark(self, item_key, status, output_path=None, records=None):
+        packed = json.dumps([r.pack() for r in records], ensure_ascii=False) if records else None
+        self._conn.execute(
+            'INSERT INTO checkpoints (item_key, status, output_path, updated_at, record) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(item_key) DO UPDATE SET status = excluded.status, '
+            'output_path = excluded.output_path, updated_at = excluded.updated_at, record = excluded.record',
+            (item_key, status, output_path, time.time(), packed)
+        )
+
+    def done_records(self, item_key):
+        """
+        Registros compactos de um item em estado final, incluindo os membros
+        concluídos quando ele é um compactado (semeiam o resumo no --resume),
+        ou None quando o item ainda precisa ser processado
+        """
+        row = self._conn.execute(
+            'SELECT status FROM checkpoints WHERE item_key = ?', (item_key,)
+        ).fetchone()
+        if row is None or row[0] not in self.FINAL_STATUSES:
+            return None
+        # Membros: chaves '<item>::...', ou seja, entre '<item>::' e '<item>:;' (usa a chave primária)
+        cursor = self._conn.execute(
+            "SELECT record FROM checkpoints WHERE status = 'done' AND record IS NOT NULL"
+            " AND (item_key = ? OR (item_key >= ? AND item_key < ?))",
+            (item_key, item_key + '::', item_key + ':;'))
+        return [ResultRecord.unpack(values) for (packed,) in cursor for values in json.loads(packed)]
+
+    def reset(self):
+        """Descarta checkpoints de execuções anteriores (execução completa)"""
+        self._conn.execute('DELETE FROM checkpoints')
+
+    def close(self):
+        self._conn.close()
+
+
+_checkpoint_journals = {}
+
+def get_checkpoint_journal(db_path):
+    """Conexão ao diário reaproveitada por processo do pool"""
+    journal = _checkpoint_journals.get(db_path)
+    if journal is None:
+        journal = CheckpointJournal(db_path)
+        _checkpoint_journals[db_path] = journal
+    return journal
+
+
+# --- Resumo da Execução ---
+
+def competence_to_int(competencia):
+    """'03/2024' -> 202403 (0 quando ausente ou inválida)"""
+    if not competencia:
+        return 0
+    try:
+        month, year = competencia.split('/')
+        month, year = int(month), int(year)
+    except ValueError:
+        return 0
+    return year * 100 + month if 1 <= month <= 12 else 0
+
+def int_to_competence(value):
+    return f"{value % 100:02d}/{value // 100}" if value else None
+
+def _months_between(first, last):
+    """Competências (AAAAMM) de first a last, inclusive"""
+    year, month = divmod(first, 100)
+    while year * 100 + month <= last:
+        yield year * 100 + month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+class ResultRecord:
+    """
+    Registro compacto de um arquivo processado, devolvido pelos workers ao
+    processo principal. A competência é guardada como inteiro AAAAMM.
+    Os campos de origem (caminho, hash, tempo...) alimentam o índice de
+    resultados; o diário de checkpoints guarda apenas os campos do resumo.
+    """
+
+    __slots__ = ('cliente', 'cnpj', 'tipo', 'competencia', 'duplicado',
+                 'source', 'agencia', 'conta', 'output_path', 'content_hash', 'duration')
+
+    def __init__(self, cliente, cnpj, tipo, competencia, duplicado=False, source=None,
+                 agencia=None, conta=None, output_path=None, content_hash=None, duration=0.0):
+        self.cliente = cliente
+        self.cnpj = cnpj
+        self.tipo = tipo
+        self.competencia = competencia
+        self.duplicado = duplicado
+        self.source = source
+        self.agencia = agencia
+        self.conta = conta
+        self.output_path = output_path
+        self.content_hash = content_hash
+        self.duration = duration
+
+    @classmethod
+    def from_result(cls, result_data, output_path=None, content_hash=None, duration=0.0):
+        return cls(result_data["Cliente_Pasta"], result_data["CNPJ"], result_data["Tipo_Arquivo"],
+                   competence_to_int(result_data["Mes_Competencia"]), "Duplicado_De" in result_data,
+                   result_data["Caminho_Original"], result_data["Agencia"], result_data["Conta"],
+                   output_path, content_hash, duration)
+
+    def pack(self):
+        return [self.cliente, self.cnpj, self.tipo, self.competencia, self.duplicado]
+
+    def pack_full(self):
+        """Todos os campos (resultado devolvido pela fila distribuída, que também alimenta o índice)"""
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def unpack(cls, values):
+        return cls(*values)
+
+
+class RunSummary:
+    """
+    Agregação incremental dos resultados da execução por cliente, tipo e
+    competência. Guarda apenas contadores (um por combinação distinta), de
+    modo que a memória não cresce com o número de arquivos.
+    """
+
+    def __init__(self):
+        self.counts = {}   # (cliente, tipo, competência) -> quantidade
+        self.clients = {}  # cliente -> {'cnpj', 'total', 'erros', 'duplicados'}
+        self.total = 0
+
+    def _client(self, cliente):
+        info = self.clients.get(cliente)
+        if info is None:
+            info = {'cnpj': None, 'total': 0, 'erros': 0, 'duplicados': 0}
+            self.clients[sys.intern(cliente)] = info
+        return info
+
+    def add(self, record):
+        cliente = sys.intern(record.cliente or '')
+        tipo = sys.intern(record.tipo or 'Não Classificado')
+        key = (cliente, tipo, record.competencia)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        info = self._client(cliente)
+        info['total'] += 1
+        if record.duplicado:
+            info['duplicados'] += 1
+        if record.cnpj and not info['cnpj']:
+            info['cnpj'] = record.cnpj
+        self.total += 1
+
+    def add_failure(self, cliente):
+        self._client(cliente or '')['erros'] += 1
+
+    def missing_competences(self):
+        """
+        Para cada cliente (todos os tipos) e cada par cliente/tipo, lista as
+        competências sem nenhum documento entre a primeira e a última encontradas.
+        """
+        present = {}
+        for (cliente, tipo, competencia), _ in self.counts.items():
+            if not competencia:
+                continue
+            present.setdefault((cliente, '*'), set()).add(competencia)
+            present.setdefault((cliente, tipo), set()).add(competencia)
+        rows = []
+        for (cliente, tipo), months in sorted(present.items()):
+            first, last = min(months), max(months)
+            missing = [m for m in _months_between(first, last) if m not in months]
+            rows.append({
+                "Cliente_Pasta": cliente,
+                "CNPJ": self.clients[cliente]['cnpj'],
+                "Tipo_Arquivo": 'TODOS' if tipo == '*' else tipo,
+                "Primeira_Competencia": int_to_competence(first),
+                "Ultima_Competencia": int_to_competence(last),
+                "Competencias_Presentes": len(months),
+                "Competencias_Faltantes": ';'.join(int_to_competence(m) for m in missing),
+            })
+        return rows
+
+    def count_rows(self):
+        for (cliente, tipo, competencia), quantidade in sorted(self.counts.items()):
+            info = self.clients[cliente]
+            yield {
+                "Cliente_Pasta": cliente,
+                "CNPJ": info['cnpj'],
+                "Tipo_Arquivo": tipo,
+                "Mes_Competencia": int_to_competence(competencia),
+                "Quantidade": quantidade,
+            }
+
+    def write(self, output_base=SUMMARY_OUTPUT_BASE, fmt=SUMMARY_FORMAT):
+        """
+        Grava <output_base>_contagens e <output_base>_faltantes (CSV ou Parquet).
+        Retorna a lista de arquivos gerados.
+        """
+        output_dir = os.path.dirname(output_base)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        tables = (('contagens', list(self.count_rows())), ('faltantes', self.missing_competences()))
+        written = []
+        for suffix, rows in tables:
+            path = f"{output_base}_{suffix}"
+            if fmt == 'parquet':
+                try:
+                    pd.DataFrame(rows).to_parquet(path + '.parquet', index=False)
+                    written.append(path + '.parquet')
+                    continue
+                except ImportError as e:
+                    logging.warning(f"Parquet indisponível ({e}); resumo gravado em CSV.")
+            with open(path + '.csv', 'w', newline='', encoding='utf-8-sig') as f:
+                fieldnames = list(rows[0].keys()) if rows else ["Cliente_Pasta"]
+                writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter=';')
+                writer.writeheader()
+                writer.writerows(rows)
+            written.append(path + '.csv')
+        return written
+
+    def log_report(self):
+        clients_with_gaps = [row for row in self.missing_competences()
+                             if row["Tipo_Arquivo"] == 'TODOS' and row["Competencias_Faltantes"]]
+        logging.info(f"Clientes no resumo: {len(self.clients)}", extra=LOG_SUMMARY)
+        logging.info(f"Clientes com competências faltantes: {len(clients_with_gaps)}", extra=LOG_SUMMARY)
+        for row in clients_with_gaps[:20]:
+            logging.info(f"  -> {row['Cliente_Pasta']}: faltam {row['Competencias_Faltantes']}", extra=LOG_SUMMARY)
+
+
+# --- Índice de Resultados ---
+
+class ResultIndex:
+    """
+    Índice SQLite (modo WAL) com um registro por documento processado.
+    A chave é o caminho de origem, de modo que execuções incrementais
+    atualizam o registro em vez de duplicá-lo. As escritas são feitas
+    apenas pelo processo principal, em lotes por transação.
+    """
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS resultados ('
+            ' caminho_original TEXT PRIMARY KEY,'
+            ' cnpj TEXT,'
+            ' cnpj_digitos TEXT,'
+            ' competencia INTEGER,'
+            ' tipo_arquivo TEXT,'
+            ' agencia TEXT,'
+            ' conta TEXT,'
+            ' cliente_pasta TEXT,'
+            ' duplicado INTEGER NOT NULL DEFAULT 0,'
+            ' caminho_json TEXT,'
+            ' hash_conteudo TEXT,'
+            ' tempo_segundos REAL,'
+            ' atualizado_em REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS idx_resultados_cnpj ON resultados (cnpj_digitos, competencia);'
+            'CREATE INDEX IF NOT EXISTS idx_resultados_cliente ON resultados (cliente_pasta, competencia);'
+            'CREATE INDEX IF NOT EXISTS idx_resultados_tipo ON resultados (tipo_arquivo, competencia);'
+            'CREATE INDEX IF NOT EXISTS idx_resultados_hash ON resultados (hash_conteudo);'
+        )
+
+    def upsert(self, records):
+        """Insere ou atualiza os registros (ResultRecord) em uma única transação"""
+        now = time.time()
+        rows = [
+            (r.source, r.cnpj, re.sub(r'\D', '', r.cnpj or '') or None, r.competencia or None, r.tipo,
+             r.agencia, r.conta, r.cliente, int(bool(r.duplicado)), r.output_path, r.content_hash,
+             r.duration, now)
+            for r in records if r.source
+        ]
+        if not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO resultados (caminho_original, cnpj, cnpj_digitos, competencia, tipo_arquivo,'
+                ' agencia, conta, cliente_pasta, duplicado, caminho_json, hash_conteudo, tempo_segundos,'
+                ' atualizado_em) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(caminho_original) DO UPDATE SET cnpj = excluded.cnpj,'
+                ' cnpj_digitos = excluded.cnpj_digitos, competencia = excluded.competencia,'
+                ' tipo_arquivo = excluded.tipo_arquivo, agencia = excluded.agencia, conta = excluded.conta,'
+                ' cliente_pasta = excluded.cliente_pasta, duplicado = excluded.duplicado,'
+                ' caminho_json = excluded.caminho_json, hash_conteudo = excluded.hash_conteudo,'
+                ' tempo_segundos = excluded.tempo_segundos, atualizado_em = excluded.atualizado_em',
+                rows)
+
+    @staticmethod
+    def origin_path(source):
+        """Arquivo em disco de um registro (sem membro de compactado nem intervalo de páginas)"""
+        return re.sub(r'#p\d+-\d+$', '', source.split('::', 1)[0])
+
+    def prune(self, older_than, discovery):
+        """
+        Remove registros não atualizados desde older_than cujo arquivo de
+        origem a descoberta confirmou ter sumido (DiscoveryRecord). Arquivos
+        ainda presentes que falharam, esgotaram o tempo ou não tinham texto,
+        e pastas que não puderam ser listadas, mantêm seus registros.
+        """
+        stale = [source for (source,) in self._conn.execute(
+            'SELECT caminho_original FROM resultados WHERE atualizado_em < ?', (older_than,))]
+        gone = [(source,) for source in stale if discovery.confirmed_gone(self.origin_path(source))]
+        with self._conn:
+            self._conn.executemany('DELETE FROM resultados WHERE caminho_original = ?', gone)
+        return len(gone)
+
+    def query(self, cnpj=None, competencia=None, tipo=None, cliente=None, limit=None):
+        """
+        Consulta por CNPJ (com ou sem pontuação), competência ('MM/AAAA'),
+        tipo e pasta do cliente (trechos, sem diferenciar maiúsculas).
+        """
+        conditions, params = [], []
+        if cnpj:
+            conditions.append('cnpj_digitos = ?')
+            params.append(re.sub(r'\D', '', cnpj))
+        if competencia:
+            conditions.append('competencia = ?')
+            params.append(competence_to_int(competencia))
+        if tipo:
+            conditions.append('tipo_arquivo LIKE ?')
+            params.append(f"%{tipo}%")
+        if cliente:
+            conditions.append('cliente_pasta LIKE ?')
+            params.append(f"%{cliente}%")
+        sql = ('SELECT cnpj, competencia, tipo_arquivo, agencia, conta, cliente_pasta,'
+               ' caminho_original, caminho_json, hash_conteudo, tempo_segundos FROM resultados')
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY cliente_pasta, competencia, tipo_arquivo'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        for row in self._conn.execute(sql, params):
+            yield {
+                "CNPJ": row[0],
+                "Mes_Competencia": int_to_competence(row[1]),
+                "Tipo_Arquivo": row[2],
+                "Agencia": row[3],
+                "Conta": row[4],
+                "Cliente_Pasta": row[5],
+                "Caminho_Original": row[6],
+                "Caminho_JSON": row[7],
+                "Hash_Conteudo": row[8],
+                "Tempo_Segundos": row[9],
+            }
+
+    def close(self):
+        self._conn.close()
+
+
+def run_index_query(index_path, cnpj=None, competencia=None, tipo=None, cliente=None,
+                    limit=None, output_format='tabela'):
+    """Consulta o índice de resultados e imprime as linhas encontradas"""
+    if not os.path.exists(index_path):
+        print(f"Índice não encontrado: {index_path}")
+        return 0
+    index = ResultIndex(index_path)
+    start_time = time.perf_counter()
+    rows = list(index.query(cnpj, competencia, tipo, cliente, limit))
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    index.close()
+
+    if output_format == 'json':
+        print(json.dumps(rows, indent=4, ensure_ascii=False))
+    else:
+        for row in rows:
+            print(f"{row['CNPJ'] or '-'}\t{row['Mes_Competencia'] or '-'}\t{row['Tipo_Arquivo']}\t"
+                  f"{row['Cliente_Pasta']}\t{row['Caminho_Original']}")
+        print(f"{len(rows)} registro(s) em {elapsed_ms:.1f} ms")
+    return len(rows)
+
+
+# --- Separação de Documentos em PDFs Concatenados ---
+
+# "Página 1 de 3", "Pág. 2/3", "Folha 1/2" (DANFE)
+PAGE_NUMBER_PATTERN = re.compile(
+    r'\b(?:p[áa]g(?:ina)?|folha|fl)\.?\s*:?\s*(\d{1,3})\s*(?:de|/)\s*(\d{1,3})\b', re.IGNORECASE)
+# Tipos em que cada página é um documento (ex.: vários boletos em sequência)
+SINGLE_PAGE_DOCUMENT_TYPES = {"Boleto de Pagamento"}
+
+def segment_pdf_pages(page_texts, ai_analyzer=None):
+    """
+    Agrupa páginas consecutivas em documentos lógicos.
+    Uma página inicia um novo documento quando traz "página 1 de N", quando
+    é de um tipo de página única, ou quando é classificada com um tipo
+    diferente do documento atual. Páginas sem classificação ou com
+    "página n de N" (n > 1) continuam o documento atual.
+    Retorna lista de (primeira_pagina, ultima_pagina_exclusiva).
+    """
+    ai_analyzer = ai_analyzer or get_document_analyzer()
+    segments = []
+    current_type = None
+
+    for index, page_text in enumerate(page_texts):
+        page_type = "Documento Não Classificado"
+        if page_text.strip():
+            page_type = ai_analyzer.classify_document_with_ai(page_text)
+        marker = PAGE_NUMBER_PATTERN.search(page_text)
+        classified = page_type != "Documento Não Classificado"
+
+        if not segments:
+            starts_new = True
+        elif marker:
+            starts_new = int(marker.group(1)) == 1
+        elif not classified:
+            starts_new = False
+        elif page_type in SINGLE_PAGE_DOCUMENT_TYPES:
+            starts_new = True
+        else:
+            starts_new = current_type is not None and page_type != current_type
+
+        if starts_new:
+            segments.append([index, index + 1])
+            current_type = page_type if classified else None
+        else:
+            segments[-1][1] = index + 1
+            if current_type is None and classified:
+                current_type = page_type
+
+    return [tuple(segment) for segment in segments]
+
+def analyze_pdf_segments(page_texts, segments, filename, client_folder_name):
+    """
+    Analisa cada documento lógico reaproveitando o texto já extraído por página.
+    Retorna a análise do primeiro documento acrescida de 'Segmentos'
+    (uma análise por documento, com o intervalo de 'Paginas').
+    """
+    segment_analyses = []
+    for start, end in segments:
+        segment_text = "".join(page_text + "\n" for page_text in page_texts[start:end] if page_text)
+        analysis = analyze_document_text(segment_text, filename, client_folder_name, log_steps=False)
+        analysis["Paginas"] = f"{start + 1}-{end}"
+        segment_analyses.append(analysis)
+        logging.info(f"  -> Páginas {analysis['Paginas']}: {analysis['Tipo_Arquivo']} "
+                     f"(Competência: {analysis['Mes_Competencia'] or 'Não encontrada'})")
+
+    combined = dict(segment_analyses[0])
+    combined["Segmentos"] = segment_analyses
+    return combined
+
+
+# --- Extração de Transações de Extratos Bancários ---
+
+STATEMENT_DATE_PATTERN = re.compile(r'^(\d{2})/(\d{2})(?:/(\d{2}|\d{4}))?$')
+STATEMENT_AMOUNT_PATTERN = re.compile(r'^\(?(-?)R?\$?\s*(\d{1,3}(?:\.\d{3})*|\d+),(\d{2})\)?\s*([-+]|[CD])?$')
+STATEMENT_COLUMNS = ("Data", "Descricao", "Valor", "Saldo", "Pagina")
+
+def _parse_statement_amount(token):
+    """'1.234,56-' / '(1.234,56)' / '1.234,56 D' -> -1234.56 (None se não for valor)"""
+    match = STATEMENT_AMOUNT_PATTERN.match(token)
+    if not match:
+        return None
+    sign, integer, cents, suffix = match.groups()
+    value = float(integer.replace('.', '') + '.' + cents)
+    if sign or suffix in ('-', 'D') or token.startswith('('):
+        value = -value
+    return value
+
+def _group_words_into_lines(words):
+    """Agrupa palavras (x0, y0, x1, y1, texto) em linhas pela posição vertical"""
+    if not words:
+        return []
+    heights = sorted(w[3] - w[1] for w in words)
+    tolerance = max(heights[len(heights) // 2] * 0.5, 1.0)
+    lines = []
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        center = (word[1] + word[3]) / 2
+        if lines and abs(center - lines[-1][0]) <= tolerance:
+            lines[-1][1].append(word)
+        else:
+            lines.append([center, [word]])
+    return [sorted(line_words, key=lambda w: w[0]) for _, line_words in lines]
+
+def _merge_amount_tokens(line_words):
+    """Junta tokens separados pelo OCR/PDF, como '1.234,56' + '-' ou 'R$' + '10,00'"""
+    merged = []
+    for word in line_words:
+        if merged and word[4] in ('-', '+', 'C', 'D') and _parse_statement_amount(merged[-1][4]) is not None:
+            previous = merged[-1]
+            merged[-1] = (previous[0], previous[1], word[2], previous[3], previous[4] + word[4])
+            continue
+        if merged and merged[-1][4] in ('R$', '-R$') and _parse_statement_amount(word[4]) is not None:
+            previous = merged[-1]
+            merged[-1] = (previous[0], previous[1], word[2], word[3], previous[4].replace('R$', '') + word[4])
+            continue
+        merged.append(word)
+    return merged
+
+
+class StatementTableParser:
+    """
+    Reconstrói as linhas de transação (data, descrição, valor, saldo) a partir
+    das palavras posicionadas de cada página. Um cabeçalho com 'Saldo' e
+    'Débito'/'Crédito' define as colunas por posição horizontal; sem ele, o
+    último valor da linha é o saldo quando há dois valores.
+    Mantém apenas a transação em andamento (descrições em várias linhas).
+    """
+
+    def __init__(self, year_hint=None):
+        self.year_hint = year_hint
+        self.columns = {}   # 'saldo' / 'debito' / 'credito' -> centro x
+        self.last_date = None
+        self._pending = None
+
+    def _detect_header(self, line_words):
+        found = {}
+        for word in line_words:
+            token = word[4].lower().strip(':')
+            center = (word[0] + word[2]) / 2
+            if token == 'saldo':
+                found['saldo'] = center
+            elif token in ('débito', 'debito', 'débitos', 'debitos', 'saída', 'saida'):
+                found['debito'] = center
+            elif token in ('crédito', 'credito', 'créditos', 'creditos', 'entrada'):
+                found['credito'] = center
+            elif token == 'valor':
+                found['valor'] = center
+        if 'saldo' in found and len(found) >= 2:
+            self.columns = found
+            return True
+        return False
+
+    def _nearest_column(self, center):
+        if not self.columns:
+            return None
+        name, column_center = min(self.columns.items(), key=lambda item: abs(item[1] - center))
+        return name
+
+    def _normalize_date(self, match):
+        day, month, year = match.groups()
+        if year is None:
+            year = self.year_hint
+        elif len(year) == 2:
+            year = '20' + year
+        return f"{day}/{month}/{year}" if year else f"{day}/{month}"
+
+    def _flush(self):
+        row, self._pending = self._pending, None
+        return row
+
+    def feed_page(self, words, page_number):
+        """Processa as palavras de uma página e produz as transações concluídas"""
+        for line_words in _group_words_into_lines(words):
+            line_words = _merge_amount_tokens(line_words)
+            if self._detect_header(line_words):
+                continue
+
+            date = None
+            description = []
+            amounts = []
+            for position, word in enumerate(line_words):
+                token = word[4]
+                date_match = STATEMENT_DATE_PATTERN.match(token)
+                if position == 0 and date_match:
+                    date = self._normalize_date(date_match)
+                    continue
+                value = _parse_statement_amount(token)
+                if value is not None:
+                    amounts.append((value, (word[0] + word[2]) / 2))
+                else:
+                    description.append(token)
+
+            description = " ".join(description).strip()
+            if not amounts:
+                # Continuação da descrição da transação anterior
+                if self._pending is not None and description and date is None:
+                    self._pending["Descricao"] = f"{self._pending['Descricao']} {description}".strip()
+                continue
+            if date is None and self.last_date is None:
+                continue  # Valores antes da primeira transação (resumos, totais do cabeçalho)
+
+            if date is not None:
+                self.last_date = date
+            row = {"Data": date or self.last_date, "Descricao": description,
+                   "Valor": None, "Saldo": None, "Pagina": page_number}
+            for value, center in amounts:
+                column = self._nearest_column(center)
+                if column == 'saldo':
+                    row["Saldo"] = value
+                elif column == 'debito':
+                    row["Valor"] = -abs(value)
+                elif column == 'credito' or column is not None:
+                    row["Valor"] = value
+            if not self.columns:
+                if len(amounts) >= 2:
+                    row["Valor"], row["Saldo"] = amounts[-2][0], amounts[-1][0]
+                elif 'saldo' in description.lower():
+                    row["Saldo"] = amounts[0][0]
+                else:
+                    row["Valor"] = amounts[0][0]
+
+            previous = self._flush()
+            if previous is not None:
+                yield previous
+            self._pending = row
+
+    def finish(self):
+        row = self._flush()
+        if row is not None:
+            yield row
+
+
+def _iter_statement_page_words(source, pages=None, zoom=2, page_words=None):
+    """
+    Palavras posicionadas de cada página, uma página por vez: camada de texto
+    do PyMuPDF quando existe, as palavras já reconhecidas na análise
+    (page_words, por índice base 0), senão OCR com caixas (páginas em paralelo).
+    Produz (número_da_página, palavras).
+    """
+    page_words = page_words or {}
+    file_ext = os.path.splitext(_source_name(source))[1].lower()
+    document_ocr = DocumentOCR()
+
+    def ocr_words(img):
+        # Caixas em pontos da página, como as da camada de texto: as colunas do
+        # cabeçalho continuam válidas nas páginas seguintes, seja qual for a origem
+        page_size = page_size_points(img)
+        img = document_ocr.upright(img)
+        img = preprocess_image_for_ocr(img) or img
+        return words_to_page_points(document_ocr.image_to_words(img, config='--psm 6'), img.size, page_size)
+
+    def ocr_or_known(img):
+        return ocr_words(img) if img is not None else None
+
+    if file_ext in IMAGE_EXTENSIONS:
+        with Image.open(_rewind(source)) as img:
+            frames = iter_image_frames(img)
+            if pages is not None:
+                wanted = set(pages)
+                frames = ((index, frame) for index, frame in frames if index in wanted)
+            frames = ((index, None if index in page_words else frame) for index, frame in frames)
+            for index, words in iter_page_ocr(frames, ocr_or_known):
+                yield index + 1, words if words is not None else page_words[index]
+        return
+
+    with _open_pdf(source) as doc:
+        page_numbers = pages if pages is not None else range(doc.page_count)
+        text_pages = {}
+
+        def pages_to_ocr():
+            for page_num in page_numbers:
+                page = doc.load_page(page_num)
+                words = page.get_text("words")
+                if len(words) > 5:
+                    text_pages[page_num] = [(w[0], w[1], w[2], w[3], w[4]) for w in words]
+                    yield page_num, None
+                    continue
+                if page_num in page_words:
+                    text_pages[page_num] = page_words[page_num]
+                    yield page_num, None
+                    continue
+                yield page_num, render_page_for_ocr(doc, page, zoom)
+
+        for page_num, words in iter_page_ocr(pages_to_ocr(), ocr_or_known):
+            if words is None:
+                words = text_pages.pop(page_num)
+            yield page_num + 1, words
+
+def extract_statement_transactions(source, pages=None, year_hint=None, page_words=None):
+    """
+    Gera as transações de um extrato (PDF ou imagem) como dicionários com
+    Data, Descricao, Valor, Saldo e Pagina, página a página, sem manter o
+    documento inteiro em memória. pages restringe a um intervalo (base 0);
+    page_words reaproveita as palavras do OCR feito na análise.
+    """
+    parser = StatementTableParser(year_hint)
+    for page_number, words in _iter_statement_page_words(source, pages, page_words=page_words):
+        yield from parser.feed_page(words, page_number)
+    yield from parser.finish()
+
+def write_statement_transactions(source, csv_path, pages=None, year_hint=None, page_words=None):
+    """Grava as transações do extrato em CSV à medida que são extraídas; retorna a quantidade"""
+    count = 0
+    with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=STATEMENT_COLUMNS, delimiter=';')
+        writer.writeheader()
+        for row in extract_statement_transactions(source, pages, year_hint, page_words):
+            writer.writerow(row)
+            count += 1
+    if count == 0:
+        os.remove(csv_path)
+    return count
+
+
+# --- Perfil de Desempenho (--profile) ---
+
+def configure_profiling(output_dir=None, slow_seconds=None, memory_mb=None):
+    """Ativa o perfil por arquivo (repassado aos processos worker)"""
+    _runtime_settings['profile'] = {
+        'output_dir': output_dir or PROFILE_OUTPUT_DIR,
+        'slow_seconds': PROFILE_SLOW_SECONDS if slow_seconds is None else slow_seconds,
+        'memory_mb': PROFILE_MEMORY_MB if memory_mb is None else memory_mb,
+    }
+
+def profile_base_name(file_path):
+    """Nome dos arquivos de perfil: nome do documento + identificador estável do caminho"""
+    base_name = re.sub(r'[^\w\-_.]', '_', os.path.splitext(os.path.basename(file_path))[0])
+    return f"{base_name}_{stable_output_id(file_path)}"
+
+@contextmanager
+def profile_file(file_path):
+    """
+    Mede tempo (cProfile) e pico de memória (tracemalloc) do processamento de
+    um arquivo. Só grava o perfil (.prof) e os principais locais de alocação
+    (.json) quando o arquivo passa de um dos limites configurados. O cProfile
+    cobre apenas a thread chamadora: o OCR paralelo de páginas aparece como
+    espera em future.result(). O tracemalloc não enxerga buffers alocados
+    fora do Python (imagens do Pillow, pixmaps do PyMuPDF).
+    """
+    settings = _runtime_settings.get('profile')
+    if not settings:
+        yield
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(PROFILE_TRACEBACK_FRAMES)
+    tracemalloc.reset_peak()
+    sampler = _PeakSnapshotSampler()
+    sampler.start()
+    profiler = cProfile.Profile()
+    start_time = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start_time
+        sampler.stop()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_mb = peak / (1024 * 1024)
+        try:
+            if elapsed >= settings['slow_seconds'] or peak_mb >= settings['memory_mb']:
+                _save_file_profile(settings['output_dir'], file_path, profiler, elapsed, peak_mb,
+                                   sampler.peak_snapshot())
+        except Exception as e:
+            logging.warning(f"  -> Falha ao gravar o perfil de {file_path}: {e}")
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+class _PeakSnapshotSampler:
+    """
+    Thread que amostra a memória rastreada e guarda o snapshot do tracemalloc
+    tirado com mais memória em uso: ao fim do arquivo, a maior parte do que
+    causou o pico já foi liberada.
+    """
+    __slots__ = ('_stop', '_thread', '_snapshot', '_snapshot_size')
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='perfil-memoria', daemon=True)
+        self._snapshot = None
+        self._snapshot_size = 0
+
+    def _sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self._snapshot_size:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._snapshot_size = current
+
+    def _run(self):
+        while not self._stop.wait(PROFILE_SNAPSHOT_INTERVAL):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def peak_snapshot(self):
+        self._sample()
+        return self._snapshot
+
+def _allocation_sites(snapshot, limit=PROFILE_TOP_ALLOCATIONS):
+    """Principais locais de alocação do snapshot: [arquivo:linha, bytes, blocos]"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    sites = []
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        sites.append([f"{frame.filename}:{frame.lineno}", stat.size, stat.count])
+    return sites
+
+def _save_file_profile(output_dir, file_path, profiler, elapsed, peak_mb, snapshot):
+    os.makedirs(output_dir, exist_ok=True)
+    base_path = os.path.join(output_dir, profile_base_name(file_path))
+    profiler.dump_stats(base_path + '.prof')
+    details = {
+        'arquivo': file_path,
+        'segundos': round(elapsed, 3),
+        'pico_mb': round(peak_mb, 1),
+        'alocacoes': _allocation_sites(snapshot),
+    }
+    tmp_path = f"{base_path}.json.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(details, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, base_path + '.json')
+    logging.info(f"  -> Perfil gravado ({elapsed:.1f}s, pico {peak_mb:.0f} MB): {base_path}.prof")
+
+def reset_profile_dir(output_dir=None):
+    """Remove perfis de execuções anteriores (o relatório cobre apenas a execução atual)"""
+    output_dir = output_dir or PROFILE_OUTPUT_DIR
+    for pattern in ('*.prof', '*.json', '*.folded', '*.txt'):
+        for path in glob.glob(os.path.join(output_dir, pattern)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _function_label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name  # funções embutidas: '<built-in method ...>'
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def folded_stacks(stats, min_seconds=0.0001, max_depth=64):
+    """
+    Converte um pstats.Stats em pilhas no formato 'a;b;c <microssegundos>'
+    (flamegraph.pl, speedscope, inferno). O cProfile guarda apenas pares
+    chamador/chamado, então o tempo de cada função é repartido entre os
+    caminhos pela fração de tempo acumulado de cada chamador.
+    """
+    entries = stats.stats
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+    stacks = Counter()
+
+    def walk(func, path, scale):
+        _, _, self_time, cumulative, _ = entries[func]
+        path = path + (_function_label(func),)
+        if self_time * scale > 0:
+            stacks[';'.join(path)] += self_time * scale
+        if len(path) >= max_depth:
+            return
+        for callee, edge_time in callees.get(func, {}).items():
+            callee_total = entries[callee][3]
+            if callee_total <= 0 or _function_label(callee) in path:
+                continue
+            callee_scale = scale * min(1.0, edge_time / callee_total)
+            if callee_total * callee_scale >= min_seconds:
+                walk(callee, path, callee_scale)
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(func, (), 1.0)
+    return [(stack, int(seconds * 1_000_000)) for stack, seconds in stacks.most_common()
+            if seconds * 1_000_000 >= 1]
+
+def write_profile_report(output_dir=None, top_allocations=PROFILE_TOP_ALLOCATIONS):
+    """
+    Mescla os perfis mantidos na execução: perfil_mesclado.prof (pstats/snakeviz),
+    perfil_mesclado.folded (flame graph) e perfil_relatorio.txt (arquivos
+    perfilados, funções mais caras e principais locais de alocação).
+    Retorna o caminho do relatório ou None se nenhum arquivo passou dos limites.
+    """
+    output_dir = output_dir or PROFILE_OUTPUT_DIR
+    prof_paths = sorted(path for path in glob.glob(os.path.join(output_dir, '*.prof'))
+                        if os.path.basename(path) != 'perfil_mesclado.prof')
+    if not prof_paths:
+        logging.info("Perfil: nenhum arquivo passou dos limites de tempo/memória.", extra=LOG_SUMMARY)
+        return None
+
+    merged = pstats.Stats(prof_paths[0])
+    for path in prof_paths[1:]:
+        merged.add(path)
+    merged.dump_stats(os.path.join(output_dir, 'perfil_mesclado.prof'))
+    with open(os.path.join(output_dir, 'perfil_mesclado.folded'), 'w', encoding='utf-8') as f:
+        for stack, microseconds in folded_stacks(merged):
+            f.write(f"{stack} {microseconds}\n")
+
+    profiled_files = []
+    allocations = defaultdict(lambda: [0, 0])
+    for path in prof_paths:
+        try:
+            with open(os.path.splitext(path)[0] + '.json', encoding='utf-8') as f:
+                details = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiled_files.append(details)
+        for site, size, count in details['alocacoes']:
+            allocations[site][0] += size
+            allocations[site][1] += count
+    profiled_files.sort(key=lambda d: d['segundos'], reverse=True)
+    top_sites = heapq.nlargest(top_allocations, allocations.items(), key=lambda item: item[1][0])
+
+    report_path = os.path.join(output_dir, 'perfil_relatorio.txt')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write("=== ARQUIVOS PERFILADOS ===\n")
+        for details in profiled_files:
+            f.write(f"{details['segundos']:>10.2f}s {details['pico_mb']:>8.1f} MB  {details['arquivo']}\n")
+        f.write("\n=== FUNÇÕES (tempo acumulado) ===\n")
+        merged.stream = f
+        merged.files = []  # omite a lista de .prof no cabeçalho do pstats
+        merged.sort_stats('cumulative').print_stats(40)
+        f.write("\n=== PRINCIPAIS LOCAIS DE ALOCAÇÃO (soma dos picos por arquivo) ===\n")
+        for site, (size, count) in top_sites:
+            f.write(f"{size / (1024 * 1024):>10.1f} MB {count:>10} blocos  {site}\n")
+
+    logging.info(f"Perfil: {len(prof_paths)} arquivo(s) acima dos limites; relatório em {report_path}",
+                 extra=LOG_SUMMARY)
+    return report_path
+
+
+# --- FUNÇÃO PRINCIPAL CORRIGIDA ---
+
+def analyze_document_text(extracted_text, filename, client_folder_name, log_steps=True):
+    """
+    Executa a análise de IA sobre o texto extraído.
+    Retorna dicionário com CNPJ, competência, tipo, agência e conta.
+    """
+    log_info = logging.info if log_steps else logging.debug
+
+    # Chave de acesso válida de NF-e/CT-e: tipo, competência e CNPJ saem da própria chave
+    key_info = find_access_key(extracted_text)
+    if key_info:
+        log_info(f"  -> Chave de acesso válida ({key_info['tipo_arquivo']}, modelo {key_info['modelo']}): "
+                 f"{key_info['chave']}")
+        return analysis_from_access_key(key_info, client_folder_name)
+
+    # Linha digitável válida: boleto com competência pelo vencimento codificado
+    boleto_info = find_boleto_line(extracted_text)
+    if boleto_info and boleto_info['vencimento']:
+        log_info(f"  -> Linha digitável válida (vencimento {boleto_info['vencimento']}, "
+                 f"valor {boleto_info['valor']:.2f})")
+        return analysis_from_boleto(boleto_info, client_folder_name, extracted_text)
+
+    ai_analyzer = get_document_analyzer()
     cnpj_validator = CNPJValidator()
 
     # EXTRAÇÃO INTELIGENTE DE CNPJ - CORRIGIDA
-    logging.info(f"  -> Iniciando extração de CNPJ...")
+    log_info(f"  -> Iniciando extração de CNPJ...")
 
     # Primeira tentativa: extrair do documento
     final_cnpj = cnpj_validator.extract_and_validate_cnpj(extracted_text)
 
     if final_cnpj:
-        logging.info(f"  -> SUCESSO: CNPJ encontrado no documento: {final_cnpj}")
+        log_info(f"  -> SUCESSO: CNPJ encontrado no documento: {final_cnpj}")
     else:
-        logging.info(f"  -> CNPJ não encontrado no documento. Tentando extrair da pasta...")
+        log_info(f"  -> CNPJ não encontrado no documento. Tentando extrair da pasta...")
 
         # Segunda tentativa: extrair da pasta do cliente
         folder_cnpj = extract_cnpj_from_folder_name(client_folder_name)
 
         if folder_cnpj:
             final_cnpj = folder_cnpj
-            logging.info(f"  -> SUCESSO: CNPJ extraído da pasta: {final_cnpj}")
+            log_info(f"  -> SUCESSO: CNPJ extraído da pasta: {final_cnpj}")
         else:
-            logging.warning(f"  -> AVISO: CNPJ não encontrado no documento nem na pasta.")
+            if log_steps:
+                logging.warning(f"  -> AVISO: CNPJ não encontrado no documento nem na pasta.")
             final_cnpj = None
 
     # Extração inteligente de competência
@@ -1020,102 +4869,1543 @@ def process_and_save_file_data(file_path, filename, client_folder_name):
     # Extração de agência e conta
     agencia, conta = extract_agency_account(extracted_text)
 
-    # CRIAÇÃO DO JSON - REMOVENDO OS CAMPOS SOLICITADOS
-    result_data = {
+    return {
         "CNPJ": final_cnpj,
         "Mes_Competencia": competencia,
         "Tipo_Arquivo": tipo_arquivo,
-        "Caminho_Original": file_path,
         "Agencia": agencia,
         "Conta": conta,
+    }
+
+def _is_analysis_resolved(analysis):
+    """Verdadeiro quando tipo, competência e CNPJ já foram determinados"""
+    return (analysis["Tipo_Arquivo"] != "Documento Não Classificado"
+            and analysis["Mes_Competencia"] is not None
+            and analysis["CNPJ"] is not None)
+
+def _build_result_data(analysis, source, client_folder_name):
+    # CRIAÇÃO DO JSON - REMOVENDO OS CAMPOS SOLICITADOS
+    result_data = {
+        "CNPJ": analysis["CNPJ"],
+        "Mes_Competencia": analysis["Mes_Competencia"],
+        "Tipo_Arquivo": analysis["Tipo_Arquivo"],
+        "Caminho_Original": source,
+        "Agencia": analysis["Agencia"],
+        "Conta": analysis["Conta"],
         "Cliente_Pasta": client_folder_name
         # REMOVIDOS conforme solicitado: "Qualidade_Extracao", "Timestamp_Processamento", "Tamanho_Texto_Extraido"
     }
+    if analysis.get("Chave_Acesso"):
+        result_data["Chave_Acesso"] = analysis["Chave_Acesso"]
+    if analysis.get("Boleto"):
+        result_data["Boleto"] = analysis["Boleto"]
+    if analysis.get("Paginas"):
+        result_data["Paginas"] = analysis["Paginas"]
+    if analysis.get("Segmentos"):
+        result_data["Segmentos"] = [_build_result_data(segment, source, client_folder_name)
+                                    for segment in analysis["Segmentos"]]
+    return result_data
+
+def analyze_file(file_path, filename, client_folder_name, full_text=False, use_registry=None, header_first=None,
+                 page_words=None):
+    """
+    Extração e análise de um arquivo, sem gravar nada em disco.
+    Retorna (registro, entrada_de_duplicados) ou (None, None) quando não há texto.
+    A entrada de duplicados deve ser registrada após salvar o resultado; a de
+    uma cópia idêntica ('duplicate': True) traz só o hash de conteúdo e não é
+    registrada.
+    Com full_text=True, PDFs escaneados sempre passam pelo OCR completo.
+    Com page_words (dicionário), o OCR completo de PDFs e imagens guarda as
+    palavras posicionadas de cada página, usadas depois pela exportação de
+    extratos sem novo OCR. Nesse caso, um extrato identificado pelo cabeçalho
+    não usa o atalho do cabeçalho: o OCR completo, que a exportação faria de
+    qualquer forma, passa a servir às duas etapas.
+    """
+    logging.info(f"Processando arquivo: {filename} (Cliente: {client_folder_name})")
+
+    file_ext = os.path.splitext(filename)[1].lower()
+
+    if file_ext not in EXTRACTION_MAP:
+        logging.warning(f"  -> Tipo de arquivo '{file_ext}' não suportado. Arquivo ignorado: {filename}")
+        return None, None
+
+    analysis = None
+    duplicate = similar = None
+    content_hash = phash = minhash = None
+    page_count, has_text = _probe_pdf(file_path) if file_ext == '.pdf' else (None, False)
+
+    # Duplicados: cópias idênticas do mesmo cliente reaproveitam o primeiro resultado;
+    # quase-duplicados (hash perceptual antes do OCR, MinHash do texto depois dele)
+    # também são marcados, mas reaproveitam só a classificação
+    if use_registry is None:
+        use_registry = DEDUP_ENABLED
+    if header_first is None:
+        header_first = PDF_HEADER_FIRST
+    registry = get_duplicate_registry(DEDUP_DB_PATH) if use_registry else None
+    if registry:
+        content_hash = compute_content_hash(file_path)
+        duplicate = registry.find_exact(content_hash, client_folder_name, file_path)
+        if duplicate is None and (file_ext in IMAGE_EXTENSIONS or (file_ext == '.pdf' and not has_text)):
+            phash = compute_perceptual_hash(file_path, file_ext)
+            if phash is not None:
+                similar = registry.find_similar_image(phash, client_folder_name, file_path)
+                if similar is not None:
+                    logging.info(f"  -> Imagem semelhante a: {similar['source_path']}. "
+                                 f"Competência e CNPJ serão lidos desta cópia.")
+
+    # Imagem ou PDF escaneado de uma página: código de barras de boleto lido sem OCR
+    if (duplicate is None and BOLETO_BARCODE_ENABLED and not full_text
+            and (file_ext in IMAGE_EXTENSIONS or (file_ext == '.pdf' and page_count == 1 and not has_text))):
+        boleto_info = read_boleto_barcode_from_file(file_path, file_ext)
+        if boleto_info and boleto_info['vencimento']:
+            logging.info(f"  -> Código de barras de boleto lido (vencimento {boleto_info['vencimento']}); OCR dispensado.")
+            analysis = analysis_from_boleto(boleto_info, client_folder_name)
+
+    # PDF com várias páginas pode conter vários documentos (análise por página)
+    split_pdf = file_ext == '.pdf' and PDF_SPLIT_DOCUMENTS and (page_count or 0) > 1
+
+    # PDF escaneado: tenta resolver pelo cabeçalho da página 1 (OCR rápido)
+    if duplicate is None and analysis is None and file_ext == '.pdf' and header_first and not full_text:
+        if page_count and not has_text:
+            header_text = extract_header_text_from_pdf(file_path)
+            if header_text.strip():
+                header_analysis = analyze_document_text(header_text, filename, client_folder_name, log_steps=False)
+                _classify_from_similar(header_analysis, similar)
+                if page_words is not None and header_analysis["Tipo_Arquivo"] == "Extrato Bancário":
+                    logging.info("  -> Extrato identificado pelo cabeçalho; OCR completo com posições "
+                                 "(reaproveitado na exportação das transações).")
+                elif _is_analysis_resolved(header_analysis):
+                    # Página 1 não resolvida dispensa a sondagem: o OCR completo segmenta pelo texto
+                    if split_pdf and _may_be_pdf_bundle(file_path, header_text, header_analysis, page_count):
+                        logging.info("  -> PDF pode reunir vários documentos; OCR completo por página.")
+                    else:
+                        logging.info(f"  -> Classificação resolvida pelo cabeçalho da página 1; OCR completo dispensado ({page_count} página(s)).")
+                        analysis = header_analysis
+
+    # XML de NF-e/CT-e: chave de acesso lida direto das tags, sem parsear o documento
+    if duplicate is None and analysis is None and file_ext == '.xml':
+        key_info = find_access_key_in_xml(_read_source_bytes(file_path))
+        if key_info:
+            logging.info(f"  -> Chave de acesso no XML ({key_info['tipo_arquivo']}): {key_info['chave']}")
+            analysis = analysis_from_access_key(key_info, client_folder_name)
+
+    if duplicate is None and analysis is None:
+        # Extração de texto
+        if split_pdf:
+            page_texts = extract_pdf_pages_text(file_path, page_words)
+            extracted_text = "".join(page_text + "\n" for page_text in page_texts if page_text)
+        elif page_words is not None and (file_ext == '.pdf' or file_ext in IMAGE_EXTENSIONS):
+            extracted_text = EXTRACTION_MAP[file_ext](file_path, page_words=page_words)
+        else:
+            extracted_text = EXTRACTION_MAP[file_ext](file_path)
+
+        if not extracted_text or not extracted_text.strip():
+            logging.warning(f"  -> Nenhum texto extraído de {filename}. JSON não será gerado.")
+            return None, None
+
+        segments = segment_pdf_pages(page_texts) if split_pdf else []
+        if len(segments) > 1:
+            logging.info(f"  -> PDF contém {len(segments)} documentos; um registro por documento.")
+            analysis = analyze_pdf_segments(page_texts, segments, filename, client_folder_name)
+        else:
+            if registry:
+                minhash = compute_text_minhash(extracted_text)
+                if similar is None and minhash is not None:
+                    similar = registry.find_similar_text(minhash, client_folder_name, file_path)
+                    if similar is not None:
+                        logging.info(f"  -> Texto semelhante a: {similar['source_path']}. "
+                                     f"Competência e CNPJ serão lidos desta cópia.")
+            analysis = analyze_document_text(extracted_text, filename, client_folder_name)
+            _classify_from_similar(analysis, similar)
+
+    if duplicate is not None:
+        logging.info(f"  -> DUPLICADO ({duplicate['match']}) de: {duplicate['source_path']}. Resultado reaproveitado.")
+        analysis = duplicate['analysis']
+
+    source = file_path if isinstance(file_path, str) else _source_name(file_path)
+    result_data = _build_result_data(analysis, source, client_folder_name)
+    if duplicate is not None:
+        result_data["Duplicado_De"] = duplicate['source_path']
+        for segment in result_data.get("Segmentos", []):
+            segment["Duplicado_De"] = duplicate['source_path']
+        # O hash já calculado segue junto: o arquivo não é lido de novo para o resumo/índice
+        return result_data, {'content_hash': content_hash, 'duplicate': True}
+    if similar is not None and "Segmentos" not in result_data:
+        # Quase-duplicado: marcado como cópia, com competência e CNPJ da própria cópia
+        logging.info(f"  -> DUPLICADO ({similar['match']}) de: {similar['source_path']}. Só o tipo foi reaproveitado.")
+        result_data["Duplicado_De"] = similar['source_path']
+
+    dedup_entry = None
+    if registry:
+        dedup_entry = {'content_hash': content_hash, 'analysis': analysis, 'phash': phash, 'minhash': minhash}
+    return result_data, dedup_entry
+
+def _may_be_pdf_bundle(pdf_path, first_header, first_analysis, page_count):
+    """
+    PDF escaneado com a página 1 resolvida pelo cabeçalho: verdadeiro quando
+    pode reunir vários documentos. "Página 1 de N" cobrindo o PDF confirma um
+    documento só sem ler as demais páginas; um tipo de página única (boleto)
+    ou mais de PDF_SEGMENT_PROBE_MAX_PAGES páginas vai direto ao OCR completo.
+    Nos demais casos, os cabeçalhos das outras páginas são lidos e segmentados.
+    """
+    marker = PAGE_NUMBER_PATTERN.search(first_header)
+    if marker and int(marker.group(1)) == 1 and int(marker.group(2)) >= page_count:
+        return False
+    if first_analysis["Tipo_Arquivo"] in SINGLE_PAGE_DOCUMENT_TYPES or page_count > PDF_SEGMENT_PROBE_MAX_PAGES:
+        return True
+    header_texts = [first_header] + extract_header_texts_from_pdf(pdf_path, pages=range(1, page_count))
+    return len(segment_pdf_pages(header_texts)) > 1
+
+def _classify_from_similar(analysis, similar):
+    """Documento não classificado pelo próprio texto: usa o tipo do documento semelhante já processado"""
+    if similar is None or analysis["Tipo_Arquivo"] != "Documento Não Classificado":
+        return
+    tipo = similar['analysis'].get("Tipo_Arquivo")
+    if tipo and tipo != "Documento Não Classificado":
+        logging.info(f"  -> Tipo reaproveitado do documento semelhante: {tipo}")
+        analysis["Tipo_Arquivo"] = tipo
+
+def stable_output_id(key):
+    """Identificador determinístico do JSON de uma origem (gravações repetidas usam o mesmo arquivo)"""
+    return hashlib.blake2b(os.path.normcase(key).encode('utf-8'), digest_size=6).hexdigest()
+
+def save_result_json(result_data, file_path, filename, base_path=None, output_path=None, output_id=None):
+    """
+    Grava o registro em JSON espelhando a estrutura de pastas de base_path
+    dentro de output_path (padrão: BASE_PATH e JSON_OUTPUT_PATH).
+    Com output_id o nome é fixo e a gravação é atômica (arquivo temporário +
+    os.replace): reprocessar o mesmo item substitui o JSON em vez de duplicá-lo.
+    Retorna o caminho gravado ou None em caso de erro.
+    """
+    base_path = base_path or BASE_PATH
+    output_path = output_path or JSON_OUTPUT_PATH
 
     # Determina diretório de saída
-    relative_dir = os.path.relpath(os.path.dirname(file_path), BASE_PATH)
-    final_output_dir = os.path.join(JSON_OUTPUT_PATH, relative_dir)
+    relative_dir = os.path.relpath(os.path.dirname(file_path), base_path)
+    final_output_dir = os.path.join(output_path, relative_dir)
     os.makedirs(final_output_dir, exist_ok=True)
 
     # Gera nome único para o arquivo JSON
     base_name = os.path.splitext(filename)[0]
     # Remove caracteres problemáticos do nome
     base_name = re.sub(r'[^\w\-_.]', '_', base_name)
-    unique_id = int(time.time() * 1000)
+    unique_id = output_id or int(time.time() * 1000)
     output_filename = f"{base_name}_{unique_id}.json"
     output_file_path = os.path.join(final_output_dir, output_filename)
 
     try:
-        with open(output_file_path, 'w', encoding='utf-8') as json_file:
+        write_path = f"{output_file_path}.{os.getpid()}.tmp" if output_id else output_file_path
+        with open(write_path, 'w', encoding='utf-8') as json_file:
             json.dump(result_data, json_file, indent=4, ensure_ascii=False)
+        if output_id:
+            os.replace(write_path, output_file_path)
 
         logging.info(f"  -> SUCESSO! Dados salvos em: {output_file_path}")
-        logging.info(f"  -> CNPJ: {final_cnpj or 'Não encontrado'}")
-        logging.info(f"  -> Competência: {competencia or 'Não encontrada'}")
-        logging.info(f"  -> Tipo: {tipo_arquivo}\n")
-
+        logging.info(f"  -> CNPJ: {result_data['CNPJ'] or 'Não encontrado'}")
+        logging.info(f"  -> Competência: {result_data['Mes_Competencia'] or 'Não encontrada'}")
+        logging.info(f"  -> Tipo: {result_data['Tipo_Arquivo']}\n")
     except Exception as e:
         logging.error(f"  -> ERRO ao salvar o arquivo JSON {output_filename}: {e}\n")
+        return None
+    return output_file_path
+
+def export_statement_for_result(file_path, result_data, json_path, page_words=None):
+    """
+    Extratos em PDF/imagem: grava as transações ao lado do JSON do resultado.
+    page_words traz as palavras do OCR da análise (por página); só as páginas
+    sem elas são lidas de novo. Cópias (Duplicado_De) não são exportadas: as
+    transações já estão no CSV do original.
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if result_data["Tipo_Arquivo"] != "Extrato Bancário" or result_data.get("Duplicado_De"):
+        return None
+    if file_ext != '.pdf' and file_ext not in IMAGE_EXTENSIONS:
+        return None
+
+    pages = None
+    if result_data.get("Paginas"):
+        first, last = result_data["Paginas"].split('-')
+        pages = range(int(first) - 1, int(last))
+    competencia = result_data["Mes_Competencia"]
+    year_hint = competencia.split('/')[1] if competencia else None
+    csv_path = os.path.splitext(json_path)[0] + '_transacoes.csv'
+    try:
+        count = write_statement_transactions(file_path, csv_path, pages, year_hint, page_words)
+    except Exception as e:
+        logging.warning(f"  -> Falha ao extrair transações do extrato: {e}")
+        return None
+    if count:
+        logging.info(f"  -> Transações do extrato: {count} linha(s) em {csv_path}")
+        return csv_path
+    return None
+
+def process_and_save_file_data(file_path, filename, client_folder_name, full_text=False, records=None,
+                               output_key=None, layout_path=None):
+    """
+    Processamento principal com IA aprimorada e EXTRAÇÃO DE CNPJ CORRIGIDA
+    Retorna o caminho do JSON gerado (ou None quando nada foi salvo).
+    Com records (lista), acrescenta o ResultRecord compacto do arquivo salvo.
+    PDFs com vários documentos geram um JSON e um registro por documento.
+    Com output_key, o nome do JSON é derivado dela (gravação idempotente) e
+    layout_path, se informado, define a pasta espelhada em vez de file_path.
+    As linhas de log do arquivo são enviadas ao escritor em um único lote.
+    Com o perfil ativo (--profile), o arquivo é medido por profile_file().
+    """
+    with file_log_batch(), profile_file(file_path):
+        return _process_and_save_file_data(file_path, filename, client_folder_name, full_text, records,
+                                           output_key, layout_path)
+
+def _process_and_save_file_data(file_path, filename, client_folder_name, full_text, records,
+                                output_key, layout_path):
+    start_time = time.time()
+    page_words = {} if STATEMENT_TRANSACTIONS_ENABLED else None
+    result_data, dedup_entry = analyze_file(file_path, filename, client_folder_name, full_text=full_text,
+                                            page_words=page_words)
+    if result_data is None:
+        return None
+    duration = time.time() - start_time
+
+    saved = []
+    output_id = stable_output_id(output_key) if output_key else None
+    layout_path = layout_path or file_path
+    if "Segmentos" in result_data:
+        base_name, file_ext = os.path.splitext(filename)
+        for segment in result_data["Segmentos"]:
+            segment_path = save_result_json(segment, layout_path, f"{base_name}_p{segment['Paginas']}{file_ext}",
+                                            output_id=output_id)
+            if segment_path is None:
+                return None
+            saved.append((segment, segment_path))
+    else:
+        output_file_path = save_result_json(result_data, layout_path, filename, output_id=output_id)
+        if output_file_path is None:
+            return None
+        saved.append((result_data, output_file_path))
+    output_file_path = saved[0][1]
+
+    if STATEMENT_TRANSACTIONS_ENABLED:
+        for saved_data, saved_path in saved:
+            export_statement_for_result(file_path, saved_data, saved_path, page_words)
+
+    if dedup_entry is not None and not dedup_entry.get('duplicate'):
+        get_duplicate_registry(DEDUP_DB_PATH).register(
+            dedup_entry['content_hash'], file_path, client_folder_name, output_file_path,
+            dedup_entry['analysis'], dedup_entry['phash'], dedup_entry['minhash'])
+    if records is not None:
+        content_hash = dedup_entry['content_hash'] if dedup_entry else compute_content_hash(file_path)
+        for saved_data, saved_path in saved:
+            record = ResultRecord.from_result(saved_data, saved_path, content_hash, duration / len(saved))
+            if saved_data.get("Paginas"):
+                # Chave própria no índice para cada documento do PDF
+                record.source = f"{record.source}#p{saved_data['Paginas']}"
+            records.append(record)
+    return output_file_path
+
+def process_work_item(item, checkpoint_path=None, resume=False, stable_output=False):
+    """
+    Processa um item de trabalho (arquivo comum ou compactado).
+    Executado dentro dos pools do agendador; retorna contadores e os
+    registros compactos dos arquivos salvos (para o resumo da execução).
+    Com checkpoint_path, cada arquivo concluído é registrado no diário;
+    com resume, membros de compactados já concluídos são pulados.
+    Com stable_output (fila distribuída), os JSONs têm nome fixo por origem,
+    então uma nova tentativa do mesmo item sobrescreve em vez de duplicar.
+    """
+    file_path = item['path']
+    client_folder_name = get_client_folder_name(file_path, BASE_PATH)
+    journal = get_checkpoint_journal(checkpoint_path) if checkpoint_path else None
+    item_key = CheckpointJournal.item_key(item)
+    records = []
+    outcome = {'processed': 0, 'errors': 0, 'skipped': 0, 'client': client_folder_name, 'records': records}
+
+    if journal:
+        journal.mark(item_key, 'in_progress')
 
-def main_recursive_process(directory_to_scan):
-    """Processamento recursivo principal"""
+    if item['ext'] not in COMPRESSED_EXTENSIONS:
+        try:
+            output_path = process_and_save_file_data(file_path, item['filename'], client_folder_name,
+                                                     records=records,
+                                                     output_key=file_path if stable_output else None)
+        except Exception:
+            if journal:
+                journal.mark(item_key, 'failed')
+            raise
+        if journal:
+            journal.mark(item_key, 'done', output_path, records)
+        outcome['processed'] += 1
+        return outcome
+
+    # Processamento de arquivos comprimidos
+    os.makedirs(ARCHIVE_EXTRACT_BASE, exist_ok=True)
+    # mkdtemp evita colisão de nomes entre processos do pool; o pid no prefixo permite
+    # ao pool remover a pasta de um worker encerrado por tempo esgotado
+    extract_dir = tempfile.mkdtemp(prefix=_archive_extract_prefix(os.getpid()), dir=ARCHIVE_EXTRACT_BASE)
+
+    if extract_compressed_files(file_path, extract_dir):
+        for ext_item in iter_work_items(extract_dir, max_workers=1, excluded_paths=()):
+            if ext_item['ext'] in COMPRESSED_EXTENSIONS:
+                continue
+            # Chave do membro: chave do compactado + caminho relativo interno
+            member_key = CheckpointJournal.member_key(item_key, extract_dir, ext_item)
+            done_records = journal.done_records(member_key) if journal and resume else None
+            if done_records is not None:
+                # Membro concluído antes da interrupção: só entra no resumo
+                records.extend(done_records)
+                outcome['skipped'] += 1
+                continue
+            first_record = len(records)
+            # Origem estável no índice: compactado + caminho interno (a pasta temporária muda a cada execução)
+            member_source = f"{file_path}::{os.path.relpath(ext_item['path'], extract_dir)}"
+            try:
+                if stable_output:
+                    # JSON na pasta espelhada do compactado, com nome fixo pelo membro
+                    output_path = process_and_save_file_data(ext_item['path'], ext_item['filename'],
+                                                             client_folder_name, records=records,
+                                                             output_key=member_source, layout_path=file_path)
+                else:
+                    output_path = process_and_save_file_data(ext_item['path'], ext_item['filename'],
+                                                             client_folder_name, records=records)
+            except Exception as e:
+                logging.error(f"Erro ao processar {ext_item['filename']} de {item['filename']}: {e}")
+                if journal:
+                    journal.mark(member_key, 'failed')
+                outcome['errors'] += 1
+                continue
+            for record in records[first_record:]:
+                record.source = record.source.replace(ext_item['path'], member_source, 1)
+            if journal:
+                journal.mark(member_key, 'done', output_path, records[first_record:])
+            outcome['processed'] += 1
+    else:
+        outcome['errors'] += 1
+
+    try:
+        shutil.rmtree(extract_dir)
+        logging.info(f"  -> Pasta temporária removida: {extract_dir}")
+    except Exception as e:
+        logging.warning(f"  -> Não foi possível remover pasta temporária {extract_dir}: {e}")
+
+    if journal:
+        # Compactado só é considerado concluído se todos os membros foram
+        journal.mark(item_key, 'done' if outcome['errors'] == 0 else 'failed')
+    return outcome
+
+def main_recursive_process(directory_to_scan, scan_workers=SCAN_WORKERS, resume=False,
+                           checkpoint_path=CHECKPOINT_DB_PATH, summary_base=SUMMARY_OUTPUT_BASE,
+                           index_path=INDEX_DB_PATH, queue_path=None):
+    """
+    Processamento recursivo principal. Com queue_path, atua como coordenador:
+    publica os itens na fila compartilhada e agrega os resultados dos workers
+    (a própria fila substitui o diário de checkpoints no --resume).
+    """
+    run_started_at = time.time()
+    index = ResultIndex(index_path) if INDEX_ENABLED and index_path else None
     total_files = 0
     processed_files = 0
+    skipped_files = 0
+    timeouts = 0
     errors = 0
+    summary = RunSummary()
+    discovery = DiscoveryRecord()
+
+    journal = None if queue_path else CheckpointJournal(checkpoint_path)
+    if resume and journal:
+        logging.info(f"Retomando execução a partir do diário: {checkpoint_path}")
+    elif not resume:
+        if journal:
+            journal.reset()
+        if DEDUP_ENABLED:
+            # Execução completa: o registro de duplicados recomeça junto com o diário
+            get_duplicate_registry(DEDUP_DB_PATH).reset()
+
+    def pending_items():
+        nonlocal skipped_files
+        for item in iter_work_items(directory_to_scan, max_workers=scan_workers, discovery=discovery):
+            done_records = journal.done_records(CheckpointJournal.item_key(item)) if resume else None
+            if done_records is not None:
+                # Concluído antes da interrupção: entra no resumo só se a descoberta o
+                # encontrou de novo com a mesma chave (um arquivo alterado é refeito
+                # e contado uma vez; um removido deixa de ser contado)
+                for record in done_records:
+                    summary.add(record)
+                skipped_files += 1
+                continue
+            yield item
 
-    for root, dirs, files in os.walk(directory_to_scan, topdown=True):
-        # Exclui diretório de saída da busca
-        dirs[:] = [d for d in dirs if os.path.join(root, d) != JSON_OUTPUT_PATH]
+    if queue_path:
+        # Coordenador: os workers (nesta ou em outras máquinas) processam a fila
+        results = coordinate_work_queue(directory_to_scan, queue_path, resume=resume,
+                                        scan_workers=scan_workers, discovery=discovery)
+    else:
+        # A descoberta já descarta extensões não suportadas e pastas de sistema;
+        # o agendador executa primeiro os arquivos baratos e isola o OCR pesado
+        scheduler = WorkScheduler()
+        handler = partial(process_work_item, checkpoint_path=checkpoint_path, resume=resume)
+        results = scheduler.run(legacy_preconversion(pending_items()), handler)
+
+    for item, outcome, error in results:
+        total_files += 1
+        if isinstance(error, FileProcessingTimeout):
+            logging.error(f"TEMPO ESGOTADO ao processar arquivo {item['path']}: {error}")
+            if journal:
+                journal.mark(CheckpointJournal.item_key(item), 'timeout')
+            summary.add_failure(get_client_folder_name(item['path'], BASE_PATH))
+            timeouts += 1
+            errors += 1
+            continue
+        if error is not None:
+            logging.error(f"Erro ao processar arquivo {item['filename']}: {error}")
+            if journal:
+                journal.mark(CheckpointJournal.item_key(item), 'failed')
+            summary.add_failure(get_client_folder_name(item['path'], BASE_PATH))
+            errors += 1
+            continue
+        processed_files += outcome['processed']
+        skipped_files += outcome['skipped']
+        errors += outcome['errors']
+        for record in outcome['records']:
+            summary.add(record)
+        for _ in range(outcome['errors']):
+            summary.add_failure(outcome['client'])
+        if index:
+            index.upsert(outcome['records'])
+
+    if journal:
+        journal.close()
+    if index:
+        if not resume:
+            # Execução completa: remove do índice arquivos que comprovadamente não existem mais
+            removed = index.prune(run_started_at, discovery)
+            if removed:
+                logging.info(f"Registros removidos do índice (arquivos ausentes): {removed}")
+        index.close()
 
-        for filename in files:
-            total_files += 1
-            file_path = os.path.join(root, filename)
-            client_folder_name = get_client_folder_name(file_path, BASE_PATH)
+    # Relatório final
+    logging.info(f"\n=== RELATÓRIO FINAL ===", extra=LOG_SUMMARY)
+    logging.info(f"Total de arquivos encontrados: {total_files}", extra=LOG_SUMMARY)
+    logging.info(f"Arquivos processados com sucesso: {processed_files}", extra=LOG_SUMMARY)
+    logging.info(f"Erros de processamento: {errors}", extra=LOG_SUMMARY)
+    logging.info(f"Arquivos interrompidos por tempo esgotado: {timeouts}", extra=LOG_SUMMARY)
+    if resume:
+        logging.info(f"Arquivos já concluídos em execução anterior (pulados): {skipped_files}", extra=LOG_SUMMARY)
+    logging.info(f"Taxa de sucesso: {(processed_files/total_files*100):.1f}%" if total_files > 0 else "N/A",
+                 extra=LOG_SUMMARY)
+
+    summary.log_report()
+    try:
+        for path in summary.write(summary_base):
+            logging.info(f"Resumo da execução salvo em: {path}", extra=LOG_SUMMARY)
+    except Exception as e:
+        logging.error(f"Erro ao gravar o resumo da execução: {e}")
 
-            try:
-                file_ext = os.path.splitext(filename)[1].lower()
-
-                if file_ext in ['.zip', '.rar']:
-                    # Processamento de arquivos comprimidos
-                    extract_base = r'C:\temp_extract' if os.name == 'nt' else '/tmp/temp_extract'
-                    os.makedirs(extract_base, exist_ok=True)
-                    extract_dir = os.path.join(extract_base, f"_temp_{int(time.time() * 1000)}")
-                    os.makedirs(extract_dir, exist_ok=True)
-
-                    if extract_compressed_files(file_path, extract_dir):
-                        for ext_root, _, ext_files in os.walk(extract_dir):
-                            for ext_filename in ext_files:
-                                ext_file_path = os.path.join(ext_root, ext_filename)
-                                process_and_save_file_data(ext_file_path, ext_filename, client_folder_name)
-                                processed_files += 1
 
-                        try:
-                            shutil.rmtree(extract_dir)
-                            logging.info(f"  -> Pasta temporária removida: {extract_dir}")
-                        except Exception as e:
-                            logging.warning(f"  -> Não foi possível remover pasta temporária {extract_dir}: {e}")
-                    else:
-                        errors += 1
+# --- Processamento Distribuído (Fila Compartilhada) ---
+#
+# Coordenador (python OCR_inteligente.py --queue F:\fila\ocr.sqlite3) faz a
+# descoberta e publica os itens; workers em uma ou mais máquinas
+# (--queue-worker F:\fila\ocr.sqlite3) disputam os itens por lease. Os
+# caminhos são publicados relativos à pasta raiz do coordenador e cada worker
+# os resolve contra a sua própria raiz (--base-path), então cada máquina pode
+# montar a pasta compartilhada onde quiser.
+
+class WorkQueue:
+    """
+    Fila de trabalho em SQLite (arquivo em pasta compartilhada). Cada item é
+    entregue a um worker por vez através de um lease com prazo, renovado
+    enquanto o item está em processamento; se o worker morrer, o lease expira
+    e outro worker retoma o item, até QUEUE_MAX_ATTEMPTS tentativas. Itens
+    concluídos recebem um número de sequência para que o coordenador colete
+    apenas os resultados novos.
+    """
+
+    ACTIVE_STATUSES = ('pending', 'leased')
+
+    def __init__(self, db_path, max_attempts=None):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.max_attempts = max_attempts or QUEUE_MAX_ATTEMPTS
+        self._conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self._conn.execute(f'PRAGMA journal_mode={QUEUE_JOURNAL_MODE}')
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' item_key TEXT PRIMARY KEY, item TEXT NOT NULL, cost REAL NOT NULL,'
+            ' status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,'
+            ' lease_owner TEXT, lease_expires REAL, result TEXT, error TEXT,'
+            ' finished_seq INTEGER, updated_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, cost);'
+            'CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_seq);'
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);'
+        )
+
+    def _begin(self):
+        # BEGIN IMMEDIATE: o lock de escrita é obtido antes da leitura, então
+        # dois workers nunca recebem o mesmo item
+        self._conn.execute('BEGIN IMMEDIATE')
+
+    def reset(self):
+        """Descarta itens e estado de execuções anteriores (execução completa)"""
+        self._begin()
+        self._conn.execute('DELETE FROM jobs')
+        self._conn.execute('DELETE FROM meta')
+        self._conn.execute('COMMIT')
+
+    def publish(self, items, base_path):
+        """
+        Publica itens da descoberta (idempotente: itens já publicados são
+        mantidos; os que falharam voltam para a fila). Retorna a quantidade.
+        """
+        now = time.time()
+        rows = []
+        for item in items:
+            _, cost = estimate_processing_cost(item)
+            payload = {'relpath': os.path.relpath(item['path'], base_path).replace(os.sep, '/'),
+                       'filename': item['filename'], 'ext': item['ext'],
+                       'size': item.get('size', 0), 'mtime': item.get('mtime', 0)}
+            rows.append((CheckpointJournal.item_key(item), json.dumps(payload, ensure_ascii=False), cost, now))
+        if not rows:
+            return 0
+        self._begin()
+        try:
+            self._conn.executemany(
+                "INSERT INTO jobs (item_key, item, cost, status, updated_at) VALUES (?, ?, ?, 'pending', ?) "
+                "ON CONFLICT(item_key) DO UPDATE SET status = 'pending', attempts = 0, error = NULL,"
+                " finished_seq = NULL, updated_at = excluded.updated_at WHERE jobs.status = 'failed'",
+                rows)
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def set_publishing_done(self, done=True):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('publicacao_concluida', ?)",
+                           ('1' if done else '0',))
+
+    def lease(self, worker_id, lease_seconds=None):
+        """Reserva o próximo item (menor custo primeiro); retorna (chave, item) ou None"""
+        lease_seconds = lease_seconds or QUEUE_LEASE_SECONDS
+        self._begin()
+        try:
+            while True:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT item_key, item, attempts FROM jobs WHERE status = 'pending'"
+                    " OR (status = 'leased' AND lease_expires < ?) ORDER BY cost LIMIT 1", (now,)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute('COMMIT')
+                    return None
+                item_key, payload, attempts = row
+                if attempts >= self.max_attempts:
+                    # Lease expirado na última tentativa: o worker provavelmente travou ou morreu
+                    self._finish_locked(item_key, 'failed', None,
+                                        f"Lease expirado após {attempts} tentativa(s)", now)
+                    continue
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?,"
+                    " lease_expires = ?, updated_at = ? WHERE item_key = ?",
+                    (worker_id, now + lease_seconds, now, item_key))
+                self._conn.execute('COMMIT')
+                return item_key, json.loads(payload)
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def renew(self, worker_id, item_keys, lease_seconds=None):
+        """Prorroga os leases ainda pertencentes ao worker"""
+        if not item_keys:
+            return
+        lease_seconds = lease_seconds or QUEUE_LEASE_SECONDS
+        now = time.time()
+        self._conn.executemany(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+            "WHERE item_key = ? AND lease_owner = ? AND status = 'leased'",
+            [(now + lease_seconds, now, item_key, worker_id) for item_key in item_keys])
+
+    def _finish_locked(self, item_key, status, result, error, now):
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, lease_owner = NULL, lease_expires = NULL,"
+            " finished_seq = (SELECT COALESCE(MAX(finished_seq), 0) + 1 FROM jobs), updated_at = ? "
+            "WHERE item_key = ?", (status, result, error, now, item_key))
+
+    def finish(self, item_key, worker_id, status, result=None, error=None):
+        """
+        Registra o estado final ('done', 'timeout' ou 'failed') do item.
+        Ignorado se o lease já passou para outro worker (o resultado gravado
+        é idempotente; vale o do worker que detém o lease).
+        """
+        self._begin()
+        try:
+            owner = self._conn.execute(
+                "SELECT lease_owner FROM jobs WHERE item_key = ? AND status = 'leased'", (item_key,)
+            ).fetchone()
+            if owner is None or owner[0] != worker_id:
+                self._conn.execute('COMMIT')
+                return False
+            self._finish_locked(item_key, status,
+                                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                                error, time.time())
+            self._conn.execute('COMMIT')
+            return True
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def retry(self, item_key, worker_id, error):
+        """Devolve o item à fila após uma falha, ou o encerra como 'failed' na última tentativa"""
+        row = self._conn.execute(
+            "SELECT attempts FROM jobs WHERE item_key = ? AND lease_owner = ? AND status = 'leased'",
+            (item_key, worker_id)).fetchone()
+        if row is None:
+            return
+        if row[0] >= self.max_attempts:
+            self.finish(item_key, worker_id, 'failed', error=error)
+            return
+        self._conn.execute(
+            "UPDATE jobs SET status = 'pending', lease_owner = NULL, lease_expires = NULL, error = ?,"
+            " updated_at = ? WHERE item_key = ? AND lease_owner = ? AND status = 'leased'",
+            (error, time.time(), item_key, worker_id))
+
+    def iter_finished(self, after_seq=0):
+        """Itens encerrados após after_seq: (seq, chave, item, status, resultado, erro)"""
+        rows = self._conn.execute(
+            "SELECT finished_seq, item_key, item, status, result, error FROM jobs "
+            "WHERE finished_seq > ? ORDER BY finished_seq", (after_seq,)).fetchall()
+        for seq, item_key, payload, status, result, error in rows:
+            yield seq, item_key, json.loads(payload), status, json.loads(result) if result else None, error
+
+    def counts(self):
+        return dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def is_drained(self):
+        """Publicação encerrada e nenhum item pendente ou em processamento"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'publicacao_concluida'").fetchone()
+        if row is None or row[0] != '1':
+            return False
+        counts = self.counts()
+        return not any(counts.get(status) for status in self.ACTIVE_STATUSES)
+
+    def close(self):
+        self._conn.close()
+
+
+def _queue_item_to_work_item(payload, base_path):
+    item = dict(payload)
+    item['path'] = os.path.join(base_path, *payload['relpath'].split('/'))
+    return item
+
+def coordinate_work_queue(directory_to_scan, queue_path, resume=False, scan_workers=SCAN_WORKERS, discovery=None):
+    """
+    Coordenador: publica a descoberta na fila e produz (item, resultado, erro)
+    à medida que os workers concluem os itens, no mesmo formato do agendador
+    local. Com resume, itens concluídos em execuções anteriores também são
+    produzidos (entram no resumo) e itens que falharam voltam para a fila.
+    """
+    queue = WorkQueue(queue_path)
+    if not resume:
+        queue.reset()
+    queue.set_publishing_done(False)
+
+    published = 0
+    batch = []
+    for item in iter_work_items(directory_to_scan, max_workers=scan_workers, discovery=discovery):
+        batch.append(item)
+        if len(batch) >= QUEUE_PUBLISH_BATCH:
+            published += queue.publish(batch, directory_to_scan)
+            batch = []
+    published += queue.publish(batch, directory_to_scan)
+    queue.set_publishing_done(True)
+    logging.info(f"Itens publicados na fila {queue_path}: {published}. Aguardando os workers...", extra=LOG_SUMMARY)
+
+    last_seq = 0
+    last_report = time.monotonic()
+    try:
+        while True:
+            drained = queue.is_drained()
+            for seq, _, payload, status, result, error in queue.iter_finished(last_seq):
+                last_seq = seq
+                item = _queue_item_to_work_item(payload, directory_to_scan)
+                if status == 'done':
+                    result['records'] = [ResultRecord.unpack(values) for values in result['records']]
+                    yield item, result, None
+                elif status == 'timeout':
+                    yield item, None, FileProcessingTimeout(error or '')
+                else:
+                    yield item, None, RuntimeError(error or 'falha no worker')
+            if drained:
+                break
+            if time.monotonic() - last_report >= 30:
+                counts = queue.counts()
+                logging.info(f"Fila: {counts.get('pending', 0)} pendente(s), {counts.get('leased', 0)} em processamento, "
+                             f"{counts.get('done', 0)} concluído(s)")
+                last_report = time.monotonic()
+            time.sleep(QUEUE_POLL_INTERVAL)
+    finally:
+        queue.close()
+
+def run_queue_worker(queue_path, worker_id=None, fast_workers=FAST_POOL_WORKERS, ocr_workers=OCR_POOL_WORKERS,
+                     exit_when_drained=True, base_path=None):
+    """
+    Worker da fila distribuída: reserva itens, processa-os com o mesmo
+    agendador por custo e processos isolados da execução local e registra o
+    resultado. Mantém no máximo um item reservado por processo do pool e
+    renova os leases em segundo plano. Os caminhos relativos da fila são
+    resolvidos contra base_path (padrão: BASE_PATH, ajustável por
+    --base-path). Retorna {estado: quantidade}.
+    """
+    base_path = base_path or BASE_PATH
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    capacity = fast_workers + ocr_workers
+    leased = {}
+    leased_lock = threading.Lock()
+    stop_event = threading.Event()
+    totals = Counter()
+
+    def renew_leases():
+        renewer = WorkQueue(queue_path)
+        try:
+            while not stop_event.wait(QUEUE_LEASE_SECONDS / 3):
+                with leased_lock:
+                    item_keys = list(leased)
+                try:
+                    renewer.renew(worker_id, item_keys)
+                except sqlite3.Error as e:
+                    logging.warning(f"Falha ao renovar leases na fila: {e}")
+        finally:
+            renewer.close()
+
+    def leased_items():
+        while True:
+            if len(leased) >= capacity:
+                time.sleep(0.05)
+                yield None  # Pulso: apenas recolhe resultados
+                continue
+            job = queue.lease(worker_id)
+            if job is None:
+                if exit_when_drained and queue.is_drained():
+                    return
+                time.sleep(QUEUE_POLL_INTERVAL)
+                yield None
+                continue
+            item_key, payload = job
+            item = _queue_item_to_work_item(payload, base_path)
+            item['queue_key'] = item_key
+            with leased_lock:
+                leased[item_key] = time.time()
+            yield item
+
+    logging.info(f"Worker {worker_id} conectado à fila {queue_path}")
+    renewer_thread = threading.Thread(target=renew_leases, daemon=True)
+    renewer_thread.start()
+    started = time.perf_counter()
+    scheduler = WorkScheduler(fast_workers, ocr_workers)
+    handler = partial(process_work_item, stable_output=True)
+    try:
+        for item, outcome, error in scheduler.run(leased_items(), handler):
+            item_key = item['queue_key']
+            if isinstance(error, FileProcessingTimeout):
+                logging.error(f"TEMPO ESGOTADO ao processar arquivo {item['path']}: {error}")
+                # Estado final, como no diário: o arquivo travaria de novo em outra máquina
+                queue.finish(item_key, worker_id, 'timeout', error=str(error))
+                totals['timeout'] += 1
+            elif error is not None:
+                logging.error(f"Erro ao processar arquivo {item['filename']}: {error}")
+                queue.retry(item_key, worker_id, f"{type(error).__name__}: {error}")
+                totals['retry'] += 1
+            else:
+                result = dict(outcome, records=[record.pack_full() for record in outcome['records']])
+                if queue.finish(item_key, worker_id, 'done', result=result):
+                    totals['done'] += 1
                 else:
-                    # Processamento de arquivos normais
-                    process_and_save_file_data(file_path, filename, client_folder_name)
-                    processed_files += 1
+                    logging.warning(f"Lease de {item['filename']} perdido para outro worker; resultado descartado.")
+                    totals['lost'] += 1
+            with leased_lock:
+                leased.pop(item_key, None)
+    finally:
+        stop_event.set()
+        renewer_thread.join()
+        queue.close()
+
+    elapsed = time.perf_counter() - started
+    logging.info(f"Worker {worker_id} encerrado: {dict(totals)} em {elapsed:.1f}s", extra=LOG_SUMMARY)
+    return dict(totals)
+
+def _queue_benchmark_node(queue_path, worker_id, base_path, output_path, fast_workers, ocr_workers):
+    """Processo de um worker do benchmark (saída e caches isolados por rodada)"""
+    global DEDUP_ENABLED, OCR_CACHE_ENABLED
+    # Pelas configurações de runtime: os pools do nó reaplicam --base-path e, depois, esta saída
+    configure_output_path(output_path)
+    DEDUP_ENABLED = False
+    OCR_CACHE_ENABLED = False  # Cache compartilhado entre rodadas inflaria a vazão
+    # Log próprio, como numa máquina separada (o escritor do processo principal não é herdado)
+    os.makedirs(output_path, exist_ok=True)
+    setup_logging(os.path.join(output_path, 'processamento_log.log'), quiet=True)
+    run_queue_worker(queue_path, worker_id, fast_workers, ocr_workers, base_path=base_path)
+
+def run_queue_benchmark(directory, node_counts=(1, 2, 4), fast_workers=1, ocr_workers=1):
+    """
+    Mede a vazão da fila distribuída neste host: para cada quantidade de
+    workers, publica todos os arquivos de directory numa fila nova, sobe os
+    workers como processos separados (como máquinas distintas) e mede
+    arquivos por segundo até a fila esvaziar. Destinado a Linux (fork).
+    """
+    items = list(iter_work_items(directory))
+    if not items:
+        print(f"Nenhum arquivo suportado em {directory}")
+        return []
+    context = multiprocessing.get_context()
+    report = []
+    for node_count in node_counts:
+        bench_dir = tempfile.mkdtemp(prefix='_bench_fila_')
+        try:
+            queue_path = os.path.join(bench_dir, 'fila.sqlite3')
+            queue = WorkQueue(queue_path)
+            queue.publish(items, directory)
+            queue.set_publishing_done(True)
+
+            started = time.perf_counter()
+            nodes = [context.Process(target=_queue_benchmark_node,
+                                     args=(queue_path, f"bench-{node_count}-{index}", directory,
+                                           os.path.join(bench_dir, 'saida'), fast_workers, ocr_workers))
+                     for index in range(node_count)]
+            for node in nodes:
+                node.start()
+            for node in nodes:
+                node.join()
+            elapsed = time.perf_counter() - started
+
+            counts = queue.counts()
+            queue.close()
+            finished = sum(counts.get(status, 0) for status in ('done', 'timeout', 'failed'))
+            row = {'workers': node_count, 'arquivos': finished, 'segundos': elapsed,
+                   'vazao_arq_s': finished / elapsed if elapsed else 0.0, 'status': counts}
+            report.append(row)
+            print(f"Workers: {node_count} | Arquivos: {finished} | Tempo: {elapsed:.1f}s | "
+                  f"Vazão: {row['vazao_arq_s']:.2f} arq/s | Status: {counts}")
+        finally:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+    if report and report[0]['vazao_arq_s']:
+        base = report[0]['vazao_arq_s']
+        print("Escala relativa: " + ", ".join(f"{row['workers']}w = {row['vazao_arq_s'] / base:.2f}x" for row in report))
+    return report
+
+
+# --- API de Biblioteca ---
+#
+# Uso embutido em outros pipelines, sem gravar JSON nem depender de
+# configuração global feita na importação:
+#
+#     config = AnalysisConfig(tesseract_cmd='/usr/bin/tesseract')
+#     result = analyze_path('extrato.pdf', config=config)
+#     for result in analyze_many(caminhos, config=config, workers=4): ...
+
+class AnalysisConfig:
+    """
+    Configuração injetada nas chamadas da API (None usa o padrão do módulo).
+    full_text, header_first, base_path e timeout valem só para a chamada.
+    Os executáveis (tesseract_cmd, unrar_tool) são globais do pytesseract e
+    do rarfile, então valem para o processo inteiro: a última configuração
+    aplicada vence, e chamadas concorrentes com executáveis diferentes no
+    mesmo processo não são suportadas. O registro de duplicados
+    (use_registry) e o cache de OCR também são do processo: usam
+    DEDUP_DB_PATH, OCR_CACHE_DB_PATH e OCR_CACHE_ENABLED do módulo.
+    """
+
+    __slots__ = ('base_path', 'tesseract_cmd', 'unrar_tool', 'full_text',
+                 'header_first', 'use_registry', 'timeout')
+
+    def __init__(self, base_path=None, tesseract_cmd=None, unrar_tool=None, full_text=False,
+                 header_first=None, use_registry=False, timeout=FILE_TIMEOUT_SECONDS):
+        self.base_path = base_path
+        self.tesseract_cmd = tesseract_cmd
+        self.unrar_tool = unrar_tool
+        self.full_text = full_text
+        self.header_first = header_first
+        self.use_registry = use_registry
+        self.timeout = timeout
+
+    def apply(self):
+        """Aplica os executáveis externos no processo atual (configuração do processo inteiro)"""
+        configure_external_tools(self.tesseract_cmd, self.unrar_tool)
+
+    def runtime_settings(self):
+        settings = current_runtime_settings()
+        if self.tesseract_cmd:
+            settings['tesseract_cmd'] = self.tesseract_cmd
+        if self.unrar_tool:
+            settings['unrar_tool'] = self.unrar_tool
+        return settings
+
+
+class AnalysisResult:
+    """Resultado estruturado da análise de um documento"""
+
+    __slots__ = ('source', 'cnpj', 'competencia', 'tipo_arquivo', 'agencia', 'conta',
+                 'cliente_pasta', 'duplicado_de', 'erro', 'tempo', 'paginas', 'segmentos', 'chave_acesso', 'boleto')
+
+    def __init__(self, source, cnpj=None, competencia=None, tipo_arquivo=None, agencia=None,
+                 conta=None, cliente_pasta=None, duplicado_de=None, erro=None, tempo=0.0,
+                 paginas=None, segmentos=None, chave_acesso=None, boleto=None):
+        self.source = source
+        self.cnpj = cnpj
+        self.competencia = competencia
+        self.tipo_arquivo = tipo_arquivo
+        self.agencia = agencia
+        self.conta = conta
+        self.cliente_pasta = cliente_pasta
+        self.duplicado_de = duplicado_de
+        self.erro = erro
+        self.tempo = tempo
+        self.paginas = paginas
+        # PDFs com vários documentos: um AnalysisResult por documento
+        self.segmentos = segmentos or []
+        self.chave_acesso = chave_acesso
+        self.boleto = boleto
+
+    @classmethod
+    def from_record(cls, record, tempo=0.0):
+        return cls(record["Caminho_Original"], record["CNPJ"], record["Mes_Competencia"],
+                   record["Tipo_Arquivo"], record["Agencia"], record["Conta"],
+                   record["Cliente_Pasta"], record.get("Duplicado_De"), tempo=tempo,
+                   paginas=record.get("Paginas"), chave_acesso=record.get("Chave_Acesso"),
+                   boleto=record.get("Boleto"),
+                   segmentos=[cls.from_record(segment) for segment in record.get("Segmentos", [])])
+
+    @classmethod
+    def failure(cls, source, erro, cliente_pasta=None, tempo=0.0):
+        return cls(source, cliente_pasta=cliente_pasta, erro=erro, tempo=tempo)
+
+    @property
+    def ok(self):
+        return self.erro is None
+
+    def to_dict(self):
+        """Mesmo formato do JSON gravado pelo processamento em lote"""
+        record = {
+            "CNPJ": self.cnpj,
+            "Mes_Competencia": self.competencia,
+            "Tipo_Arquivo": self.tipo_arquivo,
+            "Caminho_Original": self.source,
+            "Agencia": self.agencia,
+            "Conta": self.conta,
+            "Cliente_Pasta": self.cliente_pasta,
+        }
+        if self.duplicado_de:
+            record["Duplicado_De"] = self.duplicado_de
+        if self.chave_acesso:
+            record["Chave_Acesso"] = self.chave_acesso
+        if self.boleto:
+            record["Boleto"] = self.boleto
+        if self.paginas:
+            record["Paginas"] = self.paginas
+        if self.segmentos:
+            record["Segmentos"] = [segment.to_dict() for segment in self.segmentos]
+        if self.erro:
+            record["Erro"] = self.erro
+        return record
+
+    def __repr__(self):
+        if not self.ok:
+            return f"AnalysisResult({self.source!r}, erro={self.erro!r})"
+        return (f"AnalysisResult({self.source!r}, cnpj={self.cnpj!r}, "
+                f"competencia={self.competencia!r}, tipo_arquivo={self.tipo_arquivo!r})")
+
+
+def _analyze_source(source, filename, client_folder_name, config):
+    start_time = time.time()
+    try:
+        record, _ = analyze_file(source, filename, client_folder_name, full_text=config.full_text,
+                                 use_registry=config.use_registry, header_first=config.header_first)
+    except Exception as e:
+        return AnalysisResult.failure(filename, str(e), client_folder_name, time.time() - start_time)
+    if record is None:
+        return AnalysisResult.failure(filename, "Nenhum texto extraído", client_folder_name,
+                                      time.time() - start_time)
+    return AnalysisResult.from_record(record, time.time() - start_time)
+
+def analyze_bytes(data, filename, client_folder_name='', config=None):
+    """
+    Analisa um documento já em memória, sem gravar arquivos temporários.
+    O tipo é determinado pela extensão de filename.
+    """
+    config = config or AnalysisConfig()
+    config.apply()
+    stream = io.BytesIO(data)
+    stream.name = filename
+    return _analyze_source(stream, filename, client_folder_name, config)
+
+def analyze_path(path, client_folder_name=None, config=None):
+    """
+    Analisa um arquivo em disco e devolve um AnalysisResult, sem gravar JSON.
+    Sem client_folder_name, a pasta do cliente é deduzida do caminho
+    relativo a config.base_path ou, sem ele, é a pasta do próprio arquivo.
+    """
+    config = config or AnalysisConfig()
+    config.apply()
+    if client_folder_name is None:
+        if config.base_path:
+            client_folder_name = get_client_folder_name(path, config.base_path)
+        else:
+            client_folder_name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    result = _analyze_source(path, os.path.basename(path), client_folder_name, config)
+    result.source = path
+    return result
+
+def analyze_many(paths, config=None, workers=1):
+    """
+    Iterador em lote: produz um AnalysisResult por caminho, na ordem de entrada.
+    Com workers > 1 usa processos isolados (tempo limite por arquivo) e mantém
+    apenas uma janela limitada de arquivos em andamento.
+    """
+    config = config or AnalysisConfig()
+    if workers <= 1:
+        for path in paths:
+            yield analyze_path(path, config=config)
+        return
 
+    pool = IsolatedProcessPool(workers, timeout=config.timeout,
+                               initargs=(config.runtime_settings(),))
+    window = deque()
+    paths = iter(paths)
+    try:
+        while True:
+            while len(window) < workers * 2:
+                path = next(paths, None)
+                if path is None:
+                    break
+                window.append((path, pool.submit(analyze_path, path, config=config)))
+            if not window:
+                break
+            path, future = window.popleft()
+            try:
+                yield future.result()
             except Exception as e:
-                logging.error(f"Erro ao processar arquivo {filename}: {e}")
-                errors += 1
+                yield AnalysisResult.failure(path, f"{type(e).__name__}: {e}")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- Modo Daemon (Pasta Monitorada) ---
+
+class _WatchEventHandler(FileSystemEventHandler):
+    """Encaminha eventos do watchdog (inotify/ReadDirectoryChangesW) ao FolderWatcher"""
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        self.watcher.notify(event.src_path, event.is_directory)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path, False)
+
+    def on_moved(self, event):
+        self.watcher.notify(event.dest_path, event.is_directory)
+
+
+class FolderWatcher:
+    """
+    Observa a pasta base e produz itens de trabalho para arquivos novos ou
+    alterados, somente depois que o tamanho deixa de mudar (debounce de
+    gravações parciais). Usa eventos do sistema de arquivos via watchdog
+    quando disponível; caso contrário, recorre a varreduras periódicas.
+    """
+
+    def __init__(self, directory_to_watch, debounce=WATCH_DEBOUNCE_SECONDS, poll_interval=WATCH_POLL_INTERVAL):
+        self.directory_to_watch = directory_to_watch
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._events = queue.Queue()
+        self._pending = {}  # caminho -> (último evento, tamanho observado)
+        self._observer = None
+        self._snapshot = None
+        self._next_poll = 0
+        self._excluded = os.path.normcase(os.path.abspath(JSON_OUTPUT_PATH))
+
+    def start(self):
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_WatchEventHandler(self), self.directory_to_watch, recursive=True)
+            self._observer.start()
+            logging.info(f"Monitorando eventos em: {self.directory_to_watch}")
+        else:
+            logging.warning("Pacote watchdog não instalado. Monitorando por varredura periódica.")
+            self._snapshot = self._take_snapshot()
+            self._next_poll = time.monotonic() + self.poll_interval
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    def notify(self, path, is_directory=False):
+        """Chamado pelas threads do observador; apenas enfileira o evento"""
+        self._events.put((path, is_directory))
+
+    def _is_relevant(self, path, is_directory=False):
+        norm_path = os.path.normcase(os.path.abspath(path))
+        if norm_path.startswith(self._excluded):
+            return False
+        parts = os.path.normpath(path).split(os.sep)
+        if any(part in IGNORED_DIR_NAMES for part in (parts if is_directory else parts[:-1])):
+            return False
+        if is_directory:
+            return True
+        file_ext = os.path.splitext(path)[1].lower()
+        return file_ext in SUPPORTED_EXTENSIONS or file_ext in COMPRESSED_EXTENSIONS
+
+    @staticmethod
+    def _current_size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    def _take_snapshot(self):
+        return {item['path']: (item['size'], item['mtime']) for item in iter_work_items(self.directory_to_watch)}
+
+    def _drain_events(self, now):
+        while True:
+            try:
+                path, is_directory = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if is_directory:
+                if not self._is_relevant(path, is_directory=True):
+                    continue
+                # Pasta criada/movida já com conteúdo: varre apenas essa subárvore
+                for item in iter_work_items(path, max_workers=1):
+                    self._pending[item['path']] = (now, item['size'])
+            elif self._is_relevant(path):
+                self._pending[path] = (now, self._current_size(path))
+
+    def _poll(self, now):
+        if self._snapshot is None or now < self._next_poll:
+            return
+        snapshot = self._take_snapshot()
+        for path, signature in snapshot.items():
+            if self._snapshot.get(path) != signature:
+                self._pending[path] = (now, signature[0])
+        self._snapshot = snapshot
+        self._next_poll = now + self.poll_interval
+
+    def _ready_items(self, now):
+        ready = []
+        for path, (last_event, last_size) in list(self._pending.items()):
+            if now - last_event < self.debounce:
+                continue
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                del self._pending[path]  # Removido ou renomeado antes de estabilizar
+                continue
+            if stat_result.st_size != last_size:
+                # Ainda crescendo: aguarda mais um intervalo de debounce
+                self._pending[path] = (now, stat_result.st_size)
+                continue
+            del self._pending[path]
+            ready.append({
+                'path': path,
+                'filename': os.path.basename(path),
+                'ext': os.path.splitext(path)[1].lower(),
+                'size': stat_result.st_size,
+                'mtime': stat_result.st_mtime,
+            })
+        return ready
+
+    def iter_ready_items(self, stop_event=None, tick=1.0):
+        """Gerador infinito: itens prontos ou None a cada pulso (para o agendador recolher resultados)"""
+        while stop_event is None or not stop_event.is_set():
+            now = time.monotonic()
+            self._drain_events(now)
+            self._poll(now)
+            yield from self._ready_items(now)
+            yield None
+            time.sleep(tick)
+
+
+def run_watch_daemon(directory_to_watch, checkpoint_path=CHECKPOINT_DB_PATH, stop_event=None,
+                     index_path=INDEX_DB_PATH):
+    """
+    Modo daemon: mantém os workers (e seus motores de OCR) aquecidos e
+    processa arquivos novos em segundos, sem varrer novamente a árvore.
+    """
+    journal = CheckpointJournal(checkpoint_path)
+    index = ResultIndex(index_path) if INDEX_ENABLED and index_path else None
+    watcher = FolderWatcher(directory_to_watch)
+    scheduler = WorkScheduler()
+    handler = partial(process_work_item, checkpoint_path=checkpoint_path, resume=True)
+
+    def new_items():
+        for item in watcher.iter_ready_items(stop_event):
+            if item is not None and journal.is_done(CheckpointJournal.item_key(item)):
+                continue  # Evento repetido para um arquivo já processado
+            yield item
+
+    watcher.start()
+    logging.info("Modo daemon iniciado. Pressione Ctrl+C para encerrar.")
+    try:
+        for item, outcome, error in scheduler.run(new_items(), handler):
+            if isinstance(error, FileProcessingTimeout):
+                logging.error(f"TEMPO ESGOTADO ao processar arquivo {item['path']}: {error}")
+                journal.mark(CheckpointJournal.item_key(item), 'timeout')
+            elif error is not None:
+                logging.error(f"Erro ao processar arquivo {item['filename']}: {error}")
+                journal.mark(CheckpointJournal.item_key(item), 'failed')
+            elif index:
+                index.upsert(outcome['records'])
+    except KeyboardInterrupt:
+        logging.info("Encerrando modo daemon...")
+    finally:
+        watcher.stop()
+        journal.close()
+        if index:
+            index.close()
+
+
+# --- Serviço HTTP Local de Extração ---
+
+def analyze_upload(filename, client_folder_name, content):
+    """
+    Executado no worker: analisa um documento recebido pelo serviço,
+    diretamente em memória. Retorna ('ok', registro) ou ('erro', mensagem).
+    Cada requisição é uma tarefa própria no pool, com o tempo limite de um
+    arquivo: um documento travado não afeta as demais requisições.
+    """
+    result = analyze_bytes(content, filename, client_folder_name)
+    if result.ok:
+        return 'ok', result.to_dict()
+    return 'erro', result.erro
 
-    # Relatório final
-    logging.info(f"\n=== RELATÓRIO FINAL ===")
-    logging.info(f"Total de arquivos encontrados: {total_files}")
-    logging.info(f"Arquivos processados com sucesso: {processed_files}")
-    logging.info(f"Erros de processamento: {errors}")
-    logging.info(f"Taxa de sucesso: {(processed_files/total_files*100):.1f}%" if total_files > 0 else "N/A")
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /analyze?filename=<nome>&cliente=<pasta>  (corpo = bytes do documento)
+    GET  /health
+    """
+
+    server_version = "OCRInteligente/3.0"
+
+    def log_message(self, format, *args):
+        logging.debug(f"HTTP {self.address_string()} - {format % args}")
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != '/health':
+            self._send_json(404, {"erro": "Rota não encontrada"})
+            return
+        self._send_json(200, {"status": "ok", "em_processamento": self.server.in_flight})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/analyze':
+            self._send_json(404, {"erro": "Rota não encontrada"})
+            return
+        params = urllib.parse.parse_qs(url.query)
+        filename = params.get('filename', [''])[0]
+        client_folder_name = params.get('cliente', ['_SERVICO_'])[0]
+        file_ext = os.path.splitext(filename)[1].lower()
+        if file_ext not in SUPPORTED_EXTENSIONS:
+            self._send_json(400, {"erro": f"Parâmetro 'filename' ausente ou extensão não suportada: '{file_ext}'"})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > SERVICE_MAX_UPLOAD_MB * 1024 * 1024:
+            self._send_json(413, {"erro": f"Corpo vazio ou maior que {SERVICE_MAX_UPLOAD_MB} MB"})
+            return
+
+        # Contrapressão: acima do limite de admissão, recusa imediatamente
+        if not self.server.admission.acquire(blocking=False):
+            self._send_json(503, {"erro": "Serviço ocupado, tente novamente"}, {'Retry-After': '1'})
+            return
+        try:
+            with self.server.counter_lock:
+                self.server.in_flight += 1
+            content = self.rfile.read(length)
+            status, payload = self.server.pool.submit(analyze_upload, filename, client_folder_name, content).result()
+            if status == 'ok':
+                self._send_json(200, payload)
+            else:
+                self._send_json(422, {"erro": payload})
+        except FileProcessingTimeout as e:
+            self._send_json(504, {"erro": str(e)})
+        except Exception as e:
+            logging.error(f"Erro no serviço ao analisar {filename}: {e}")
+            self._send_json(500, {"erro": str(e)})
+        finally:
+            with self.server.counter_lock:
+                self.server.in_flight -= 1
+            self.server.admission.release()
+
+
+def run_extraction_service(host=SERVICE_HOST, port=SERVICE_PORT, workers=SERVICE_WORKERS):
+    """Sobe o serviço HTTP local com workers aquecidos e limite de concorrência"""
+    pool = IsolatedProcessPool(max_workers=workers, timeout=FILE_TIMEOUT_SECONDS)
+    server = ThreadingHTTPServer((host, port), ExtractionRequestHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.admission = threading.BoundedSemaphore(SERVICE_MAX_CONCURRENCY)
+    server.counter_lock = threading.Lock()
+    server.in_flight = 0
+    logging.info(f"Serviço de extração em http://{host}:{port} ({workers} worker(s))")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Encerrando serviço...")
+    finally:
+        server.server_close()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run_service_benchmark(url, file_patterns, concurrency=8, total_requests=200):
+    """
+    Gerador de carga local: envia documentos de exemplo ao serviço com N
+    clientes concorrentes e informa vazão e percentis de latência.
+    """
+    sample_paths = []
+    for pattern in file_patterns:
+        sample_paths.extend(p for p in glob.glob(pattern, recursive=True)
+                            if os.path.splitext(p)[1].lower() in SUPPORTED_EXTENSIONS)
+    if not sample_paths:
+        print("Nenhum arquivo de exemplo encontrado para o benchmark.")
+        return None
+    samples = []
+    for path in sample_paths:
+        with open(path, 'rb') as f:
+            samples.append((os.path.basename(path), f.read()))
+
+    endpoint = url.rstrip('/') + '/analyze'
+
+    def send_one(index):
+        filename, content = samples[index % len(samples)]
+        request = urllib.request.Request(
+            f"{endpoint}?{urllib.parse.urlencode({'filename': filename})}",
+            data=content, method='POST', headers={'Content-Type': 'application/octet-stream'})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=FILE_TIMEOUT_SECONDS) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = 'falha'
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send_one, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for status, latency in results if status == 200)
+    status_counts = Counter(str(status) for status, _ in results)
+
+    def percentile(p):
+        if not latencies:
+            return float('nan')
+        return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))] * 1000
+
+    report = {
+        'requisicoes': total_requests,
+        'concorrencia': concurrency,
+        'vazao_req_s': total_requests / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'media_ms': statistics.mean(latencies) * 1000 if latencies else float('nan'),
+        'status': dict(status_counts),
+    }
+    print(f"Requisições: {total_requests} | Concorrência: {concurrency} | Vazão: {report['vazao_req_s']:.1f} req/s")
+    print(f"Latência (ms): p50={report['p50_ms']:.1f} p90={report['p90_ms']:.1f} "
+          f"p95={report['p95_ms']:.1f} p99={report['p99_ms']:.1f} média={report['media_ms']:.1f}")
+    print(f"Status HTTP: {report['status']}")
+    return report
 
 
 # --- Bloco de Execução Principal ---
+
+def parse_arguments():
+    """Argumentos de linha de comando"""
+    parser = argparse.ArgumentParser(description="Sistema de IA para extração de dados de documentos")
+    parser.add_argument('--resume', action='store_true',
+                        help="Retoma a execução anterior, pulando arquivos já concluídos")
+    parser.add_argument('--watch', action='store_true',
+                        help="Modo daemon: monitora o BASE_PATH e processa arquivos novos continuamente")
+    parser.add_argument('--serve', action='store_true',
+                        help=f"Sobe o serviço HTTP local de extração (padrão: {SERVICE_HOST}:{SERVICE_PORT})")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help="Porta do serviço HTTP")
+    parser.add_argument('--bench-url', metavar='URL',
+                        help="Executa o gerador de carga contra um serviço já em execução")
+    parser.add_argument('--bench-files', nargs='+', default=[], metavar='GLOB',
+                        help="Arquivos de exemplo para o gerador de carga")
+    parser.add_argument('--bench-concurrency', type=int, default=8)
+    parser.add_argument('--bench-requests', type=int, default=200)
+    parser.add_argument('--query', action='store_true',
+                        help="Consulta o índice de resultados em vez de processar arquivos")
+    parser.add_argument('--cnpj', help="Filtro da consulta: CNPJ (com ou sem pontuação)")
+    parser.add_argument('--competencia', metavar='MM/AAAA', help="Filtro da consulta: competência")
+    parser.add_argument('--tipo', help="Filtro da consulta: trecho do tipo de arquivo")
+    parser.add_argument('--cliente', help="Filtro da consulta: trecho do nome da pasta do cliente")
+    parser.add_argument('--limit', type=int, help="Número máximo de registros da consulta")
+    parser.add_argument('--json', action='store_true', help="Imprime o resultado da consulta em JSON")
+    parser.add_argument('--queue', metavar='FILA',
+                        help="Coordenador distribuído: publica os arquivos na fila SQLite FILA (pasta compartilhada)")
+    parser.add_argument('--queue-worker', metavar='FILA',
+                        help="Worker distribuído: processa itens da fila FILA até ela esvaziar")
+    parser.add_argument('--base-path', metavar='PASTA',
+                        help=f"Pasta raiz dos documentos; a saída fica em PASTA/{JSON_OUTPUT_FOLDER_NAME} "
+                             f"(padrão: {BASE_PATH}). No modo distribuído, cada máquina informa a sua montagem")
+    parser.add_argument('--worker-id', help="Identificação do worker na fila (padrão: host:pid)")
+    parser.add_argument('--bench-queue', nargs='+', type=int, metavar='N',
+                        help="Mede a vazão da fila com N workers locais sobre o BASE_PATH (ex.: 1 2 4)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="Console silencioso: apenas avisos, erros e o resumo final (o arquivo de log continua completo)")
+    parser.add_argument('--regras', metavar='PASTA',
+                        help=f"Pasta de pacotes de regras de classificação (padrão: {RULE_PACKS_DIR})")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"Perfila cada arquivo (cProfile + tracemalloc) e grava os mais caros em {PROFILE_OUTPUT_DIR}")
+    parser.add_argument('--profile-slow-threshold', type=float, default=PROFILE_SLOW_SECONDS, metavar='SEGUNDOS',
+                        help="Mantém o perfil dos arquivos que levaram pelo menos SEGUNDOS")
+    parser.add_argument('--profile-memory-threshold', type=float, default=PROFILE_MEMORY_MB, metavar='MB',
+                        help="Mantém o perfil dos arquivos com pico de memória do Python de pelo menos MB")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    logging.info("=== INICIANDO SISTEMA DE IA PARA EXTRAÇÃO DE DADOS - VERSÃO CORRIGIDA ===")
+    args = parse_arguments()
+    if args.base_path:
+        configure_base_path(args.base_path)
+    if args.query:
+        run_index_query(INDEX_DB_PATH, args.cnpj, args.competencia, args.tipo, args.cliente,
+                        args.limit, 'json' if args.json else 'tabela')
+        raise SystemExit(0)
+    setup_logging(quiet=args.quiet)
+    configure_external_tools()
+    if args.regras:
+        configure_rule_packs(args.regras)
+    if args.profile:
+        configure_profiling(slow_seconds=args.profile_slow_threshold, memory_mb=args.profile_memory_threshold)
+    if args.bench_url:
+        run_service_benchmark(args.bench_url, args.bench_files, args.bench_concurrency, args.bench_requests)
+        raise SystemExit(0)
+    if args.serve:
+        run_extraction_service(port=args.port)
+        raise SystemExit(0)
+
+    logging.info("=== INICIANDO SISTEMA DE IA PARA EXTRAÇÃO DE DADOS - VERSÃO CORRIGIDA ===", extra=LOG_SUMMARY)
     logging.info("Versão: 3.0 - CNPJ da Pasta Corrigido")
     logging.info("Campos removidos do JSON: Qualidade_Extracao, Timestamp_Processamento, Tamanho_Texto_Extraido")
 
@@ -1127,13 +6417,30 @@ if __name__ == "__main__":
         logging.info(f"Pasta de Saída Principal: {JSON_OUTPUT_PATH}")
         logging.info(f"Inicializando sistema de IA...\n")
 
+        if args.watch:
+            run_watch_daemon(BASE_PATH, checkpoint_path=CHECKPOINT_DB_PATH, index_path=INDEX_DB_PATH)
+            raise SystemExit(0)
+        if args.queue_worker:
+            run_queue_worker(args.queue_worker, args.worker_id)
+            if args.profile:
+                write_profile_report()
+            raise SystemExit(0)
+        if args.bench_queue:
+            run_queue_benchmark(BASE_PATH, args.bench_queue)
+            raise SystemExit(0)
+
+        if args.profile:
+            reset_profile_dir()
         start_time = time.time()
-        main_recursive_process(BASE_PATH)
+        main_recursive_process(BASE_PATH, resume=args.resume, checkpoint_path=CHECKPOINT_DB_PATH,
+                               summary_base=SUMMARY_OUTPUT_BASE, index_path=INDEX_DB_PATH, queue_path=args.queue)
         end_time = time.time()
+        if args.profile:
+            write_profile_report()
 
         processing_time = end_time - start_time
-        logging.info(f"\nTempo total de processamento: {processing_time:.2f} segundos")
+        logging.info(f"\nTempo total de processamento: {processing_time:.2f} segundos", extra=LOG_SUMMARY)
 
-        logging.info("\n=== PROCESSAMENTO CONCLUÍDO ===")
+        logging.info("\n=== PROCESSAMENTO CONCLUÍDO ===", extra=LOG_SUMMARY)
         logging.info("Verifique o arquivo 'processamento_log.log' para um relatório detalhado.")
         logging.info("Sistema de IA finalizado com sucesso!")
\ No newline at end of file
@@ -1,119 +1,303 @@
 import re
 import os
+import sys
+import glob
+import gzip
+import heapq
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-def analisar_log(caminho_do_arquivo):
+# --- Configuração ---
+
+LOG_PADRAO = r"C:\Users\laurob\Desktop\processamento_log.log"
+ARQUIVO_RELATORIO = "relatorio_analise.txt"
+TOP_N_PADRAO = 50          # Limite de itens por lista do relatório (não classificados, clientes, tipos)
+TIPO_NAO_CLASSIFICADO = "Documento Não Classificado"
+
+# Expressões regulares
+padrao_arquivo = re.compile(r"Processando arquivo: (.*?) \s*\(Cliente: (.*)\)\s*$")
+padrao_tipo = re.compile(r"-> Tipo: (.*)")
+padrao_diretorio_raiz = re.compile(r"Diretório Raiz para Processamento: (.*)")
+padrao_data = re.compile(r"^(\d{4}-\d{2}-\d{2})")
+
+
+class ResultadoParcial:
     """
-    Analisa um arquivo de log para contabilizar arquivos classificados e não classificados.
-    Calcula a porcentagem de não classificados e, ao final, exibe o relatório
-    no console e o salva em um arquivo .txt.
+    Contadores de um arquivo de log (ou da soma de vários). A memória é
+    limitada: os clientes e tipos são contadores e, dos não classificados,
+    só os top_n mais recentes são guardados.
+    """
+    __slots__ = ('classificados', 'nao_classificados', 'por_tipo', 'por_cliente',
+                 'nao_classificados_por_cliente', 'recentes', 'top_n', 'logs_lidos', 'erros')
 
-    Args:
-        caminho_do_arquivo (str): O caminho completo para o arquivo .log.
+    def __init__(self, top_n=TOP_N_PADRAO):
+        self.classificados = 0
+        self.nao_classificados = 0
+        self.por_tipo = Counter()
+        self.por_cliente = Counter()
+        self.nao_classificados_por_cliente = Counter()
+        self.recentes = []  # heap de (data/hora, caminho, cliente) com os top_n mais recentes
+        self.top_n = top_n
+        self.logs_lidos = 0
+        self.erros = []
+
+    def registrar(self, data_hora, caminho, cliente, tipo_documento):
+        self.por_tipo[tipo_documento] += 1
+        self.por_cliente[cliente] += 1
+        if tipo_documento != TIPO_NAO_CLASSIFICADO:
+            self.classificados += 1
+            return
+        self.nao_classificados += 1
+        self.nao_classificados_por_cliente[cliente] += 1
+        item = (data_hora, caminho, cliente)
+        if len(self.recentes) < self.top_n:
+            heapq.heappush(self.recentes, item)
+        elif item > self.recentes[0]:
+            heapq.heapreplace(self.recentes, item)
+
+    def mesclar(self, outro):
+        self.classificados += outro.classificados
+        self.nao_classificados += outro.nao_classificados
+        self.por_tipo.update(outro.por_tipo)
+        self.por_cliente.update(outro.por_cliente)
+        self.nao_classificados_por_cliente.update(outro.nao_classificados_por_cliente)
+        self.recentes = heapq.nlargest(self.top_n, self.recentes + outro.recentes)
+        heapq.heapify(self.recentes)
+        self.logs_lidos += outro.logs_lidos
+        self.erros.extend(outro.erros)
+        return self
+
+
+# --- Leitura dos Logs ---
+
+def abrir_log(caminho_do_arquivo):
+    """Abre logs em texto puro ou compactados (.gz, como os arquivados na rotação)"""
+    if caminho_do_arquivo.lower().endswith('.gz'):
+        return gzip.open(caminho_do_arquivo, 'rt', encoding='utf-8', errors='replace')
+    return open(caminho_do_arquivo, 'r', encoding='utf-8', errors='replace')
+
+def expandir_caminhos(padroes):
+    """Expande os padrões glob (inclusive '**') na ordem informada, sem repetir arquivos"""
+    caminhos = []
+    vistos = set()
+    for padrao in padroes:
+        encontrados = sorted(glob.glob(padrao, recursive=True)) if glob.has_magic(padrao) else [padrao]
+        for caminho in encontrados:
+            chave = os.path.normcase(os.path.abspath(caminho))
+            if chave not in vistos and os.path.isfile(caminho):
+                vistos.add(chave)
+                caminhos.append(caminho)
+    return caminhos
+
+def analisar_arquivo_log(caminho_do_arquivo, data_inicial=None, data_final=None, cliente=None,
+                         top_n=TOP_N_PADRAO):
     """
-    # Verifica se o caminho do arquivo existe
-    if not os.path.exists(caminho_do_arquivo):
-        print(f"--- ERRO ---")
-        print(f"O arquivo não foi encontrado no caminho especificado: {caminho_do_arquivo}")
-        print("Por favor, verifique se o caminho está correto e tente novamente.")
-        return
+    Lê um arquivo de log em streaming e devolve um ResultadoParcial.
+    data_inicial/data_final ('AAAA-MM-DD') filtram pela data da linha
+    "Processando arquivo"; cliente filtra por trecho do nome da pasta do
+    cliente (sem diferenciar maiúsculas).
+    """
+    resultado = ResultadoParcial(top_n)
+    # Log rotacionado sem escrita desde antes do período: nada a ler
+    if data_inicial and datetime.fromtimestamp(os.path.getmtime(caminho_do_arquivo)).strftime('%Y-%m-%d') < data_inicial:
+        return resultado
+    cliente_filtro = cliente.casefold() if cliente else None
 
-    # Contadores e listas para armazenar os resultados
-    classificados = 0
-    nao_classificados = 0
-    arquivos_nao_classificados = []
-    
     arquivo_atual = None
     diretorio_raiz = ""
-
-    # Expressões regulares
-    padrao_arquivo = re.compile(r"Processando arquivo: (.*?) \s*\(Cliente:")
-    padrao_tipo = re.compile(r"-> Tipo: (.*)")
-    padrao_diretorio_raiz = re.compile(r"Diretório Raiz para Processamento: (.*)")
-
     try:
-        with open(caminho_do_arquivo, 'r', encoding='utf-8') as f:
+        with abrir_log(caminho_do_arquivo) as f:
             for linha in f:
-                match_diretorio = padrao_diretorio_raiz.search(linha)
-                if match_diretorio and not diretorio_raiz:
-                    diretorio_raiz = match_diretorio.group(1).strip()
-
-                match_arquivo = padrao_arquivo.search(linha)
-                if match_arquivo:
-                    arquivo_atual = match_arquivo.group(1).strip()
-                    continue
-
-                match_tipo = padrao_tipo.search(linha)
-                if match_tipo and arquivo_atual:
-                    tipo_documento = match_tipo.group(1).strip()
-                    
-                    if tipo_documento == "Documento Não Classificado":
-                        nao_classificados += 1
-                        caminho_completo = os.path.join(diretorio_raiz, arquivo_atual)
-                        arquivos_nao_classificados.append(caminho_completo)
-                    else:
-                        classificados += 1
-                    
+                # Testes de substring antes das regex: a maioria das linhas não interessa
+                if 'Processando arquivo: ' in linha:
+                    match_arquivo = padrao_arquivo.search(linha)
                     arquivo_atual = None
-
+                    if not match_arquivo:
+                        continue
+                    match_data = padrao_data.match(linha)
+                    data_linha = match_data.group(1) if match_data else ''
+                    if data_inicial and data_linha < data_inicial:
+                        continue
+                    if data_final and data_linha > data_final:
+                        continue
+                    cliente_atual = match_arquivo.group(2).strip()
+                    if cliente_filtro and cliente_filtro not in cliente_atual.casefold():
+                        continue
+                    arquivo_atual = (linha[:23], match_arquivo.group(1).strip(), cliente_atual)
+                elif '-> Tipo: ' in linha:
+                    if arquivo_atual is None:
+                        continue
+                    tipo_documento = padrao_tipo.search(linha).group(1).strip()
+                    data_hora, nome_arquivo, cliente_atual = arquivo_atual
+                    # Sem reiniciar arquivo_atual: um PDF dividido em vários documentos
+                    # grava um "-> Tipo:" por documento, todos sob o mesmo arquivo
+                    resultado.registrar(data_hora, os.path.join(diretorio_raiz, nome_arquivo),
+                                        cliente_atual, tipo_documento)
+                elif 'Diretório Raiz para Processamento: ' in linha:
+                    # Cada execução registra a sua raiz; um log pode conter várias execuções
+                    diretorio_raiz = padrao_diretorio_raiz.search(linha).group(1).strip()
     except Exception as e:
-        print(f"Ocorreu um erro inesperado ao processar o arquivo: {e}")
-        return
+        resultado.erros.append(f"{caminho_do_arquivo}: {e}")
+        return resultado
 
-    # --- Cálculo da Porcentagem ---
-    total_de_arquivos = classificados + nao_classificados
+    resultado.logs_lidos = 1
+    return resultado
+
+def analisar_logs(caminhos, data_inicial=None, data_final=None, cliente=None, top_n=TOP_N_PADRAO,
+                  workers=None):
+    """
+    Analisa vários logs, um processo por arquivo, e mescla os contadores.
+    Com um único arquivo (ou workers=1), lê no próprio processo.
+    """
+    total = ResultadoParcial(top_n)
+    workers = workers or os.cpu_count() or 1
+    argumentos = (data_inicial, data_final, cliente, top_n)
+    if len(caminhos) <= 1 or workers <= 1:
+        for caminho in caminhos:
+            total.mesclar(analisar_arquivo_log(caminho, *argumentos))
+        return total
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(caminhos))) as executor:
+        futuros = [executor.submit(analisar_arquivo_log, caminho, *argumentos) for caminho in caminhos]
+        for futuro in futuros:
+            total.mesclar(futuro.result())
+    return total
+
+
+# --- Relatório ---
+
+def montar_relatorio(resultado, descricao_logs, filtros):
+    """Monta o texto do relatório a partir do resultado mesclado"""
+    total_de_arquivos = resultado.classificados + resultado.nao_classificados
     # Evita divisão por zero se o log estiver vazio
     if total_de_arquivos > 0:
-        porcentagem_nao_classificados = (nao_classificados / total_de_arquivos) * 100
+        porcentagem_nao_classificados = (resultado.nao_classificados / total_de_arquivos) * 100
     else:
         porcentagem_nao_classificados = 0
 
-    # --- Montagem do Relatório ---
     linhas_relatorio = []
-    
+
     linhas_relatorio.append("======================================================")
     linhas_relatorio.append("          ANÁLISE DO LOG DE PROCESSAMENTO           ")
     linhas_relatorio.append("======================================================")
-    linhas_relatorio.append(f"Arquivo de Log Analisado: {caminho_do_arquivo}")
+    linhas_relatorio.append(f"Arquivo de Log Analisado: {descricao_logs}")
     linhas_relatorio.append(f"Data da Análise: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
-    
+    if filtros:
+        linhas_relatorio.append(f"Filtros: {'; '.join(filtros)}")
+
     # Formata a porcentagem para o padrão brasileiro (vírgula)
     porcentagem_formatada = f"{porcentagem_nao_classificados:.2f}".replace('.', ',')
 
     linhas_relatorio.append("\nResumo da Classificação:\n")
-    linhas_relatorio.append(f"  - Arquivos Classificados com Sucesso: {classificados}")
-    linhas_relatorio.append(f"  - Arquivos Não Classificados:         {nao_classificados}")
+    linhas_relatorio.append(f"  - Arquivos Classificados com Sucesso: {resultado.classificados}")
+    linhas_relatorio.append(f"  - Arquivos Não Classificados:         {resultado.nao_classificados}")
     if total_de_arquivos > 0:
         linhas_relatorio.append(f"\n  - {porcentagem_formatada}% de arquivos não classificados")
 
+    top_n = resultado.top_n
+    if resultado.por_tipo:
+        linhas_relatorio.append(f"\nDocumentos por Tipo (top {top_n}):\n")
+        for tipo_documento, quantidade in resultado.por_tipo.most_common(top_n):
+            linhas_relatorio.append(f"  - {tipo_documento}: {quantidade}")
+    if resultado.nao_classificados_por_cliente:
+        linhas_relatorio.append(f"\nClientes com Mais Não Classificados (top {top_n}):\n")
+        for nome_cliente, quantidade in resultado.nao_classificados_por_cliente.most_common(top_n):
+            total_cliente = resultado.por_cliente[nome_cliente]
+            linhas_relatorio.append(f"  - {nome_cliente}: {quantidade} de {total_cliente}")
+
     linhas_relatorio.append("\n------------------------------------------------------\n")
 
-    if arquivos_nao_classificados:
-        linhas_relatorio.append("Arquivos com 'Tipo: Documento Não Classificado':\n")
-        for i, caminho in enumerate(arquivos_nao_classificados, 1):
-            linhas_relatorio.append(f"{i}. {caminho}")
+    if resultado.nao_classificados:
+        recentes = sorted(resultado.recentes, reverse=True)
+        linhas_relatorio.append(f"Arquivos com 'Tipo: {TIPO_NAO_CLASSIFICADO}' "
+                                f"(os {len(recentes)} mais recentes de {resultado.nao_classificados}):\n")
+        for i, (data_hora, caminho, nome_cliente) in enumerate(recentes, 1):
+            linhas_relatorio.append(f"{i}. [{data_hora}] {caminho} (Cliente: {nome_cliente})")
     else:
         linhas_relatorio.append("🎉 Todos os arquivos foram classificados com sucesso!")
-        
+
+    if resultado.erros:
+        linhas_relatorio.append("\nLogs com erro de leitura:\n")
+        for erro in resultado.erros:
+            linhas_relatorio.append(f"  - {erro}")
+
     linhas_relatorio.append("\n======================================================")
+    return "\n".join(linhas_relatorio)
+
+def _data_iso(valor):
+    """Converte DD/MM/AAAA (ou AAAA-MM-DD) para AAAA-MM-DD, o formato das linhas do log"""
+    for formato in ('%d/%m/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(valor, formato).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"data inválida: {valor} (use DD/MM/AAAA)")
+
+def analisar_log(caminho_do_arquivo, data_inicial=None, data_final=None, cliente=None,
+                 top_n=TOP_N_PADRAO, workers=None, arquivo_saida=ARQUIVO_RELATORIO):
+    """
+    Analisa um ou mais arquivos de log para contabilizar arquivos classificados e não classificados.
+    Calcula a porcentagem de não classificados e, ao final, exibe o relatório
+    no console e o salva em um arquivo .txt.
+
+    Args:
+        caminho_do_arquivo (str ou list): Caminho(s) ou padrão(ões) glob de logs (.log ou .log.gz).
+        data_inicial, data_final (str): Período 'AAAA-MM-DD' (inclusive), opcional.
+        cliente (str): Trecho do nome da pasta do cliente, opcional.
+        top_n (int): Limite de itens de cada lista do relatório.
+        workers (int): Processos de leitura (padrão: número de CPUs).
+        arquivo_saida (str): Caminho do relatório .txt.
+    """
+    padroes = [caminho_do_arquivo] if isinstance(caminho_do_arquivo, str) else list(caminho_do_arquivo)
+    caminhos = expandir_caminhos(padroes)
+    # Verifica se algum arquivo foi encontrado
+    if not caminhos:
+        print(f"--- ERRO ---")
+        print(f"Nenhum arquivo encontrado no caminho especificado: {', '.join(padroes)}")
+        print("Por favor, verifique se o caminho está correto e tente novamente.")
+        return None
+
+    resultado = analisar_logs(caminhos, data_inicial, data_final, cliente, top_n, workers)
+
+    filtros = []
+    if data_inicial or data_final:
+        filtros.append(f"período {data_inicial or '...'} a {data_final or '...'}")
+    if cliente:
+        filtros.append(f"cliente contém '{cliente}'")
+    descricao_logs = caminhos[0] if len(caminhos) == 1 else f"{len(caminhos)} arquivos ({', '.join(padroes)})"
 
     # --- Apresentação dos Resultados no Console ---
-    relatorio_final = "\n".join(linhas_relatorio)
+    relatorio_final = montar_relatorio(resultado, descricao_logs, filtros)
     print(relatorio_final)
 
     # --- Salvamento do Relatório em Arquivo .txt ---
-    nome_arquivo_saida = "relatorio_analise.txt"
     try:
-        with open(nome_arquivo_saida, 'w', encoding='utf-8') as f:
+        with open(arquivo_saida, 'w', encoding='utf-8') as f:
             f.write(relatorio_final)
-        print(f"\n✅ Relatório também foi salvo com sucesso em: {os.path.abspath(nome_arquivo_saida)}")
+        print(f"\n✅ Relatório também foi salvo com sucesso em: {os.path.abspath(arquivo_saida)}")
     except Exception as e:
         print(f"\n❌ Ocorreu um erro ao salvar o arquivo de relatório: {e}")
+    return resultado
 
+def parse_arguments(argv=None):
+    """Argumentos de linha de comando"""
+    parser = argparse.ArgumentParser(description="Análise dos logs de processamento do OCR_inteligente")
+    parser.add_argument('logs', nargs='*', default=[LOG_PADRAO], metavar='LOG',
+                        help="Arquivos ou padrões glob de logs, texto ou .gz (ex.: \"logs/processamento_log*.gz\")")
+    parser.add_argument('--de', type=_data_iso, metavar='DD/MM/AAAA', help="Considera apenas arquivos processados a partir desta data")
+    parser.add_argument('--ate', type=_data_iso, metavar='DD/MM/AAAA', help="Considera apenas arquivos processados até esta data")
+    parser.add_argument('--cliente', help="Filtra por trecho do nome da pasta do cliente")
+    parser.add_argument('--top', type=int, default=TOP_N_PADRAO, metavar='N',
+                        help="Itens listados por seção do relatório")
+    parser.add_argument('--workers', type=int, help="Processos de leitura em paralelo (padrão: número de CPUs)")
+    parser.add_argument('--saida', default=ARQUIVO_RELATORIO, help="Arquivo do relatório")
+    return parser.parse_args(argv)
 
-# --- INÍCIO DA EXECUÇÃO ---
-# Especifique o caminho para o seu arquivo de log aqui.
-caminho_do_log = r"C:\Users\laurob\Desktop\processamento_log.log"
 
-# Chama a função principal para iniciar a análise
-analisar_log(caminho_do_log)
\ No newline at end of file
+# --- INÍCIO DA EXECUÇÃO ---
+if __name__ == "__main__":
+    args = parse_arguments()
+    resultado = analisar_log(args.logs, args.de, args.ate, args.cliente, args.top, args.workers, args.saida)
+    sys.exit(0 if resultado is not None else 1)